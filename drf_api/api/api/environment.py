@@ -14,4 +14,10 @@ DB_PASSWORD = "<PASSWORD>"
 DB_NAME = "api"
 # DB_NAME = "rnpnew"
 DB_HOST = "api-pgdb"
-DB_PORT = '5432'
\ No newline at end of file
+DB_PORT = '5432'
+# Incoming credit limits per account level, in transactionAmount units
+MERCHANT_CREDIT_LIMITS = {
+    "L0" : {"daily" : 2500000, "monthly" : 5000000},
+    "L1" : {"daily" : 5000000, "monthly" : 40000000},
+    "L2" : {"daily" : 50000000, "monthly" : 200000000},
+}
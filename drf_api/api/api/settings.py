@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.payload.RequestPayloadMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -56,6 +57,17 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'api.urls'
 
+REST_FRAMEWORK = {
+    'DEFAULT_PARSER_CLASSES': [
+        'core.payload.CachedJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
+# Largest request body (in bytes) the payload layer will decode
+PAYLOAD_MAX_BODY_SIZE = 64 * 1024
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -128,3 +140,132 @@ STATIC_URL = '/static/'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Seconds between allowlist file/redis version checks in core.allowlist
+ALLOWLIST_CHECK_INTERVAL = 1.0
+
+
+# Per-merchant request serialization in SyncLockMiddleware: "advisory" (postgres)
+# or "redis" (lease lock), overridable per route with RoutePolicy(lock_backend=...)
+SYNC_LOCK_BACKEND = "advisory"
+SYNC_LOCK_LEASE_MS = 30000
+# Backend used while the route's backend is unreachable (redis down), None
+# answers those requests with a 429 instead
+SYNC_LOCK_FALLBACK_BACKEND = "advisory"
+# How long a request may queue behind the holder of its lock before the 429,
+# and how many may queue per key, for routes that don't set their own
+SYNC_LOCK_WAIT_MS = 0
+SYNC_LOCK_MAX_WAITERS = None
+
+# Issue HMAC signed bearer tokens (core.tokens) verified without a database hit.
+# Keys are rotated by adding a new kid and switching AUTH_TOKEN_ACTIVE_KEY_ID,
+# SECRET_KEY is used when no keys are configured.
+AUTH_TOKEN_SIGNED = False
+AUTH_TOKEN_SIGNING_KEYS = {}
+AUTH_TOKEN_ACTIVE_KEY_ID = None
+AUTH_TOKEN_REVOCATION_REFRESH = 5.0
+
+# Wallet authentication principal cache (core.principal), seconds
+PRINCIPAL_CACHE_TTL = 60
+PRINCIPAL_LOCAL_TTL = 5
+
+# Background RequestLog writer (core.request_log), postgres only
+REQUEST_LOG_ASYNC = True
+REQUEST_LOG_QUEUE_SIZE = 10000
+REQUEST_LOG_BATCH_SIZE = 200
+REQUEST_LOG_FLUSH_INTERVAL_MS = 200
+REQUEST_LOG_PUT_TIMEOUT_MS = 20
+
+# Per-process copy of the decoded wallet catalog (core.redis_ops.WalletLocalCache),
+# checked against wallet_timestamps on every read unless WALLET_L1_PUBSUB is on
+WALLET_L1_ENABLED = True
+WALLET_L1_TTL = 300
+WALLET_L1_MAX_ENTRIES = 64
+WALLET_L1_PUBSUB = False
+
+# Single-flight rebuild of cleared wallet sections, other workers serve the
+# stale copy or wait up to WALLET_REBUILD_WAIT_MS. WALLET_CACHE_WARM_ON_SAVE
+# rebuilds sections when vendor, voucher or biller rows are saved.
+WALLET_REBUILD_LEASE_MS = 10000
+WALLET_REBUILD_WAIT_MS = 2000
+WALLET_CACHE_WARM_ON_SAVE = False
+
+# Threads per process running independent wallet lookups concurrently
+# (core.fanout), 0 runs them one after another
+WALLET_FANOUT_WORKERS = 8
+
+# Serve TitleFetch and Wallet with their async views, for the ASGI deployment
+# (api/asgi.py). Under WSGI keep it off, every async view runs its own loop.
+ASYNC_VIEWS = False
+
+# Switch credits and reversals are claimed per (rrn, stan, transmission date)
+# in redis (core.idempotency), retries within IDEMPOTENCY_TTL seconds get the
+# original response back. A retry arriving while the original is in flight
+# waits up to IDEMPOTENCY_WAIT_MS for its result, an in-flight claim is leased
+# for IDEMPOTENCY_PENDING_TTL seconds.
+IDEMPOTENCY_TTL = 7 * 24 * 3600
+IDEMPOTENCY_PENDING_TTL = 120
+IDEMPOTENCY_WAIT_MS = 2000
+
+# IBAN lookups of the switch endpoints (transaction.accounts) are cached as
+# account snapshots in redis for ACCOUNT_CACHE_TTL seconds and per process
+# for ACCOUNT_LOCAL_TTL seconds, the bound on how long another process may
+# serve a merchant status or credit block change late. A change leaves a
+# tombstone for ACCOUNT_TOMBSTONE_TTL seconds that lookups which read the old
+# row cannot overwrite.
+ACCOUNT_CACHE_TTL = 300
+ACCOUNT_LOCAL_TTL = 5
+ACCOUNT_LOCAL_MAX_ENTRIES = 10000
+ACCOUNT_TOMBSTONE_TTL = 10
+
+# Outbox events (core.outbox) are delivered by the dispatch_outbox worker in
+# batches of OUTBOX_BATCH_SIZE. Failed deliveries are retried with backoff
+# doubling from OUTBOX_BACKOFF_SECONDS up to OUTBOX_MAX_BACKOFF_SECONDS, and
+# given up after OUTBOX_MAX_ATTEMPTS. A claimed event is retried after
+# OUTBOX_LEASE_SECONDS when its worker dies, each event is leased again as
+# its delivery starts so the lease must be longer than OUTBOX_DELIVERY_SECONDS
+# (checked on startup). The partner calls of a handler share an
+# OUTBOX_DELIVERY_SECONDS budget (core.http.deadline), a call the budget
+# can't cover fails the attempt and the event is retried.
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_BACKOFF_SECONDS = 5
+OUTBOX_MAX_BACKOFF_SECONDS = 3600
+OUTBOX_LEASE_SECONDS = 300
+OUTBOX_DELIVERY_SECONDS = 15
+
+# Merchant to udhaar business lookups (core.businesses) are cached in redis
+# for BUSINESS_CACHE_TTL seconds, BUSINESS_MISSING_TTL when the merchant has
+# no business, and per process for BUSINESS_LOCAL_TTL seconds. Run
+# "business_cache --watch" to drop entries as soon as a business changes.
+BUSINESS_CACHE_TTL = 3600
+BUSINESS_MISSING_TTL = 60
+BUSINESS_LOCAL_TTL = 60
+BUSINESS_LOCAL_MAX_ENTRIES = 10000
+
+# Outbound partner calls (core.http) use a keep-alive session per partner
+# host. Connect/read timeouts are cut to the budget of the enclosing
+# core.http.deadline() block, retries back off from PARTNER_HTTP_RETRY_BACKOFF
+# seconds and stop when the budget is spent. Inside a deadline() block plain
+# requests.get/post calls (record_deposit_to_rnp's) go through it as well.
+PARTNER_HTTP_CONNECT_TIMEOUT = 3.0
+PARTNER_HTTP_READ_TIMEOUT = 10.0
+PARTNER_HTTP_RETRIES = 2
+PARTNER_HTTP_RETRY_BACKOFF = 0.2
+PARTNER_HTTP_POOL_MAXSIZE = 20
+
+# Incoming credit limits per account level over Pakistan calendar days and
+# months (merchant.limits) come from api/environment.py as
+# MERCHANT_CREDIT_LIMITS = {level: {"daily": ..., "monthly": ...}}, the
+# merchant.E001 system check requires every account level to have both
+
+# Primary keys reserved per block by core.ids, per model label overrides
+ID_BLOCK_SIZE = 100
+ID_BLOCK_SIZES = {
+    "core.RequestLog" : 200,
+}
+
+# RequestLog retention (request_log_partitions --prune)
+REQUEST_LOG_RETENTION_MONTHS = 6
+REQUEST_LOG_ARCHIVE_DIR = BASE_DIR / 'archive' / 'request_log'
\ No newline at end of file
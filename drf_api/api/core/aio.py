@@ -0,0 +1,36 @@
+import asyncio
+from asgiref.sync import markcoroutinefunction
+
+
+class DualModeMiddleware:
+    """
+    Base of middlewares that run natively under both WSGI and ASGI.
+
+    When the next handler is async, __call__ returns acall() and
+    aprocess_view (when defined) replaces process_view, so Django awaits
+    them directly instead of hopping to its sync thread for every request.
+    Subclasses override handle()/ahandle() and process_view()/aprocess_view().
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+
+        if self.is_async:
+            markcoroutinefunction(self)
+            if hasattr(self, "aprocess_view"):
+                self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.ahandle(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        return self.get_response(request)
+
+    async def ahandle(self, request):
+        return await self.get_response(request)
@@ -0,0 +1,216 @@
+import bisect
+import ipaddress
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from core.redis_ops import conn
+
+log = logging.getLogger("django")
+
+IP_GROUPS = ['all', 'hbl', 'kunda', 'internal_data']
+
+MERCHANTS_FILE = 'white_listed_merchants.txt'
+
+VERSION_KEY = "allowlist_version"
+
+DEFAULT_CHECK_INTERVAL = 1.0
+
+
+def ip_file_name(group):
+    return '%s_ips.txt' % group
+
+
+def read_entries(filename):
+    """Non empty, non comment lines of an allowlist file, [] if it is missing."""
+
+    try:
+        with open(filename, 'r') as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return []
+
+    entries = []
+
+    for line in lines:
+        line = line.split('#')[0].strip()
+        if line:
+            entries.append(line)
+
+    return entries
+
+
+class IPAllowlist:
+    """
+    Sorted, merged interval table of IPv4 and IPv6 networks.
+    Single addresses and CIDR blocks are both accepted, lookups are a
+    bisect over the interval starts of the address family.
+    """
+
+    def __init__(self, entries=()):
+
+        intervals = {4: [], 6: []}
+
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(entry, strict=False)
+            except ValueError:
+                log.warning("Invalid allowlist entry %s" % entry)
+                continue
+
+            intervals[network.version].append(
+                (int(network.network_address), int(network.broadcast_address))
+            )
+
+        self.tables = {
+            version: self._merge(ranges) for version, ranges in intervals.items()
+        }
+        self.starts = {
+            version: [start for start, end in table] for version, table in self.tables.items()
+        }
+
+    @staticmethod
+    def _merge(ranges):
+
+        merged = []
+
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+
+        return merged
+
+    def __contains__(self, ip):
+
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+
+        value = int(address)
+        index = bisect.bisect_right(self.starts[address.version], value) - 1
+
+        if index < 0:
+            return False
+
+        return value <= self.tables[address.version][index][1]
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+
+class AllowlistSnapshot:
+
+    def __init__(self, ips, merchants, signature):
+        self.ips = ips
+        self.merchants = merchants
+        self.signature = signature
+
+
+class AllowlistEngine:
+    """
+    Holds the compiled IP and merchant allowlists of the process.
+
+    The files are stat'ed and the redis version key read at most once per
+    ALLOWLIST_CHECK_INTERVAL seconds. When either changed a new snapshot is
+    built and swapped in with a single assignment, so readers never see a
+    half built allowlist and never wait on a reload.
+
+    The first snapshot is built by the first lookup, so importing the
+    module reads neither the files nor redis.
+    """
+
+    def __init__(self, directory=None, check_interval=None):
+        self.directory = directory or ''
+        self.check_interval = check_interval if check_interval is not None else getattr(
+            settings, "ALLOWLIST_CHECK_INTERVAL", DEFAULT_CHECK_INTERVAL
+        )
+        self._reload_lock = threading.Lock()
+        self._checked_at = 0
+        self.snapshot = None
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _files(self):
+        return [self._path(ip_file_name(group)) for group in IP_GROUPS] + [self._path(MERCHANTS_FILE)]
+
+    def _signature(self):
+
+        mtimes = []
+
+        for filename in self._files():
+            try:
+                mtimes.append(os.stat(filename).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+
+        try:
+            version = conn.get(VERSION_KEY)
+        except Exception as e:
+            log.warning("Allowlist version check failed: %s" % e)
+            version = None
+
+        return (tuple(mtimes), version)
+
+    def _build(self, signature):
+
+        ips = {
+            group: IPAllowlist(read_entries(self._path(ip_file_name(group)))) for group in IP_GROUPS
+        }
+        merchants = frozenset(read_entries(self._path(MERCHANTS_FILE)))
+
+        return AllowlistSnapshot(ips, merchants, signature)
+
+    def refresh_due(self):
+        """Whether the next lookup will stat the files and read redis."""
+        return self.snapshot is None or time.monotonic() - self._checked_at >= self.check_interval
+
+    def refresh(self, force=False):
+
+        now = time.monotonic()
+        building = self.snapshot is None
+
+        if not (force or building) and now - self._checked_at < self.check_interval:
+            return self.snapshot
+
+        # only the first build makes lookups wait, reloads keep serving the old snapshot
+        if not self._reload_lock.acquire(blocking=building):
+            return self.snapshot
+
+        try:
+            if self.snapshot is not None and building and not force:
+                # built by another thread while this one waited
+                return self.snapshot
+
+            self._checked_at = now
+            signature = self._signature()
+
+            if force or self.snapshot is None or signature != self.snapshot.signature:
+                self.snapshot = self._build(signature)
+                log.info("Allowlists reloaded")
+        finally:
+            self._reload_lock.release()
+
+        return self.snapshot
+
+    def ip_allowed(self, group, ip):
+        ips = self.refresh().ips.get(group)
+        return ips is not None and ip in ips
+
+    def merchant_allowed(self, phone_number):
+        return phone_number in self.refresh().merchants
+
+    def bump_version(self):
+        """Tells every worker to reload its allowlists on the next check."""
+        return conn.incr(VERSION_KEY)
+
+
+allowlists = AllowlistEngine()
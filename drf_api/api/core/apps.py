@@ -1,6 +1,24 @@
 from django.apps import AppConfig
+import logging
+
+log = logging.getLogger("django")
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from core.routes import route_policies
+        import core.checks  # noqa: registers the system checks
+        from core import http
+        import core.principal  # noqa: connects the principal cache invalidation
+        import core.tokens  # noqa: connects the token revocation
+
+        http.install()
+
+        try:
+            route_policies.compile()
+        except Exception as e:
+            # compiled lazily on the first lookup instead
+            log.exception(e)
\ No newline at end of file
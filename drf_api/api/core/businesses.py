@@ -0,0 +1,221 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from bson import json_util
+from django.conf import settings
+from core.redis_ops import conn
+from core.mongodb import db
+
+log = logging.getLogger("django")
+
+DEFAULT_CACHE_TTL = 3600
+DEFAULT_MISSING_TTL = 60
+DEFAULT_LOCAL_TTL = 60
+DEFAULT_LOCAL_MAX_ENTRIES = 10000
+
+# every field of the lookup is in the index, mongo answers it from the
+# index alone without fetching the documents
+INDEX_NAME = "user_cloud_id_is_active_id_name"
+INDEX_KEYS = [("user_cloud_id", 1), ("is_active", 1), ("id", 1), ("name", 1)]
+PROJECTION = {"id" : 1, "_id" : 0, "name" : 1}
+
+MISSING = {"id" : None, "name" : None}
+
+
+class BusinessResolver:
+    """
+    Resolves a merchant's phone number (user_cloud_id) to the id and name of
+    its active udhaar business.
+
+    Looks in a per-process LRU (BUSINESS_LOCAL_TTL seconds, at most
+    BUSINESS_LOCAL_MAX_ENTRIES), then redis (BUSINESS_CACHE_TTL seconds,
+    BUSINESS_MISSING_TTL for merchants without a business), then runs the
+    covered find_one. Entries are dropped by the business_cache --watch
+    change stream when a business is written.
+    """
+
+    KEY_PREFIX = "udhaar_business:"
+    RESUME_TOKEN_KEY = "udhaar_business_watch:resume_token"
+
+    def __init__(self, client=None, collection=None):
+        self.client = client or conn
+        self.collection = collection
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, "BUSINESS_CACHE_TTL", DEFAULT_CACHE_TTL)
+
+    @property
+    def missing_ttl(self):
+        return getattr(settings, "BUSINESS_MISSING_TTL", DEFAULT_MISSING_TTL)
+
+    @property
+    def local_ttl(self):
+        return getattr(settings, "BUSINESS_LOCAL_TTL", DEFAULT_LOCAL_TTL)
+
+    @property
+    def local_max_entries(self):
+        return getattr(settings, "BUSINESS_LOCAL_MAX_ENTRIES", DEFAULT_LOCAL_MAX_ENTRIES)
+
+    def businesses(self):
+        return self.collection if self.collection is not None else db.businesses
+
+    def redis_key(self, user_cloud_id):
+        return "%s%s%s" % (settings.ENV, self.KEY_PREFIX, user_cloud_id)
+
+    def load(self, user_cloud_id):
+
+        business = self.businesses().find_one(
+            {"user_cloud_id" : user_cloud_id, "is_active" : True}, PROJECTION
+        )
+
+        if not business:
+            return dict(MISSING)
+
+        return {"id" : business.get("id"), "name" : business.get("name")}
+
+    def _local_get(self, user_cloud_id, now):
+
+        with self.lock:
+
+            cached = self.local.get(user_cloud_id)
+
+            if cached is None:
+                return None
+
+            if cached[0] <= now:
+                self.local.pop(user_cloud_id, None)
+                return None
+
+            self.local.move_to_end(user_cloud_id)
+            return cached[1]
+
+    def _remember(self, user_cloud_id, business, now):
+
+        with self.lock:
+
+            self.local[user_cloud_id] = (now + self.local_ttl, business)
+            self.local.move_to_end(user_cloud_id)
+
+            while len(self.local) > self.local_max_entries:
+                self.local.popitem(last=False)
+
+    def resolve(self, user_cloud_id):
+        """{"id", "name"} of the business, both None when there is none."""
+
+        now = time.monotonic()
+        business = self._local_get(user_cloud_id, now)
+
+        if business is not None:
+            return dict(business)
+
+        try:
+            value = self.client.get(self.redis_key(user_cloud_id))
+            if value:
+                business = json.loads(value)
+        except Exception as e:
+            log.warning("Business cache unavailable: %s" % e)
+
+        if business is None:
+
+            business = self.load(user_cloud_id)
+            ttl = self.ttl if business["id"] is not None else self.missing_ttl
+
+            try:
+                self.client.set(self.redis_key(user_cloud_id), json.dumps(business), ex=ttl)
+            except Exception as e:
+                log.warning("Business cache unavailable: %s" % e)
+
+        self._remember(user_cloud_id, business, now)
+
+        return dict(business)
+
+    def invalidate(self, user_cloud_id):
+
+        with self.lock:
+            self.local.pop(user_cloud_id, None)
+
+        try:
+            self.client.delete(self.redis_key(user_cloud_id))
+        except Exception as e:
+            log.warning("Business cache unavailable: %s" % e)
+
+    def resume_token(self):
+        """Token of the last change handled by watch(), None to start from now."""
+
+        try:
+            value = self.client.get("%s%s" % (settings.ENV, self.RESUME_TOKEN_KEY))
+        except Exception as e:
+            log.warning("Business cache unavailable: %s" % e)
+            return None
+
+        return json_util.loads(value) if value else None
+
+    def save_resume_token(self, token):
+
+        try:
+            if token is None:
+                self.client.delete("%s%s" % (settings.ENV, self.RESUME_TOKEN_KEY))
+            else:
+                self.client.set("%s%s" % (settings.ENV, self.RESUME_TOKEN_KEY), json_util.dumps(token))
+        except Exception as e:
+            log.warning("Business cache unavailable: %s" % e)
+
+    def ensure_index(self):
+        return self.businesses().create_index(INDEX_KEYS, name=INDEX_NAME, background=True)
+
+    def explain(self, user_cloud_id):
+        """
+        Query plan of the lookup. covered is True when the winning plan reads
+        the index only, without a FETCH stage or documents examined.
+        """
+
+        plan = self.businesses().find(
+            {"user_cloud_id" : user_cloud_id, "is_active" : True}, PROJECTION
+        ).limit(1).explain()
+
+        stages = []
+        stage = plan.get("queryPlanner", {}).get("winningPlan", {})
+        stage = stage.get("queryPlan", stage)
+
+        while stage:
+            stages.append(stage.get("stage"))
+            stage = stage.get("inputStage")
+
+        stats = plan.get("executionStats", {})
+
+        return {
+            "stages" : stages,
+            "covered" : "IXSCAN" in stages and "FETCH" not in stages and not stats.get("totalDocsExamined"),
+            "plan" : plan
+        }
+
+    def watch(self, resume_after=None):
+        """
+        Follows the businesses change stream (replica sets only) and drops
+        the cached entry of every business written. Deletes carry no
+        document, their entries run out with the TTLs. Yields each resume
+        token so the caller can persist it.
+        """
+
+        with self.businesses().watch(
+            [{"$match" : {"operationType" : {"$in" : ["insert", "update", "replace"]}}}],
+            full_document="updateLookup",
+            resume_after=resume_after
+        ) as stream:
+
+            for change in stream:
+
+                user_cloud_id = (change.get("fullDocument") or {}).get("user_cloud_id")
+
+                if user_cloud_id:
+                    self.invalidate(user_cloud_id)
+
+                yield change["_id"]
+
+
+businesses = BusinessResolver()
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.checks import Error, register
+from core import outbox
+
+
+@register()
+def outbox_lease_check(app_configs, **kwargs):
+    """An event is leased again for each delivery, the lease must outlast one."""
+
+    lease = getattr(settings, "OUTBOX_LEASE_SECONDS", outbox.DEFAULT_LEASE_SECONDS)
+    delivery = getattr(settings, "OUTBOX_DELIVERY_SECONDS", outbox.DEFAULT_DELIVERY_SECONDS)
+
+    if lease <= delivery:
+        return [Error(
+            "OUTBOX_LEASE_SECONDS (%s) must be longer than OUTBOX_DELIVERY_SECONDS (%s)" % (lease, delivery),
+            hint="A delivery outliving its lease can be claimed and sent again by another worker.",
+            id="core.E001",
+        )]
+
+    return []
@@ -1,5 +1,9 @@
 from functools import wraps
-from core.models import RequestLog
+from core.request_log import request_log_writer
+from core.payload import get_payload
+from core.redis_ops import render_json
+from core.fanout import run_async
+from django.http import JsonResponse
 from rest_framework.response import Response
 import jsonfield
 import traceback
@@ -23,19 +27,14 @@ def log_request_response(view_func):
             
             response_data = response.data if isinstance(response, Response) else {}
 
-            log_entry = RequestLog.objects.create(
+            log_id = request_log_writer.submit(
                 user=request.user,
                 request_data=request_data,
-                response_data=response_data
+                response_data=dict(response_data)
             )
 
             if isinstance(response, Response):
-                
-                auth_id = str(log_entry.id).zfill(6)
-                if len(auth_id) > 6:
-                    auth_id = auth_id[1:]
-                    
-                response.data["authIdResponse"] = auth_id
+                response.data["authIdResponse"] = auth_id_response(log_id)
 
             return response
         
@@ -46,4 +45,47 @@ def log_request_response(view_func):
                 "responseCode": "099"
             }, status=500)
     
-    return _wrapped_view
\ No newline at end of file
+    return _wrapped_view
+
+
+def auth_id_response(log_id):
+    auth_id = str(log_id).zfill(6)
+    if len(auth_id) > 6:
+        auth_id = auth_id[1:]
+    return auth_id
+
+
+def log_request_response_async(view_func):
+    """
+    log_request_response for async handlers of core.views.AsyncAPIView,
+    whose responses carry their data as response.data.
+    """
+
+    @wraps(view_func)
+    async def _wrapped_view(self, request, *args, **kwargs):
+        
+        request_data = get_payload(request).data
+        
+        try:
+            response = await view_func(self, request, *args, **kwargs)
+            
+            response_data = getattr(response, "data", None) or {}
+
+            log_id = await run_async(
+                request_log_writer.submit, request.user, request_data, dict(response_data)
+            )
+
+            if hasattr(response, "data"):
+                response.data["authIdResponse"] = auth_id_response(log_id)
+                response.content = render_json(response.data)
+
+            return response
+        
+        except Exception as e:
+            log.exception(traceback.format_exc())
+            return JsonResponse({
+                "responseDescription": "SYSTEM EXCEPTION",
+                "responseCode": "099"
+            }, status=500)
+    
+    return _wrapped_view
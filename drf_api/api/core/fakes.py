@@ -0,0 +1,171 @@
+from unittest import mock
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the redis commands used across the apps, for
+    tests. Expiry is recorded, not enforced. Lua scripts are mocks, tests
+    give them a side_effect when the script's outcome matters. Published
+    messages are kept in published.
+    """
+
+    def __init__(self, decode_responses=False):
+        self.decode_responses = decode_responses
+        self.values = {}
+        self.expiry = {}
+        self.scripts = {}
+        self.published = []
+
+    def __bool__(self):
+        return True
+
+    def encode(self, value):
+
+        if self.decode_responses:
+            return value.decode() if isinstance(value, bytes) else str(value)
+
+        if isinstance(value, bytes):
+            return value
+
+        return str(value).encode()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, ex=None, px=None):
+
+        if nx and key in self.values:
+            return None
+
+        self.values[key] = self.encode(value)
+        self.expiry[key] = ex if px is None else px / 1000.0
+
+        return True
+
+    def exists(self, key):
+        return int(key in self.values)
+
+    def delete(self, *keys):
+
+        deleted = 0
+
+        for key in keys:
+            deleted += key in self.values
+            self.values.pop(key, None)
+            self.expiry.pop(key, None)
+
+        return deleted
+
+    def incr(self, key, amount=1):
+        value = int(self.values.get(key, 0)) + amount
+        self.values[key] = self.encode(value)
+        return value
+
+    def decr(self, key, amount=1):
+        return self.incr(key, -amount)
+
+    def expire(self, key, seconds):
+        self.expiry[key] = seconds
+
+    def pexpire(self, key, milliseconds):
+        self.expiry[key] = milliseconds / 1000.0
+
+    def expireat(self, key, when):
+        self.expiry[key] = when
+
+    def hset(self, key, field=None, value=None, mapping=None):
+
+        values = self.values.setdefault(key, {})
+        mapping = dict(mapping or {})
+
+        if field is not None:
+            mapping[field] = value
+
+        values.update({name: self.encode(value) for name, value in mapping.items()})
+
+        return len(mapping)
+
+    def hget(self, key, field):
+        return self.values.get(key, {}).get(field)
+
+    def hmget(self, key, *fields):
+
+        if len(fields) == 1 and isinstance(fields[0], (list, tuple)):
+            fields = fields[0]
+
+        values = self.values.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def hgetall(self, key):
+        return {self.encode(field) : value for field, value in self.values.get(key, {}).items()}
+
+    def zadd(self, key, mapping):
+        scores = self.values.setdefault(key, {})
+        added = len(set(mapping) - set(scores))
+        scores.update(mapping)
+        return added
+
+    def zrange(self, key, start, end):
+        members = sorted(self.values.get(key, {}).items(), key=lambda item: item[1])
+        members = [self.encode(member) for member, score in members]
+        return members[start:] if end == -1 else members[start:end + 1]
+
+    def zremrangebyscore(self, key, low, high):
+
+        scores = self.values.get(key, {})
+        low = float(low)
+        high = float(high)
+        removed = [member for member, score in scores.items() if low <= score <= high]
+
+        for member in removed:
+            del scores[member]
+
+        return len(removed)
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        return 0
+
+    def register_script(self, script):
+        return self.scripts.setdefault(script, mock.Mock(return_value=None))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """Queues commands and runs them against the FakeRedis on execute()."""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+
+        command = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class DownRedis:
+    """Redis that can't be reached, every command raises ConnectionError."""
+
+    def __bool__(self):
+        return True
+
+    def __getattr__(self, name):
+        raise ConnectionError("redis down")
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+
+DEFAULT_WORKERS = 8
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    """Process wide pool of WALLET_FANOUT_WORKERS threads, None when fan-out is off."""
+
+    global _executor, _executor_pid
+
+    workers = getattr(settings, "WALLET_FANOUT_WORKERS", DEFAULT_WORKERS)
+
+    if not workers:
+        return None
+
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+                _executor_pid = os.getpid()
+
+    return _executor
+
+
+def _recycle_connections():
+    """
+    Pool threads get no request_finished, so the request's connection
+    handling is applied after each task instead: a connection errored or
+    left outside autocommit is closed, and so is one past CONN_MAX_AGE,
+    which with the default of 0 is every connection. Only CONN_MAX_AGE
+    None or > 0 keeps a connection from task to task.
+    """
+
+    for conn in connections.all():
+
+        if conn.connection is not None:
+            conn.close_if_unusable_or_obsolete()
+
+
+def _run(fn, args):
+    try:
+        return fn(*args)
+    finally:
+        _recycle_connections()
+
+
+def submit(fn, *args):
+    """
+    Starts fn(*args) on the pool and returns a callable that waits for the
+    result. Runs fn inline when fan-out is off.
+    """
+
+    pool = executor()
+
+    if pool is None:
+        result = fn(*args)
+        return lambda: result
+
+    return pool.submit(_run, fn, args).result
+
+
+def gather(*calls):
+    """
+    Results of independent (fn, *args) calls run concurrently, in order.
+    The first call runs on the calling thread.
+    """
+
+    if not calls:
+        return []
+
+    pending = [submit(*call) for call in calls[1:]]
+    first = calls[0][0](*calls[0][1:])
+
+    return [first] + [wait() for wait in pending]
+
+
+async def run_async(fn, *args):
+    """
+    Awaits fn(*args) run on the pool, for blocking calls (ORM, sync redis)
+    made by async views. Unlike sync_to_async the calls do not queue behind
+    a single thread. With fan-out off the loop's default executor is used.
+    """
+
+    pool = executor()
+
+    if pool is None:
+        return await asyncio.get_running_loop().run_in_executor(None, _run, fn, args)
+
+    return await asyncio.wrap_future(pool.submit(_run, fn, args))
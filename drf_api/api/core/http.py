@@ -0,0 +1,246 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from core.metrics import PARTNER_HTTP_BUDGET_EXHAUSTED, PARTNER_HTTP_SECONDS, PARTNER_HTTP_RETRIES
+
+log = logging.getLogger("django")
+
+DEFAULT_CONNECT_TIMEOUT = 3.0
+DEFAULT_READ_TIMEOUT = 10.0
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.2
+DEFAULT_POOL_MAXSIZE = 20
+
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+_deadline = ContextVar("partner_call_deadline", default=None)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class DeadlineExceeded(requests.Timeout):
+    """The call's budget ran out before (another) attempt could start."""
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Budget for the partner calls made inside the block, in seconds. Nested
+    blocks can only shorten the budget of the enclosing one.
+    """
+
+    expires_at = time.monotonic() + seconds
+    current = _deadline.get()
+
+    if current is not None:
+        expires_at = min(expires_at, current)
+
+    token = _deadline.set(expires_at)
+
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left of the current budget, None outside a deadline() block."""
+
+    expires_at = _deadline.get()
+
+    if expires_at is None:
+        return None
+
+    return expires_at - time.monotonic()
+
+
+def timeouts(limit=None):
+    """
+    (connect, read) timeouts of the next attempt, cut to the caller's own
+    timeout (a number or a (connect, read) pair) and the remaining budget.
+    """
+
+    connect = _setting("PARTNER_HTTP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)
+    read = _setting("PARTNER_HTTP_READ_TIMEOUT", DEFAULT_READ_TIMEOUT)
+
+    if limit is not None:
+        limit_connect, limit_read = limit if isinstance(limit, tuple) else (limit, limit)
+        connect = connect if limit_connect is None else min(connect, limit_connect)
+        read = read if limit_read is None else min(read, limit_read)
+
+    left = remaining()
+
+    if left is None:
+        return connect, read
+
+    if left <= 0:
+        raise DeadlineExceeded("Partner call budget exhausted")
+
+    return min(connect, left), min(read, left)
+
+
+class PartnerSessions:
+    """
+    One keep-alive requests.Session per partner (scheme, host), so calls to
+    a partner reuse pooled TCP/TLS connections. Sessions are rebuilt in a
+    forked worker, pools must not be shared across processes.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def build(self):
+
+        session = requests.Session()
+
+        # retries are done by request(), within the caller's budget
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=_setting("PARTNER_HTTP_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE),
+            max_retries=0
+        )
+
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        return session
+
+    def get(self, url):
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+
+        with self.lock:
+
+            if self.pid != os.getpid():
+                self.sessions = {}
+                self.pid = os.getpid()
+
+            session = self.sessions.get(key)
+
+            if session is None:
+                session = self.sessions[key] = self.build()
+
+        return session
+
+    def close(self):
+
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+sessions = PartnerSessions()
+
+
+def request(method, url, retry=None, **kwargs):
+    """
+    Partner call on the pooled session of its host, with timeouts cut to
+    the current deadline() budget and up to PARTNER_HTTP_RETRIES retries
+    while budget is left. Connect timeouts are always retried, other
+    connection errors, read timeouts and 502/503/504 responses only for
+    idempotent methods unless retry is passed. Raises DeadlineExceeded
+    when the budget runs out.
+    """
+
+    limit = kwargs.pop("timeout", None)
+
+    method = method.upper()
+    host = urlsplit(url).netloc
+    retry = method in IDEMPOTENT_METHODS if retry is None else retry
+    retries = _setting("PARTNER_HTTP_RETRIES", DEFAULT_RETRIES)
+    backoff = _setting("PARTNER_HTTP_RETRY_BACKOFF", DEFAULT_RETRY_BACKOFF)
+    session = sessions.get(url)
+    attempt = 0
+
+    while True:
+
+        try:
+            kwargs["timeout"] = timeouts(limit)
+        except DeadlineExceeded:
+            PARTNER_HTTP_BUDGET_EXHAUSTED.labels(host).inc()
+            raise
+
+        started = time.monotonic()
+        reason = None
+
+        try:
+            response = session.request(method, url, **kwargs)
+
+        except requests.ConnectTimeout as e:
+            PARTNER_HTTP_SECONDS.labels(host, method, "connect_timeout").observe(time.monotonic() - started)
+            # the request never reached the partner
+            reason = "connect"
+            error = e
+
+        except (requests.ConnectionError, requests.Timeout) as e:
+            outcome = "timeout" if isinstance(e, requests.Timeout) else "connection_error"
+            PARTNER_HTTP_SECONDS.labels(host, method, outcome).observe(time.monotonic() - started)
+            reason = outcome if retry else None
+            error = e
+
+        else:
+            PARTNER_HTTP_SECONDS.labels(host, method, str(response.status_code)).observe(time.monotonic() - started)
+
+            if not (retry and response.status_code in RETRY_STATUSES):
+                return response
+
+            reason = "status"
+            error = None
+
+        left = remaining()
+        pause = backoff * 2 ** attempt
+
+        if reason is None or attempt >= retries or (left is not None and left <= pause):
+            if error is not None:
+                raise error
+            return response
+
+        PARTNER_HTTP_RETRIES.labels(host, reason).inc()
+        log.warning("Retrying %s %s after %s" % (method, url, error or response.status_code))
+
+        time.sleep(pause)
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+_plain_request = requests.api.request
+
+
+def _routed_request(method, url, **kwargs):
+    """requests.api.request, through request() inside a deadline() block."""
+
+    if remaining() is None:
+        return _plain_request(method, url, **kwargs)
+
+    return request(method, url, **kwargs)
+
+
+def install():
+    """
+    Routes the requests.get/post/... calls made inside deadline() blocks
+    through the pooled sessions, for callers outside this tree such as
+    record_deposit_to_rnp. Calls on their own Session are not routed.
+    """
+
+    requests.api.request = _routed_request
@@ -0,0 +1,261 @@
+import json
+import logging
+import time
+from functools import wraps
+from django.conf import settings
+from rest_framework.response import Response
+from core.redis_ops import conn
+
+log = logging.getLogger("django")
+
+DEFAULT_TTL = 7 * 24 * 3600
+# a few times the 30s worker timeout, a claim whose worker died is freed after it
+DEFAULT_PENDING_TTL = 120
+DEFAULT_WAIT_MS = 2000
+
+POLL_INTERVAL = 0.02
+
+STATE_PENDING = "pending"
+STATE_DONE = "done"
+
+
+class Claim:
+    """
+    Outcome of IdempotencyStore.claim().
+
+    claimed:
+        this request owns the key and must complete() or release() it.
+    response:
+        stored response of the original request, to be replayed.
+    Neither is set while the original request is still in flight.
+    """
+
+    def __init__(self, claimed=False, response=None):
+        self.claimed = claimed
+        self.response = response
+
+
+class IdempotencyStore:
+    """
+    Exactly-once handling of switch requests, keyed by (rrn, stan,
+    transmission date).
+
+    The first request claims the key with SET NX, a pending marker leased
+    for IDEMPOTENCY_PENDING_TTL so the key frees up if its worker dies.
+    When it finishes its response is stored under the key for
+    IDEMPOTENCY_TTL, so retries get the original result back with a single
+    GET. The unique constraint on Transaction backs this up when redis is
+    unavailable or the key has expired.
+    """
+
+    KEY_PREFIX = "idempotency:"
+
+    def __init__(self, client=None):
+        self.client = client or conn
+
+    @property
+    def ttl(self):
+        return getattr(settings, "IDEMPOTENCY_TTL", DEFAULT_TTL)
+
+    @property
+    def pending_ttl(self):
+        return getattr(settings, "IDEMPOTENCY_PENDING_TTL", DEFAULT_PENDING_TTL)
+
+    def key(self, scope, rrn, stan, transmission_date):
+        """Idempotency key of a request, None when a part is missing."""
+
+        if not rrn or not stan or not transmission_date:
+            return None
+
+        return "%s:%s:%s:%s" % (scope, rrn, stan, transmission_date)
+
+    def redis_key(self, key):
+        return "%s%s%s" % (settings.ENV, self.KEY_PREFIX, key)
+
+    def _read(self, key):
+
+        value = self.client.get(self.redis_key(key))
+
+        if not value:
+            return None
+
+        return json.loads(value)
+
+    def claim(self, key, wait_ms=0):
+        """
+        Claims the key, or returns the stored response. A request arriving
+        while the original is in flight waits up to wait_ms for its result.
+        """
+
+        pending = json.dumps({"state" : STATE_PENDING})
+
+        if self.client.set(self.redis_key(key), pending, nx=True, ex=self.pending_ttl):
+            return Claim(claimed=True)
+
+        deadline = time.monotonic() + wait_ms / 1000.0
+
+        while True:
+
+            entry = self._read(key)
+
+            if entry is None:
+                # expired or released between the SET and the GET
+                if self.client.set(self.redis_key(key), pending, nx=True, ex=self.pending_ttl):
+                    return Claim(claimed=True)
+
+            elif entry.get("state") == STATE_DONE:
+                return Claim(response=entry.get("response"))
+
+            if time.monotonic() >= deadline:
+                return Claim()
+
+            time.sleep(POLL_INTERVAL)
+
+    def complete(self, key, response):
+        self.client.set(
+            self.redis_key(key),
+            json.dumps({"state" : STATE_DONE, "response" : response}, default=str),
+            ex=self.ttl
+        )
+
+    def release(self, key):
+        """Drops the claim so a retry can process the request again."""
+        self.client.delete(self.redis_key(key))
+
+
+idempotency = IdempotencyStore()
+
+
+def release_quietly(key):
+    try:
+        idempotency.release(key)
+    except Exception as e:
+        log.warning("Idempotency store unavailable: %s" % e)
+
+
+def recovered_response(view, key, response):
+    """
+    The view's recover_response(key) in place of a TECHNICAL_PROBLEM
+    response, None for any other response or when nothing was posted.
+    """
+
+    data = response.data if isinstance(response, Response) else None
+
+    if not isinstance(data, dict):
+        return None
+
+    if data.get("responseCode") != view.RESPONSE_CODES.get(view.TECHNICAL_PROBLEM):
+        return None
+
+    if not hasattr(view, "recover_response"):
+        return None
+
+    return view.recover_response(key)
+
+
+def with_auth_id(recovered, data):
+    """Recovered response with the authIdResponse the request was logged under."""
+
+    recovered = dict(recovered)
+
+    if "authIdResponse" in data:
+        recovered["authIdResponse"] = data["authIdResponse"]
+
+    return recovered
+
+
+def idempotent(scope):
+    """
+    Runs a switch view once per (rrn, stan, transmissionDate) and replays
+    its response to retries. Requests still in flight get the view's
+    DUPLICATE_PAYMENT response.
+
+    Responses carrying the view's TECHNICAL_PROBLEM code release the claim,
+    so the switch's retry is processed again. The view's recover_response(key),
+    when defined, rebuilds the response of a request that was already posted
+    (e.g. from the transaction holding the key), also when redis is down and
+    the duplicate only hit the unique constraint. The view reads the key
+    from request.idempotency_key.
+
+    Applied outside log_request_response, so the stored response carries the
+    authIdResponse of the logged request and retries replay it unchanged.
+    Server errors (the logger's SYSTEM EXCEPTION) release the claim too.
+    """
+
+    def decorator(view_func):
+
+        @wraps(view_func)
+        def _wrapped_view(self, request, *args, **kwargs):
+
+            key = idempotency.key(
+                scope,
+                request.data.get("rrn"),
+                request.data.get("stan"),
+                request.data.get("transmissionDate")
+            )
+
+            request.idempotency_key = key
+
+            if key is None:
+                return view_func(self, request, *args, **kwargs)
+
+            try:
+                claim = idempotency.claim(key, getattr(settings, "IDEMPOTENCY_WAIT_MS", DEFAULT_WAIT_MS))
+            except Exception as e:
+                # the unique constraint on the transaction still holds
+                log.warning("Idempotency store unavailable: %s" % e)
+
+                response = view_func(self, request, *args, **kwargs)
+                recovered = recovered_response(self, key, response)
+
+                if recovered is not None:
+                    return Response(with_auth_id(recovered, response.data), status=200)
+
+                return response
+
+            if claim.response is not None:
+                return Response(claim.response, status=200)
+
+            if not claim.claimed:
+                return Response({
+                    "responseDescription" : self.DUPLICATE_PAYMENT,
+                    "responseCode" : self.RESPONSE_CODES.get(self.DUPLICATE_PAYMENT)
+                })
+
+            try:
+                response = view_func(self, request, *args, **kwargs)
+            except Exception:
+                release_quietly(key)
+                raise
+
+            if not isinstance(response, Response):
+                release_quietly(key)
+                return response
+
+            if response.status_code >= 500:
+                release_quietly(key)
+                return response
+
+            data = dict(response.data or {})
+
+            if data.get("responseCode") == self.RESPONSE_CODES.get(self.TECHNICAL_PROBLEM):
+
+                recovered = recovered_response(self, key, response)
+
+                if recovered is None:
+                    release_quietly(key)
+                    return response
+
+                data = with_auth_id(recovered, data)
+                response = Response(data, status=200)
+
+            try:
+                idempotency.complete(key, data)
+            except Exception as e:
+                log.warning("Idempotency store unavailable: %s" % e)
+
+            return response
+
+        return _wrapped_view
+
+    return decorator
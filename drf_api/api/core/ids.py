@@ -0,0 +1,79 @@
+import os
+import threading
+from django.conf import settings
+from django.db import connections, router
+
+DEFAULT_BLOCK_SIZE = 100
+
+
+class BlockIdAllocator:
+    """
+    Hands out primary keys for a model from blocks reserved on the table's
+    postgres sequence, one round trip per block.
+
+    Ids are known before the row is inserted, so values derived from them
+    (references, auth ids) go into the INSERT itself and rows can be bulk
+    inserted with their final ids. Blocks are per process, a forked child
+    drops the parent's block. Gaps are expected when a process exits.
+    """
+
+    def __init__(self, model, block_size=None):
+        self.model = model
+        self.block_size = block_size or getattr(settings, "ID_BLOCK_SIZE", DEFAULT_BLOCK_SIZE)
+        self.ids = []
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    @property
+    def connection(self):
+        return connections[router.db_for_write(self.model)]
+
+    def supported(self):
+        return self.connection.vendor == "postgresql"
+
+    def reserve(self):
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                [self.model._meta.db_table, self.model._meta.pk.column, self.block_size]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def next_id(self):
+        """Next reserved id, None when the database has no sequence to reserve from."""
+
+        if not self.supported():
+            return None
+
+        with self.lock:
+
+            if self.pid != os.getpid():
+                self.ids = []
+                self.pid = os.getpid()
+
+            if not self.ids:
+                self.ids = self.reserve()
+                self.ids.reverse()
+
+            return self.ids.pop()
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def id_allocator(model):
+    """Process wide allocator of a model, ID_BLOCK_SIZES overrides the block size."""
+
+    allocator = _allocators.get(model)
+
+    if allocator is None:
+        with _allocators_lock:
+            allocator = _allocators.get(model)
+            if allocator is None:
+                block_size = getattr(settings, "ID_BLOCK_SIZES", {}).get(model._meta.label)
+                allocator = BlockIdAllocator(model, block_size)
+                _allocators[model] = allocator
+
+    return allocator
@@ -0,0 +1,276 @@
+import abc
+import logging
+import secrets
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django_pglocks import advisory_lock
+from core.redis_ops import conn
+
+log = logging.getLogger("django")
+
+ADVISORY = "advisory"
+REDIS = "redis"
+
+DEFAULT_LEASE_MS = 30000
+
+REJECTED_BUSY = "busy"
+REJECTED_QUEUE_FULL = "queue_full"
+REJECTED_TIMEOUT = "timeout"
+REJECTED_UNAVAILABLE = "unavailable"
+
+POLL_INTERVAL_MIN = 0.005
+POLL_INTERVAL_MAX = 0.025
+
+
+class LockUnavailable(Exception):
+    """The backend could not be reached, the lock state is unknown."""
+
+
+class Lease:
+    """
+    A held per-key lock. token identifies the holder to the backend on
+    release, None for backends without one.
+    """
+
+    def __init__(self, key, token=None):
+        self.key = key
+        self.token = token
+
+
+class LockAttempt:
+    """
+    Outcome of LockBackend.lock(). lease is None when the lock was not
+    acquired, rejected_reason then says why. waited is in seconds.
+    """
+
+    def __init__(self, lease=None, waited=0.0, rejected_reason=None):
+        self.lease = lease
+        self.waited = waited
+        self.rejected_reason = rejected_reason
+
+
+class WaiterQueue:
+    """
+    Bounded count of requests waiting on a key, shared by every worker
+    through a redis counter that expires with the longest possible wait.
+    """
+
+    KEY_PREFIX = "sync_lock_waiters:"
+
+    def __init__(self, client=None):
+        self.client = client or conn
+
+    def redis_key(self, key):
+        return "%s%s%s" % (settings.ENV, self.KEY_PREFIX, key)
+
+    def enter(self, key, max_waiters, wait_ms):
+
+        redis_key = self.redis_key(key)
+
+        try:
+            pipe = self.client.pipeline()
+            pipe.incr(redis_key)
+            pipe.pexpire(redis_key, int(wait_ms) + 1000)
+            waiters = pipe.execute()[0]
+        except Exception as e:
+            log.warning("Sync lock waiter queue unavailable: %s" % e)
+            return False
+
+        if max_waiters is not None and waiters > max_waiters:
+            self.leave(key)
+            return False
+
+        return True
+
+    def leave(self, key):
+        try:
+            self.client.decr(self.redis_key(key))
+        except Exception as e:
+            log.warning("Sync lock waiter queue unavailable: %s" % e)
+
+
+class LockBackend(abc.ABC):
+    """
+    Per-key mutual exclusion used by SyncLockMiddleware.
+
+    lock() is a context manager yielding a LockAttempt. With wait_ms the
+    caller queues behind the current holder for at most wait_ms, and at
+    most max_waiters callers queue on the same key at once.
+    """
+
+    name = None
+
+    waiters = None
+
+    @abc.abstractmethod
+    def try_acquire(self, key):
+        """
+        Lease of key when it is free, None otherwise, never waits. Raises
+        LockUnavailable when the backend can't be reached.
+        """
+
+    @abc.abstractmethod
+    def release(self, lease):
+        """Releases a lease returned by try_acquire."""
+
+    def acquire(self, key, wait_ms=0, max_waiters=None):
+
+        lease = self.try_acquire(key)
+
+        if lease is not None:
+            return LockAttempt(lease)
+
+        if not wait_ms:
+            return LockAttempt(rejected_reason=REJECTED_BUSY)
+
+        if self.waiters is None:
+            self.waiters = WaiterQueue()
+
+        if not self.waiters.enter(key, max_waiters, wait_ms):
+            return LockAttempt(rejected_reason=REJECTED_QUEUE_FULL)
+
+        started = time.monotonic()
+        deadline = started + wait_ms / 1000.0
+        interval = POLL_INTERVAL_MIN
+
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    return LockAttempt(
+                        waited=time.monotonic() - started,
+                        rejected_reason=REJECTED_TIMEOUT
+                    )
+
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+                lease = self.try_acquire(key)
+
+                if lease is not None:
+                    return LockAttempt(lease, waited=time.monotonic() - started)
+        finally:
+            self.waiters.leave(key)
+
+    @contextmanager
+    def lock(self, key, wait_ms=0, max_waiters=None):
+
+        attempt = self.acquire(key, wait_ms, max_waiters)
+
+        try:
+            yield attempt
+        finally:
+            if attempt.lease is not None:
+                self.release(attempt.lease)
+
+
+class AdvisoryLockBackend(LockBackend):
+    """
+    Session level postgres advisory lock. Holds a database connection for as
+    long as the lock is held and needs session pooling.
+    """
+
+    name = ADVISORY
+
+    def try_acquire(self, key):
+
+        handle = advisory_lock(lock_id=key, wait=False)
+
+        if handle.__enter__():
+            lease = Lease(key)
+            lease.handle = handle
+            return lease
+
+        handle.__exit__(None, None, None)
+        return None
+
+    def release(self, lease):
+        lease.handle.__exit__(None, None, None)
+
+
+class RedisLeaseLockBackend(LockBackend):
+    """
+    SET NX PX lease in redis. The lease expires on its own if the worker dies,
+    and release only deletes the key when it still holds our random token.
+    """
+
+    name = REDIS
+
+    KEY_PREFIX = "sync_lock:"
+
+    RELEASE_SCRIPT = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, client=None, lease_ms=None):
+        self.client = client or conn
+        self.lease_ms = lease_ms or getattr(settings, "SYNC_LOCK_LEASE_MS", DEFAULT_LEASE_MS)
+        self._release = self.client.register_script(self.RELEASE_SCRIPT)
+
+    def redis_key(self, key):
+        return "%s%s%s" % (settings.ENV, self.KEY_PREFIX, key)
+
+    def try_acquire(self, key):
+
+        token = secrets.token_hex(8)
+
+        try:
+            acquired = self.client.set(self.redis_key(key), token, nx=True, px=self.lease_ms)
+        except Exception as e:
+            raise LockUnavailable("Redis lease lock unavailable: %s" % e) from e
+
+        if acquired:
+            return Lease(key, token)
+
+        return None
+
+    def release(self, lease):
+        try:
+            released = self._release(keys=[self.redis_key(lease.key)], args=[lease.token])
+        except Exception as e:
+            log.exception(e)
+            return
+
+        if not released:
+            log.warning("Sync lock lease on %s expired before release" % lease.key)
+
+
+LOCK_BACKENDS = {
+    ADVISORY : AdvisoryLockBackend,
+    REDIS : RedisLeaseLockBackend,
+}
+
+_backends = {}
+
+
+def fallback_backend_name(name):
+    """
+    Backend to use while the named one is unavailable, from
+    settings.SYNC_LOCK_FALLBACK_BACKEND, None to reject the request.
+    """
+
+    fallback = getattr(settings, "SYNC_LOCK_FALLBACK_BACKEND", ADVISORY)
+
+    if fallback == name:
+        return None
+
+    return fallback
+
+
+def get_lock_backend(name=None):
+    """Backend instance by name, settings.SYNC_LOCK_BACKEND when name is None."""
+
+    name = name or getattr(settings, "SYNC_LOCK_BACKEND", ADVISORY)
+
+    backend = _backends.get(name)
+
+    if backend is None:
+        backend = LOCK_BACKENDS[name]()
+        _backends[name] = backend
+
+    return backend
@@ -0,0 +1,83 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from pymongo.errors import OperationFailure
+from core.businesses import businesses
+
+# the resume token has left the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class Command(BaseCommand):
+    """
+    Maintenance of the udhaar business lookup cache (core.businesses).
+
+        --ensure-index         create the covering index of the lookup
+        --explain PHONE        print the lookup's plan, fails unless covered
+        --watch                drop cached entries as businesses change,
+                               runs until stopped (replica sets only), a
+                               restart resumes after the last change handled
+        --invalidate PHONE     drop the cached entry of one merchant
+    """
+
+    help = "Maintains the merchant to udhaar business lookup cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ensure-index", action="store_true")
+        parser.add_argument("--explain", metavar="PHONE")
+        parser.add_argument("--watch", action="store_true")
+        parser.add_argument("--invalidate", metavar="PHONE", action="append")
+
+    def handle(self, *args, **options):
+
+        if not (options["ensure_index"] or options["explain"] or options["watch"] or options["invalidate"]):
+            raise CommandError("Nothing to do, pass --ensure-index, --explain, --watch or --invalidate")
+
+        if options["ensure_index"]:
+            self.stdout.write("Index %s ready" % businesses.ensure_index())
+
+        if options["explain"]:
+            self.explain(options["explain"], options["verbosity"] > 1)
+
+        for phone_number in options["invalidate"] or []:
+            businesses.invalidate(phone_number)
+            self.stdout.write("Dropped %s" % phone_number)
+
+        if options["watch"]:
+            self.watch()
+
+    def watch(self):
+
+        resume_after = businesses.resume_token()
+
+        while True:
+
+            self.stdout.write("Watching businesses%s" % (" from the last change" if resume_after else ""))
+
+            try:
+                for token in businesses.watch(resume_after):
+                    businesses.save_resume_token(token)
+                return
+
+            except OperationFailure as e:
+
+                if resume_after is None or e.code != CHANGE_STREAM_HISTORY_LOST:
+                    raise
+
+                # changes since are missed, their entries run out with the TTLs
+                self.stderr.write("Resume token expired, watching from now: %s" % e)
+                businesses.save_resume_token(None)
+                resume_after = None
+
+    def explain(self, phone_number, verbose=False):
+
+        result = businesses.explain(phone_number)
+
+        self.stdout.write(" <- ".join(stage for stage in result["stages"] if stage))
+
+        if verbose:
+            self.stdout.write(json.dumps(result["plan"], default=str, indent=2))
+
+        if not result["covered"]:
+            raise CommandError("The business lookup is not covered by an index, run --ensure-index")
+
+        self.stdout.write("Covered by the index")
@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from core.outbox import dispatch
+
+
+class Command(BaseCommand):
+    """
+    Delivers outbox events (core.outbox). Any number of workers can run side
+    by side, each claims its own batches. With --once it drains the due
+    events and exits, for cron.
+    """
+
+    help = "Delivers pending outbox events"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None)
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds to sleep when idle")
+        parser.add_argument("--once", action="store_true")
+
+    def handle(self, *args, **options):
+
+        while True:
+
+            close_old_connections()
+            delivered, failed = dispatch(options["batch_size"])
+
+            if delivered or failed:
+                self.stdout.write("Delivered %s, failed %s" % (delivered, failed))
+                continue
+
+            if options["once"]:
+                return
+
+            time.sleep(options["interval"])
@@ -0,0 +1,331 @@
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from core.models import RequestLog
+
+TABLE = RequestLog._meta.db_table
+
+LEGACY_PARTITION = "%s_legacy" % TABLE
+DEFAULT_PARTITION = "%s_default" % TABLE
+
+PARTITION_NAME = re.compile(r"^%s_p(\d{6}|\d{8})$" % TABLE)
+
+UPPER_BOUND = re.compile(r"TO \('(\d{4}-\d{2}-\d{2})")
+
+ARCHIVE_COLUMNS = ("id", "user_id", "request_data", "response_data", "created_at")
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(day):
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def partition_range(day, interval):
+    """(start, end, name) of the partition holding day."""
+
+    if interval == "day":
+        return day, day + timedelta(days=1), "%s_p%s" % (TABLE, day.strftime("%Y%m%d"))
+
+    start = month_start(day)
+    return start, next_month(start), "%s_p%s" % (TABLE, start.strftime("%Y%m"))
+
+
+def partition_end(name):
+    """Exclusive upper bound of a partition from its name, None for other tables."""
+
+    match = PARTITION_NAME.match(name)
+
+    if not match:
+        return None
+
+    stamp = match.group(1)
+
+    if len(stamp) == 8:
+        return datetime.strptime(stamp, "%Y%m%d").date() + timedelta(days=1)
+
+    return next_month(datetime.strptime(stamp, "%Y%m").date())
+
+
+def decode_json(value):
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value
+
+
+class Command(BaseCommand):
+    """
+    Monthly (or daily) range partitioning of core_requestlog on created_at.
+
+        --setup        one-off: turn the existing table into the legacy partition
+                       of a new partitioned core_requestlog
+        --ensure N     create partitions for the current and the next N periods
+        --prune        archive partitions older than the retention to gzipped
+                       NDJSON and drop them, rows of the legacy/default partitions
+                       (or of an unpartitioned table) are archived and deleted in chunks
+
+    Run --ensure and --prune daily from cron.
+    """
+
+    help = "Creates, archives and drops RequestLog partitions"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--setup", action="store_true")
+        parser.add_argument("--ensure", type=int, default=None, metavar="PERIODS")
+        parser.add_argument("--prune", action="store_true")
+        parser.add_argument("--interval", choices=["month", "day"], default="month")
+        parser.add_argument(
+            "--keep-months", type=int,
+            default=getattr(settings, "REQUEST_LOG_RETENTION_MONTHS", 6)
+        )
+        parser.add_argument(
+            "--archive-dir",
+            default=getattr(settings, "REQUEST_LOG_ARCHIVE_DIR", None)
+        )
+        parser.add_argument("--no-archive", action="store_true")
+        parser.add_argument("--chunk-size", type=int, default=5000)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+
+        if not (options["setup"] or options["prune"] or options["ensure"] is not None):
+            raise CommandError("Nothing to do, pass --setup, --ensure or --prune")
+
+        if options["prune"] and not options["no_archive"] and not options["archive_dir"]:
+            raise CommandError("--prune needs --archive-dir (or --no-archive)")
+
+        self.options = options
+        partitioned = connection.vendor == "postgresql"
+
+        if (options["setup"] or options["ensure"] is not None) and not partitioned:
+            raise CommandError("Partitioning needs postgresql")
+
+        if options["setup"]:
+            self.setup()
+
+        if options["ensure"] is not None:
+            self.ensure(options["ensure"])
+
+        if options["prune"]:
+            self.prune(partitioned)
+
+    def execute_sql(self, sql, params=None):
+
+        self.stdout.write(sql)
+
+        if self.options["dry_run"]:
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def is_partitioned(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+                "WHERE c.relname = %s", [TABLE]
+            )
+            return cursor.fetchone() is not None
+
+    def partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = %s ORDER BY c.relname", [TABLE]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def setup(self):
+
+        if self.is_partitioned():
+            self.stdout.write("%s is already partitioned" % TABLE)
+            return
+
+        today = timezone.now().date()
+        _, boundary, _ = partition_range(today, self.options["interval"])
+
+        primary_key = self.primary_key_name()
+
+        with transaction.atomic():
+            self.execute_sql("ALTER TABLE %s RENAME TO %s" % (TABLE, LEGACY_PARTITION))
+            # a partition needs the parent's (id, created_at) key, and the old
+            # constraint would take the parent's core_requestlog_pkey name
+            self.execute_sql("ALTER TABLE %s DROP CONSTRAINT %s" % (LEGACY_PARTITION, primary_key))
+            self.execute_sql("ALTER TABLE %s ADD PRIMARY KEY (id, created_at)" % LEGACY_PARTITION)
+            self.execute_sql(
+                "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+                % (TABLE, LEGACY_PARTITION)
+            )
+            self.execute_sql("ALTER TABLE %s ADD PRIMARY KEY (id, created_at)" % TABLE)
+            self.execute_sql(
+                "ALTER TABLE %s ADD FOREIGN KEY (user_id) REFERENCES auth_user (id) "
+                "DEFERRABLE INITIALLY DEFERRED" % TABLE
+            )
+            self.execute_sql("ALTER SEQUENCE %s_id_seq OWNED BY %s.id" % (TABLE, TABLE))
+            self.execute_sql(
+                "ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO ('%s')"
+                % (TABLE, LEGACY_PARTITION, boundary.isoformat())
+            )
+            self.execute_sql("CREATE INDEX core_reqlog_created_idx_p ON %s (created_at)" % TABLE)
+            self.execute_sql("CREATE INDEX core_reqlog_id_idx_p ON %s (id)" % TABLE)
+            self.execute_sql(
+                "CREATE INDEX core_reqlog_user_created_idx_p ON %s (user_id, created_at)" % TABLE
+            )
+            self.execute_sql("CREATE TABLE %s PARTITION OF %s DEFAULT" % (DEFAULT_PARTITION, TABLE))
+
+    def primary_key_name(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'",
+                [TABLE]
+            )
+            return cursor.fetchone()[0]
+
+    def legacy_bound(self):
+        """Upper bound of the legacy partition, None without one."""
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_class c WHERE c.relname = %s",
+                [LEGACY_PARTITION]
+            )
+            row = cursor.fetchone()
+
+        match = UPPER_BOUND.search(row[0] or "") if row else None
+
+        if not match:
+            return None
+
+        return datetime.strptime(match.group(1), "%Y-%m-%d").date()
+
+    def ensure(self, periods):
+
+        day = timezone.now().date()
+        legacy_bound = self.legacy_bound()
+
+        for _ in range(periods + 1):
+
+            start, end, name = partition_range(day, self.options["interval"])
+            day = end
+
+            # the legacy partition already holds everything below its bound
+            if legacy_bound is not None:
+
+                if end <= legacy_bound:
+                    continue
+
+                start = max(start, legacy_bound)
+
+            self.execute_sql(
+                "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')"
+                % (name, TABLE, start.isoformat(), end.isoformat())
+            )
+
+    def cutoff(self):
+        today = month_start(timezone.now().date())
+        for _ in range(self.options["keep_months"]):
+            today = month_start(today - timedelta(days=1))
+        return today
+
+    def archive_path(self, name):
+        stamp = timezone.now().strftime("%Y%m%d%H%M%S")
+        return os.path.join(self.options["archive_dir"], "%s.%s.ndjson.gz" % (name, stamp))
+
+    def archive(self, name, sql, params=None):
+        """Streams the rows selected by sql to gzipped NDJSON, returns the row count."""
+
+        if self.options["no_archive"] or self.options["dry_run"]:
+            return 0
+
+        os.makedirs(self.options["archive_dir"], exist_ok=True)
+        path = self.archive_path(name)
+        count = 0
+
+        with gzip.open(path, "wt") as archive, connection.chunked_cursor() as cursor:
+
+            cursor.execute(sql, params)
+
+            while True:
+                rows = cursor.fetchmany(self.options["chunk_size"])
+
+                if not rows:
+                    break
+
+                for row in rows:
+                    record = dict(zip(ARCHIVE_COLUMNS, row))
+                    record["request_data"] = decode_json(record["request_data"])
+                    record["response_data"] = decode_json(record["response_data"])
+                    archive.write(json.dumps(record, default=str) + "\n")
+                    count += 1
+
+        self.stdout.write("Archived %s rows of %s to %s" % (count, name, path))
+        return count
+
+    def prune(self, partitioned):
+
+        cutoff = self.cutoff()
+        columns = ", ".join(ARCHIVE_COLUMNS)
+
+        self.stdout.write("Pruning RequestLog rows before %s" % cutoff)
+
+        if partitioned and self.is_partitioned():
+
+            for name in self.partitions():
+
+                end = partition_end(name)
+
+                if end is None or end > cutoff:
+                    continue
+
+                with transaction.atomic():
+                    self.archive(name, "SELECT %s FROM %s ORDER BY id" % (columns, name))
+                    self.execute_sql("ALTER TABLE %s DETACH PARTITION %s" % (TABLE, name))
+                    self.execute_sql("DROP TABLE %s" % name)
+
+        self.prune_rows(cutoff, columns)
+
+    def prune_rows(self, cutoff, columns):
+        """Chunked archive and delete of rows that are not in a droppable partition."""
+
+        boundary = datetime.combine(cutoff, datetime.min.time())
+
+        if settings.USE_TZ:
+            boundary = timezone.make_aware(boundary)
+
+        queryset = RequestLog.objects.filter(created_at__lt=boundary)
+
+        if self.options["dry_run"]:
+            self.stdout.write("%s rows would be deleted" % queryset.count())
+            return
+
+        self.archive(
+            "%s_rows" % TABLE,
+            "SELECT %s FROM %s WHERE created_at < %%s ORDER BY id" % (columns, TABLE),
+            # raw SQL, so the value is adapted the way the ORM stores it
+            [connection.ops.adapt_datetimefield_value(boundary)]
+        )
+
+        deleted = 0
+
+        while True:
+            ids = list(queryset.order_by("id").values_list("id", flat=True)[:self.options["chunk_size"]])
+
+            if not ids:
+                break
+
+            deleted += RequestLog.objects.filter(id__in=ids).delete()[0]
+
+        self.stdout.write("Deleted %s rows" % deleted)
@@ -0,0 +1,33 @@
+from prometheus_client import Counter, Histogram
+
+SYNC_LOCK_WAIT_SECONDS = Histogram(
+    "sync_lock_wait_seconds",
+    "Time spent waiting for the per-merchant sync lock",
+    ["route", "outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0),
+)
+
+SYNC_LOCK_REJECTIONS = Counter(
+    "sync_lock_rejections_total",
+    "Requests answered with 429 by SyncLockMiddleware",
+    ["route", "reason"],
+)
+
+PARTNER_HTTP_SECONDS = Histogram(
+    "partner_http_request_seconds",
+    "Latency of outbound partner calls made through core.http, per attempt",
+    ["host", "method", "outcome"],
+    buckets=(0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0, 10.0),
+)
+
+PARTNER_HTTP_RETRIES = Counter(
+    "partner_http_retries_total",
+    "Outbound partner calls retried by core.http",
+    ["host", "reason"],
+)
+
+PARTNER_HTTP_BUDGET_EXHAUSTED = Counter(
+    "partner_http_budget_exhausted_total",
+    "Outbound partner calls not attempted because the deadline() budget was spent",
+    ["host"],
+)
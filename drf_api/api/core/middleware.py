@@ -7,64 +7,32 @@ from django.http import HttpResponse, QueryDict, JsonResponse
 from django.contrib.auth.models import User
 from rest_framework.request import Request as RestFrameworkRequest
 from rest_framework.views import APIView
-from django_pglocks import advisory_lock
 import uuid
 import datetime
 import os
 from django.conf import settings
 from django.http import HttpResponseForbidden
 from django.urls import resolve
-
+from core.payload import get_payload
+from core.routes import route_policies
+from core.allowlist import allowlists
+from core.principal import principals
+from core.locks import (
+    get_lock_backend, fallback_backend_name, LockAttempt, LockUnavailable,
+    REJECTED_BUSY, REJECTED_UNAVAILABLE, REDIS
+)
+from core.aio import DualModeMiddleware
+from core.fanout import run_async
+from asgiref.sync import sync_to_async
+from core.metrics import SYNC_LOCK_WAIT_SECONDS, SYNC_LOCK_REJECTIONS
+
+log = logging.getLogger("django")
 
 if not os.path.exists(settings.LOGS_FOLDER_NAME):
     os.mkdir(settings.LOGS_FOLDER_NAME)
 
 
-allowed_ips = {'all': [], 'hbl': [],'internal_data':[]}
-list_of_exempted_endpoints=[('/merchant/wallet/','POST'),('merchant/list/telcos/','POST'),
-                        ('available/telcos/', 'GET'), ('recharge/v2/', 'GET'),
-                        ('deposit/v2/','GET'), ('/loan/agreement/','GET')]
-
-allowed_merchants=[]
-
-def load_ip_list():
-
-    def get_ips(filename):
-        ips_list_final=[]
-        try:
-            ips=open('%s_ips.txt'%filename,'r').readlines()
-            for ip in ips:
-                ip=ip.strip()
-                if ip:
-                    ips_list_final.append(ip)
-        except:
-            pass
-        return ips_list_final
-
-    return {f:get_ips(f) for f in ['all', 'hbl','kunda','internal_data']}
-
-
-    
-def load_white_listed_merchants():
-    try:
-        file_white_listed_merchants=open('white_listed_merchants.txt','r')
-    except:
-        return
-    all_merchants=file_white_listed_merchants.readlines()
-    
-    for merchants in all_merchants:
-        merchants=merchants.strip()
-        allowed_merchants.append(merchants)
-    
-
-
-allowed_ips = load_ip_list()
-load_white_listed_merchants()
-
-
-class UdhaarAuthenticationMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
+class UdhaarAuthenticationMiddleware(DualModeMiddleware):
 
     def unauthorized_response(self, request):
         response = JsonResponse(
@@ -78,23 +46,31 @@ class UdhaarAuthenticationMiddleware:
 
         return response
 
-    def __call__(self, request):
-        response = self.get_response(request)
-        return response
-
     def process_view(self, request, view_func, view_args, view_kwargs):
-        if view_kwargs.get('auth') is False:
+        policy = route_policies.for_request(request)
+
+        if policy.auth is False:
             return None
-        elif view_kwargs.get('auth') is True:
-            data =json.loads(request.body)
-            user = User.objects.filter(username=data.get('phone_number'),
-                                           merchant_profile__secret_key=data.get('secret_key'))
-            if user:
+        elif policy.auth is True:
+            data = get_payload(request).data
+            principal = principals.for_request(request, data.get('phone_number'), data.get('secret_key'))
+            if principal:
                 return None
             else:
                 response = self.unauthorized_response(request)
                 return response
 
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        policy = route_policies.for_request(request)
+
+        if policy.auth is True:
+            data = get_payload(request).data
+            principal = await principals.afor_request(request, data.get('phone_number'), data.get('secret_key'))
+            if not principal:
+                return self.unauthorized_response(request)
+
+        return None
+
 
         
 '''
@@ -147,13 +123,10 @@ class UdhaarAuthenticationMiddleware:
 
 
 
-class IPBlockingMiddleware:
+class IPBlockingMiddleware(DualModeMiddleware):
     
     
 
-    def __init__(self, get_response):
-        self.get_response = get_response
-
     def unauthorized_response(self, request):
         response = JsonResponse(
             {"detail": "IP Blocked"},
@@ -163,9 +136,13 @@ class IPBlockingMiddleware:
        
         return response
 
-    def __call__(self, request):
-        response = self.get_response(request)
-        return response
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+
+        # the periodic allowlist reload stats files and reads redis
+        if allowlists.refresh_due():
+            await run_async(allowlists.refresh)
+
+        return self.process_view(request, view_func, view_args, view_kwargs)
 
     def process_view(self,request, view_func, view_args, view_kwargs):
         
@@ -173,27 +150,26 @@ class IPBlockingMiddleware:
 
         ip = request.META['REMOTE_ADDR']
         
-        if '/admin/' in request.path or '/media/' in request.path:
-            return None
+        ip_security = route_policies.for_request(request).ip_security
 
-        if view_kwargs.get('ip_security') == 'all':
-            if ip in allowed_ips['all']:
+        if ip_security == 'all':
+            if allowlists.ip_allowed('all', ip):
                 return None
             else:
-                params=json.loads(request.body)
+                params = get_payload(request).data
 
-                if params.get('phone_number') in allowed_merchants:
+                if allowlists.merchant_allowed(params.get('phone_number')):
                     return None
         
-        elif view_kwargs.get('ip_security') == 'kunda':
-            if ip in allowed_ips['kunda']:
+        elif ip_security == 'kunda':
+            if allowlists.ip_allowed('kunda', ip):
                 return None
         
-        elif view_kwargs.get('ip_security') == 'internal_data':
-            if ip in allowed_ips['internal_data']:
+        elif ip_security == 'internal_data':
+            if allowlists.ip_allowed('internal_data', ip):
                 return None
 
-        elif view_kwargs.get('ip_security') == 'disabled':
+        elif ip_security == 'disabled':
             return None
         
         return self.unauthorized_response(request)
@@ -202,9 +178,7 @@ class IPBlockingMiddleware:
 
 
 
-class SyncLockMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
+class SyncLockMiddleware(DualModeMiddleware):
 
     def limit_response(self):
         response = JsonResponse(
@@ -214,75 +188,141 @@ class SyncLockMiddleware:
         )
         return response
     
+    def lock_request(self, request):
+        """(policy, lock key) of a request that must be serialized, None otherwise."""
+
+        policy = route_policies.for_request(request)
+
+        if not policy.locks(request.method):
+            return None
+
+        payload = get_payload(request)
+        data = payload.data
+
+        if payload.error:
+            logging.info("REQUEST BODY")
+            logging.info(payload.error)
+
+        lock_key = policy.lock_key(data)
+
+        if not lock_key:
+            return None
+
+        return policy, lock_key
+
+    def rejected(self, policy, attempt):
+        """Records the outcome of the attempt, the 429 when it was rejected."""
+
+        route = policy.name or "unnamed"
+
+        if attempt.lease is None:
+            SYNC_LOCK_REJECTIONS.labels(route, attempt.rejected_reason).inc()
+            if attempt.rejected_reason != REJECTED_BUSY:
+                SYNC_LOCK_WAIT_SECONDS.labels(route, "rejected").observe(attempt.waited)
+            return self.limit_response()
+
+        if policy.wait_ms:
+            SYNC_LOCK_WAIT_SECONDS.labels(route, "acquired").observe(attempt.waited)
+
+        return None
     
-    def __call__(self, request):
-        paybill_url = 'bills/billpay/'
-        send_money_v3_url = 'api/sendmoney/v3/'
-        oscar_wallet_urls = {
-            "/oscar-wallet/wallet-balance/",
-            "/oscar-wallet/beneficiary/",
-            "/oscar-wallet/otp/",
-            "/oscar-wallet/wallet-activity/",
-            "/oscar-wallet/titlefetch/",
-            "/oscar-wallet/wallet-withdraw-report/",
-            "/oscar-wallet/current-balance/",
-            "/oscar-wallet/single-payment/",
-            "/oscar-wallet/banks/v2/",
-            "/oscar-wallet/deposit-breakdown-report/"
-        }
-        whitelist_urls = {
-            '/admin/',
-            'sharereward',
-            '/payments/deposit_funds_to_merchant/',
-            '/payments/send_money_to_supplier/',
-            'agent/creditaccount/',
-            'agent/merchanttransactions/',
-            paybill_url,
-            'loyalty/balance/',
-            send_money_v3_url
-        }
-        whitelist_urls.update(oscar_wallet_urls)
-        if (paybill_url in request.path) and (request.method == 'POST'): # remove incase it is POST Request
-            whitelist_urls.remove((paybill_url))
-
-        if (send_money_v3_url in request.path) and (request.method == 'POST'): # remove incase it is POST Request
-            whitelist_urls.remove((send_money_v3_url))
-
-        if any(url in request.path for url in whitelist_urls):
+    def fallback(self, backend, error):
+        """Backend standing in for an unavailable one, None to reject the request."""
+
+        name = fallback_backend_name(backend.name)
+
+        if name is None:
+            log.warning("%s, rejecting" % error)
+            return None
+
+        log.warning("%s, falling back to %s" % (error, name))
+        return get_lock_backend(name)
+
+    def acquire(self, policy, lock_key):
+        """(backend, attempt) of the route's lock backend, or of its fallback while it is unavailable."""
+
+        backend = get_lock_backend(policy.lock_backend)
+
+        try:
+            return backend, backend.acquire(lock_key, policy.wait_ms, policy.max_waiters)
+        except LockUnavailable as e:
+            fallback = self.fallback(backend, e)
+
+        if fallback is None:
+            return backend, LockAttempt(rejected_reason=REJECTED_UNAVAILABLE)
+
+        return fallback, fallback.acquire(lock_key, policy.wait_ms, policy.max_waiters)
+
+    def blocking(self, backend):
+
+        if backend.name == REDIS:
+            return run_async
+
+        # an advisory lock lives on the database connection of the thread
+        # that took it, release has to run on the same one
+        return sync_to_async(lambda fn, *args: fn(*args), thread_sensitive=True)
+
+    async def aacquire(self, policy, lock_key):
+
+        backend = get_lock_backend(policy.lock_backend)
+
+        try:
+            attempt = await self.blocking(backend)(
+                backend.acquire, lock_key, policy.wait_ms, policy.max_waiters
+            )
+            return backend, attempt
+        except LockUnavailable as e:
+            fallback = self.fallback(backend, e)
+
+        if fallback is None:
+            return backend, LockAttempt(rejected_reason=REJECTED_UNAVAILABLE)
+
+        attempt = await self.blocking(fallback)(
+            fallback.acquire, lock_key, policy.wait_ms, policy.max_waiters
+        )
+
+        return fallback, attempt
+
+    def handle(self, request):
+
+        locked = self.lock_request(request)
+
+        if locked is None:
             response = self.get_response(request)
             return response
 
+        policy, lock_key = locked
+        backend, attempt = self.acquire(policy, lock_key)
+
         try:
-            data =json.loads(request.body)
-        except Exception as e:
-            logging.info("REQUEST BODY")
-            logging.info(request.body)
-            logging.exception(e)
-            data ={}
-        
-        
-        if data.get('phone_number') or data.get('username'):
-            
-            for tup in list_of_exempted_endpoints:
-                if tup[0] in request.path:
-                    if request.method == tup[1]:
-                        response = self.get_response(request)
-                        return response
-
-
-            
-            
-            try:
-                phone_number = data['phone_number']
-            except:
-                phone_number = data['username']
-            with advisory_lock(lock_id=phone_number, wait=False) as acquired:
-                if acquired is False:
-                    return self.limit_response()
-                
-                response = self.get_response(request)
+            response = self.rejected(policy, attempt)
+
+            if response is not None:
                 return response
-        else:
+
             response = self.get_response(request)
+            return response
+        finally:
+            if attempt.lease is not None:
+                backend.release(attempt.lease)
+
+    async def ahandle(self, request):
+
+        locked = self.lock_request(request)
+
+        if locked is None:
+            return await self.get_response(request)
+
+        policy, lock_key = locked
+        backend, attempt = await self.aacquire(policy, lock_key)
+
+        try:
+            response = self.rejected(policy, attempt)
+
+            if response is not None:
+                return response
 
-            return response
\ No newline at end of file
+            return await self.get_response(request)
+        finally:
+            if attempt.lease is not None:
+                await self.blocking(backend)(backend.release, attempt.lease)
@@ -29,8 +29,53 @@ class UserToken(models.Model):
         return int((self.expires_at_gmt - (timezone.now() + timedelta(hours=5))).total_seconds())
 
 class RequestLog(models.Model):
+   """
+   On postgres the table is range partitioned by created_at, see the
+   request_log_partitions management command.
+   """
     
    user = models.ForeignKey(User, on_delete=models.CASCADE)
    request_data = jsonfield.JSONField(default={})
    response_data = jsonfield.JSONField(default={})
-   created_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+   # explicit default instead of auto_now_add so queued rows keep the request time
+   created_at = models.DateTimeField(default=timezone.now)
+
+   class Meta:
+       indexes = [
+           models.Index(fields=["created_at"], name="core_reqlog_created_idx"),
+           models.Index(fields=["user", "created_at"], name="core_reqlog_user_created_idx"),
+       ]
+
+class OutboxEvent(models.Model):
+    """
+    Side effect of a committed transaction (a notification to another
+    service), written in the same transaction and delivered afterwards by
+    the dispatch_outbox worker, see core.outbox.
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_DELIVERED = "delivered"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, STATUS_PENDING),
+        (STATUS_DELIVERED, STATUS_DELIVERED),
+        (STATUS_FAILED, STATUS_FAILED),
+    ]
+
+    topic = models.CharField(max_length=100)
+    payload = jsonfield.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    # next delivery attempt, moved forward while a worker holds the row
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    delivered_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "available_at"], name="core_outbox_due_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.topic} #{self.id} ({self.status})"
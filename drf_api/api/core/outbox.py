@@ -0,0 +1,171 @@
+import logging
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from core.models import OutboxEvent
+from core import http
+
+log = logging.getLogger("django")
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_BACKOFF_SECONDS = 5
+DEFAULT_MAX_BACKOFF_SECONDS = 3600
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_DELIVERY_SECONDS = 15
+
+HANDLERS = {}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def handler(topic):
+    """Registers the function delivering events of topic, it gets the payload."""
+
+    def decorator(func):
+        HANDLERS[topic] = func
+        return func
+
+    return decorator
+
+
+def enqueue(topic, **payload):
+    """
+    Writes an event to the outbox. Call it inside the transaction whose side
+    effect it is, the row only becomes visible to the worker on commit.
+    """
+
+    return OutboxEvent.objects.create(topic=topic, payload=payload)
+
+
+def backoff(attempts):
+    """Delay before the next attempt, doubling from OUTBOX_BACKOFF_SECONDS."""
+
+    seconds = _setting("OUTBOX_BACKOFF_SECONDS", DEFAULT_BACKOFF_SECONDS) * 2 ** max(attempts - 1, 0)
+
+    return timedelta(seconds=min(seconds, _setting("OUTBOX_MAX_BACKOFF_SECONDS", DEFAULT_MAX_BACKOFF_SECONDS)))
+
+
+def lease():
+    return timedelta(seconds=_setting("OUTBOX_LEASE_SECONDS", DEFAULT_LEASE_SECONDS))
+
+
+def claim(batch_size):
+    """
+    Claims up to batch_size due events. Rows are locked with SKIP LOCKED so
+    concurrent workers take disjoint batches, and leased by moving their
+    available_at forward before the claim commits. An event whose worker
+    died becomes due again when the lease runs out.
+    """
+
+    now = timezone.now()
+    leased_until = now + lease()
+
+    with transaction.atomic():
+
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True).filter(
+                status=OutboxEvent.STATUS_PENDING, available_at__lte=now
+            ).order_by("available_at", "id")[:batch_size]
+        )
+
+        if events:
+            OutboxEvent.objects.filter(id__in=[event.id for event in events]).update(
+                available_at=leased_until
+            )
+
+    for event in events:
+        event.available_at = leased_until
+
+    return events
+
+
+def renew(event):
+    """
+    Leases the event again for its own delivery, False when it is no longer
+    ours: its batch lease ran out and another worker claimed it.
+    """
+
+    leased_until = timezone.now() + lease()
+
+    renewed = OutboxEvent.objects.filter(
+        id=event.id, status=OutboxEvent.STATUS_PENDING, available_at=event.available_at
+    ).update(available_at=leased_until)
+
+    if renewed:
+        event.available_at = leased_until
+
+    return bool(renewed)
+
+
+def record(event, **fields):
+    """Writes the outcome while the event is still under our lease, False when it was lost."""
+
+    recorded = OutboxEvent.objects.filter(id=event.id, available_at=event.available_at).update(**fields)
+
+    for name, value in fields.items():
+        setattr(event, name, value)
+
+    if not recorded:
+        log.warning("Outbox event %s lease ran out before its outcome was recorded" % event.id)
+
+    return bool(recorded)
+
+
+def deliver(event):
+    """
+    Runs the topic's handler and records the outcome, True when delivered.
+    Each event is leased again for OUTBOX_LEASE_SECONDS as its delivery
+    starts, so a slow batch can't outlive the lease of its last events.
+    Partner calls of the handler share an OUTBOX_DELIVERY_SECONDS budget,
+    a call it can't cover fails the attempt like any other error.
+    """
+
+    if not renew(event):
+        log.warning("Outbox event %s was claimed by another worker" % event.id)
+        return False
+
+    attempts = event.attempts + 1
+
+    try:
+        func = HANDLERS.get(event.topic)
+
+        if func is None:
+            raise LookupError("No outbox handler for %s" % event.topic)
+
+        with http.deadline(_setting("OUTBOX_DELIVERY_SECONDS", DEFAULT_DELIVERY_SECONDS)):
+            func(event.payload)
+
+    except Exception:
+
+        last_error = traceback.format_exc()
+
+        if attempts >= _setting("OUTBOX_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS):
+            log.error("Outbox event %s failed after %s attempts" % (event.id, attempts))
+            record(event, attempts=attempts, status=OutboxEvent.STATUS_FAILED, last_error=last_error)
+        else:
+            log.warning("Outbox event %s failed, attempt %s" % (event.id, attempts))
+            record(
+                event, attempts=attempts, last_error=last_error,
+                available_at=timezone.now() + backoff(attempts)
+            )
+
+        return False
+
+    return record(
+        event, attempts=attempts, status=OutboxEvent.STATUS_DELIVERED,
+        delivered_at=timezone.now(), last_error=None
+    )
+
+
+def dispatch(batch_size=None):
+    """Claims and delivers one batch, returns (delivered, failed)."""
+
+    events = claim(batch_size or _setting("OUTBOX_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+    delivered = sum(1 for event in events if deliver(event))
+
+    return delivered, len(events) - delivered
@@ -0,0 +1,197 @@
+import json
+import logging
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework import status
+from rest_framework.parsers import JSONParser
+from rest_framework.exceptions import ParseError
+from core.aio import DualModeMiddleware
+
+log = logging.getLogger("django")
+
+DEFAULT_MAX_BODY_SIZE = 64 * 1024
+
+PAYLOAD_ATTRIBUTE = "_parsed_payload"
+
+
+class RequestPayload:
+    """
+    Parses the JSON body of a request at most once.
+    Every middleware, authenticator and parser reads the body through
+    this object instead of calling json.loads(request.body) on its own.
+    """
+
+    def __init__(self, request, max_body_size=None):
+        self.request = request
+        self.max_body_size = max_body_size or getattr(
+            settings, "PAYLOAD_MAX_BODY_SIZE", DEFAULT_MAX_BODY_SIZE
+        )
+        self._parsed = False
+        self._value = None
+        self.error = None
+
+    @property
+    def content_length(self):
+        try:
+            return int(self.request.META.get("CONTENT_LENGTH") or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    @property
+    def is_json(self):
+        content_type = self.request.META.get("CONTENT_TYPE", "")
+        return content_type.split(";")[0].strip().lower() in ("application/json", "")
+
+    @property
+    def too_large(self):
+        return self.content_length > self.max_body_size
+
+    def _parse(self):
+
+        self._parsed = True
+
+        if self.too_large:
+            self.error = "Request body too large"
+            return
+
+        try:
+            body = self.request.body
+        except Exception as e:
+            self.error = str(e)
+            return
+
+        if not body:
+            return
+
+        if len(body) > self.max_body_size:
+            self.error = "Request body too large"
+            return
+
+        try:
+            self._value = json.loads(body)
+        except (TypeError, ValueError) as e:
+            self.error = "Malformed JSON: %s" % e
+
+    @property
+    def value(self):
+        """Raw decoded JSON value, None when the body is empty or invalid."""
+        if not self._parsed:
+            self._parse()
+        return self._value
+
+    @property
+    def data(self):
+        """Decoded body as a dict, {} for empty, invalid or non-object bodies."""
+        value = self.value
+        if isinstance(value, dict):
+            return value
+        return {}
+
+    @property
+    def is_malformed(self):
+        return self.value is None and self.error is not None
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+def get_payload(request):
+    """
+    Returns the RequestPayload attached to the request, creating it on first use.
+    Accepts both django HttpRequest and rest framework Request objects.
+    """
+    request = getattr(request, "_request", request)
+
+    payload = getattr(request, PAYLOAD_ATTRIBUTE, None)
+
+    if payload is None:
+        payload = RequestPayload(request)
+        setattr(request, PAYLOAD_ATTRIBUTE, payload)
+
+    return payload
+
+
+class RequestPayloadMiddleware(DualModeMiddleware):
+    """
+    Attaches the parsed payload to the request and rejects oversized or
+    malformed JSON bodies before any other middleware touches them.
+    Other bodies (admin forms, multipart uploads) are left to django's
+    own DATA_UPLOAD_MAX_MEMORY_SIZE handling.
+    Must be placed above the core middlewares in settings.MIDDLEWARE.
+    """
+
+    def error_response(self, detail, status_code):
+        return JsonResponse(
+            {"detail": detail},
+            content_type="application/json",
+            status=status_code,
+        )
+
+    def reject(self, request):
+
+        payload = get_payload(request)
+
+        if not payload.is_json:
+            return None
+
+        if payload.too_large:
+            return self.error_response(
+                "Request body too large", status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        if request.method in ("POST", "PUT", "PATCH"):
+            if payload.is_malformed:
+                log.info("REQUEST BODY REJECTED: %s" % payload.error)
+                return self.error_response(
+                    "Malformed request body", status.HTTP_400_BAD_REQUEST
+                )
+
+        return None
+
+    def handle(self, request):
+
+        response = self.reject(request)
+
+        if response is None:
+            response = self.get_response(request)
+
+        return response
+
+    async def ahandle(self, request):
+
+        response = self.reject(request)
+
+        if response is None:
+            response = await self.get_response(request)
+
+        return response
+
+
+class CachedJSONParser(JSONParser):
+    """
+    JSON parser for rest framework that reuses the payload decoded by
+    RequestPayload instead of decoding the stream again for request.data.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+
+        parser_context = parser_context or {}
+        request = parser_context.get("request")
+
+        if request is None:
+            return super().parse(stream, media_type, parser_context)
+
+        payload = get_payload(request)
+
+        if payload.too_large:
+            raise ParseError("Request body too large")
+
+        if payload.is_malformed:
+            raise ParseError("JSON parse error - %s" % payload.error)
+
+        value = payload.value
+
+        if value is None:
+            return {}
+
+        return value
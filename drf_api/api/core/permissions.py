@@ -9,12 +9,21 @@ import json
 from django.contrib.auth.models import User
 from rest_framework import authentication
 from rest_framework import exceptions
+from core.payload import get_payload
+from core.principal import principals
+from core.tokens import (
+    is_signed_token, verify_token, token_user, revoked_tokens, InvalidToken, ExpiredToken
+)
+from core.fanout import run_async
 
 
 class IsTokenValid(BasePermission):
     
     def has_permission(self, request, view):
-        auth = request.headers.get('Authorization')
+        request.user = self.authenticate(request.headers.get('Authorization'))
+        return True
+    
+    def bearer_token(self, auth):
         
         if not auth:
             raise AuthenticationFailed({
@@ -30,10 +39,18 @@ class IsTokenValid(BasePermission):
                 "responseCode" : "053"
             })
         
-        token = parts[1]
+        return parts[1]
+    
+    def authenticate(self, auth):
+        """User of an Authorization header, raises AuthenticationFailed."""
+        
+        token = self.bearer_token(auth)
+        
+        if is_signed_token(token):
+            return self.signed_token_user(token)
         
         try:
-            user_token = UserToken.objects.get(token=token)
+            user_token = UserToken.objects.select_related('user').get(token=token)
         except UserToken.DoesNotExist:
             raise AuthenticationFailed({
                 "responseDescription" : "Invalid Authentication Token",
@@ -47,9 +64,40 @@ class IsTokenValid(BasePermission):
                 "responseCode" : "051"
             })
             
-        request.user = user_token.user
+        return user_token.user
+    
+    async def aauthenticate(self, auth):
+        """
+        authenticate() for async views. Signed tokens are checked in the
+        event loop, stored tokens are looked up on the fan-out pool.
+        """
         
-        return True
+        token = self.bearer_token(auth)
+        
+        if not is_signed_token(token):
+            return await run_async(self.authenticate, auth)
+        
+        if revoked_tokens.refresh_due():
+            await run_async(revoked_tokens.refresh)
+        
+        return self.signed_token_user(token)
+    
+    def signed_token_user(self, token):
+        
+        try:
+            claims = verify_token(token)
+        except ExpiredToken:
+            raise AuthenticationFailed({
+                "responseDescription" : "Authorization Token Expired",
+                "responseCode" : "051"
+            })
+        except InvalidToken:
+            raise AuthenticationFailed({
+                "responseDescription" : "Invalid Authentication Token",
+                "responseCode" : "054"
+            })
+        
+        return token_user(claims)
     
 class IsMerchantActive(BasePermission):
     
@@ -82,7 +130,7 @@ class UserAuthentication(authentication.TokenAuthentication):
     def authenticate(self, request):
 
         # secret_token = request.META.get('HTTP_AUTHORIZATION')
-        data = json.loads(request.body)
+        data = get_payload(request).data
         phone_number = data.get('phone_number')
         secret_token = data.get('secret_key')
         # if secret_token:
@@ -91,10 +139,9 @@ class UserAuthentication(authentication.TokenAuthentication):
         if not secret_token:
             return None
         
-        try:
-            ua = User.objects.get(username =phone_number, merchant_profile__secret_key=secret_token)
+        principal = principals.for_request(request, phone_number, secret_token)
 
-        except User.DoesNotExist:
+        if principal is None:
             raise exceptions.AuthenticationFailed('User Unauthorized')
 
-        return (ua, None)
\ No newline at end of file
+        return (principal.build_user(), principal)
\ No newline at end of file
@@ -0,0 +1,358 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from merchant.models import Merchant
+from core.redis_ops import conn, async_client
+from core.fanout import run_async
+
+log = logging.getLogger("django")
+
+DEFAULT_CACHE_TTL = 60
+DEFAULT_LOCAL_TTL = 5
+LOCAL_MAX_ENTRIES = 10000
+
+PRINCIPAL_ATTRIBUTE = "_merchant_principal"
+
+# cached field values of the User and Merchant built by build_user()
+SNAPSHOT_ATTRIBUTE = "_principal_snapshot"
+
+PREVIOUS_USERNAME_ATTRIBUTE = "_principal_previous_username"
+
+# User fields held by a principal
+USER_FIELDS = {"username", "is_active"}
+
+
+def secret_digest(secret_key):
+    return hashlib.sha256(secret_key.encode()).hexdigest()
+
+
+class MerchantPrincipal:
+    """
+    What wallet authentication needs to know about a merchant, loaded in one
+    query and cheap to cache. current_balance is only set when the principal
+    was just loaded from the database, it is never cached.
+    """
+
+    CACHED_FIELDS = (
+        "user_id", "username", "is_active", "merchant_id",
+        "merchant_uid", "status", "credit_blocked", "digest"
+    )
+
+    def __init__(
+        self,
+        user_id,
+        username,
+        is_active,
+        merchant_id,
+        merchant_uid,
+        status,
+        credit_blocked,
+        digest,
+        current_balance=None
+    ):
+        self.user_id = user_id
+        self.username = username
+        self.is_active = is_active
+        self.merchant_id = merchant_id
+        self.merchant_uid = merchant_uid
+        self.status = status
+        self.credit_blocked = credit_blocked
+        self.digest = digest
+        self.current_balance = current_balance
+
+    @classmethod
+    def from_merchant(cls, merchant):
+        return cls(
+            user_id=merchant.user.id,
+            username=merchant.user.username,
+            is_active=merchant.user.is_active,
+            merchant_id=merchant.id,
+            merchant_uid=str(merchant.uid),
+            status=merchant.status,
+            credit_blocked=merchant.credit_blocked,
+            digest=secret_digest(merchant.secret_key),
+            current_balance=merchant.current_balance
+        )
+
+    def to_json(self):
+        return json.dumps({field: getattr(self, field) for field in self.CACHED_FIELDS})
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(**json.loads(value))
+
+    def build_user(self):
+        """
+        Deferred User with its merchant_profile already attached. Fields that
+        were not loaded are fetched on first access. The cached fields can be
+        up to PRINCIPAL_CACHE_TTL old, so the first save of either object
+        reloads the ones the caller left untouched from the database first.
+        """
+
+        user = User.from_db(
+            "default",
+            ["id", "username", "is_active"],
+            [self.user_id, self.username, self.is_active]
+        )
+        setattr(user, SNAPSHOT_ATTRIBUTE, {"username" : self.username, "is_active" : self.is_active})
+
+        # from_db takes the values in the model's field order
+        merchant_fields = ["id", "uid", "user_id"]
+        merchant_values = [self.merchant_id, uuid.UUID(self.merchant_uid), self.user_id]
+
+        if self.current_balance is not None:
+            merchant_fields.append("current_balance")
+            merchant_values.append(self.current_balance)
+
+        merchant_fields += ["status", "credit_blocked"]
+        merchant_values += [self.status, self.credit_blocked]
+
+        merchant = Merchant.from_db("default", merchant_fields, merchant_values)
+        setattr(merchant, SNAPSHOT_ATTRIBUTE, {"status" : self.status, "credit_blocked" : self.credit_blocked})
+
+        Merchant.user.field.set_cached_value(merchant, user)
+        Merchant.user.field.remote_field.set_cached_value(user, merchant)
+
+        return user
+
+
+class PrincipalResolver:
+    """
+    Resolves (phone number, secret key) to a MerchantPrincipal.
+
+    Looks in a per-process dict (PRINCIPAL_LOCAL_TTL seconds), then redis
+    (PRINCIPAL_CACHE_TTL seconds), then runs a single select_related query.
+    Entries hold a digest of the secret key, never the key itself, and are
+    dropped whenever the merchant is saved or deleted.
+    """
+
+    KEY_PREFIX = "merchant_principal:"
+
+    def __init__(self, client=None):
+        self.client = client or conn
+        self.local = {}
+        self.lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, "PRINCIPAL_CACHE_TTL", DEFAULT_CACHE_TTL)
+
+    @property
+    def local_ttl(self):
+        return getattr(settings, "PRINCIPAL_LOCAL_TTL", DEFAULT_LOCAL_TTL)
+
+    def redis_key(self, phone_number):
+        return "%s%s%s" % (settings.ENV, self.KEY_PREFIX, phone_number)
+
+    def load(self, phone_number, secret_key):
+        try:
+            merchant = Merchant.objects.select_related("user").get(
+                user__username=phone_number, secret_key=secret_key
+            )
+        except Merchant.DoesNotExist:
+            return None
+
+        return MerchantPrincipal.from_merchant(merchant)
+
+    def _local_get(self, local_key, now):
+
+        cached = self.local.get(local_key)
+
+        if cached and cached[0] > now:
+            return cached[1]
+
+        return None
+
+    def _remember(self, local_key, principal, now):
+
+        # the balance of a fresh load goes to this request only
+        cached = MerchantPrincipal(**{field: getattr(principal, field) for field in MerchantPrincipal.CACHED_FIELDS})
+
+        with self.lock:
+            if len(self.local) >= LOCAL_MAX_ENTRIES:
+                self.local = {
+                    key: value for key, value in self.local.items() if value[0] > now
+                }
+            self.local[local_key] = (now + self.local_ttl, cached)
+
+    def resolve(self, phone_number, secret_key):
+
+        if not phone_number or not secret_key:
+            return None
+
+        digest = secret_digest(secret_key)
+        local_key = (phone_number, digest)
+        now = time.monotonic()
+
+        cached = self._local_get(local_key, now)
+
+        if cached is not None:
+            return cached
+
+        principal = None
+
+        try:
+            value = self.client.get(self.redis_key(phone_number))
+            if value:
+                principal = MerchantPrincipal.from_json(value)
+        except Exception as e:
+            log.warning("Principal cache unavailable: %s" % e)
+
+        if principal is None or principal.digest != digest:
+
+            principal = self.load(phone_number, secret_key)
+
+            if principal is None:
+                return None
+
+            try:
+                self.client.set(self.redis_key(phone_number), principal.to_json(), ex=self.ttl)
+            except Exception as e:
+                log.warning("Principal cache unavailable: %s" % e)
+
+        self._remember(local_key, principal, now)
+
+        return principal
+
+    async def aresolve(self, phone_number, secret_key):
+        """
+        resolve() for async views, the redis read goes through the async
+        client and only a cache miss runs the query on the fan-out pool.
+        """
+
+        if not phone_number or not secret_key:
+            return None
+
+        digest = secret_digest(secret_key)
+        local_key = (phone_number, digest)
+        now = time.monotonic()
+
+        cached = self._local_get(local_key, now)
+
+        if cached is not None:
+            return cached
+
+        try:
+            value = await async_client("conn").get(self.redis_key(phone_number))
+            if value:
+                principal = MerchantPrincipal.from_json(value)
+                if principal.digest == digest:
+                    self._remember(local_key, principal, now)
+                    return principal
+        except Exception as e:
+            log.warning("Principal cache unavailable: %s" % e)
+
+        return await run_async(self.resolve, phone_number, secret_key)
+
+    def invalidate(self, phone_number):
+
+        with self.lock:
+            for key in [key for key in self.local if key[0] == phone_number]:
+                self.local.pop(key, None)
+
+        try:
+            self.client.delete(self.redis_key(phone_number))
+        except Exception as e:
+            log.warning("Principal cache unavailable: %s" % e)
+
+    def for_request(self, request, phone_number, secret_key):
+        """Resolves once per request, the middleware and authenticator share it."""
+
+        request = getattr(request, "_request", request)
+
+        if not hasattr(request, PRINCIPAL_ATTRIBUTE):
+            setattr(request, PRINCIPAL_ATTRIBUTE, self.resolve(phone_number, secret_key))
+
+        return getattr(request, PRINCIPAL_ATTRIBUTE)
+
+    async def afor_request(self, request, phone_number, secret_key):
+
+        if not hasattr(request, PRINCIPAL_ATTRIBUTE):
+            setattr(request, PRINCIPAL_ATTRIBUTE, await self.aresolve(phone_number, secret_key))
+
+        return getattr(request, PRINCIPAL_ATTRIBUTE)
+
+
+principals = PrincipalResolver()
+
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=Merchant)
+def load_principal_row(sender, instance, update_fields=None, **kwargs):
+    """
+    Before the first save of a User or Merchant built from a principal, the
+    cached values the caller left untouched are replaced by the row's current
+    ones, so the save never writes back a value up to PRINCIPAL_CACHE_TTL old.
+    A field set back to its cached value counts as untouched.
+    """
+
+    snapshot = instance.__dict__.pop(SNAPSHOT_ATTRIBUTE, None)
+
+    if not snapshot:
+        return
+
+    untouched = [
+        field for field, value in snapshot.items()
+        if (update_fields is None or field in update_fields) and getattr(instance, field) == value
+    ]
+
+    if untouched:
+        instance.refresh_from_db(fields=untouched)
+
+
+def invalidate_on_commit(*usernames):
+
+    def invalidate():
+        for username in usernames:
+            if username:
+                principals.invalidate(username)
+
+    # dropped after commit, a read in between would cache the old row again
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=Merchant)
+@receiver(post_delete, sender=Merchant)
+def invalidate_merchant_principal(sender, instance, **kwargs):
+    try:
+        username = instance.user.username
+    except Exception as e:
+        log.exception(e)
+        return
+
+    invalidate_on_commit(username)
+
+
+@receiver(pre_save, sender=User)
+def remember_previous_username(sender, instance, update_fields=None, **kwargs):
+
+    if instance.pk is None or (update_fields is not None and "username" not in update_fields):
+        return
+
+    try:
+        previous = sender.objects.filter(pk=instance.pk).values_list("username", flat=True).first()
+    except Exception as e:
+        log.exception(e)
+        return
+
+    if previous and previous != instance.username:
+        setattr(instance, PREVIOUS_USERNAME_ATTRIBUTE, previous)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_principal(sender, instance, created=False, update_fields=None, **kwargs):
+
+    # e.g. last_login updates, and new users have nothing cached yet
+    if created or update_fields is not None and not USER_FIELDS.intersection(update_fields):
+        return
+
+    invalidate_on_commit(instance.username, instance.__dict__.pop(PREVIOUS_USERNAME_ATTRIBUTE, None))
@@ -1,8 +1,15 @@
 import redis
+import redis.asyncio
+import asyncio
 from django.conf import settings
 import logging
 from django.utils import timezone
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from rest_framework.utils import encoders
 
 django_log = logging.getLogger("django")
 
@@ -13,6 +20,47 @@ conn_udhaar = redis.Redis(
     host=settings.REDIS_UDHAAR_HOST, db=settings.REDIS_UDHAAR_DB, charset="utf-8", decode_responses=True)
 
 
+_async_clients = {}
+
+
+def async_client(name):
+    """
+    redis.asyncio twin of conn ("conn") or conn_udhaar ("udhaar") for async
+    views. Clients bind their connections to the running event loop, so one
+    is kept per loop.
+    """
+    
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get((name, loop))
+    
+    if client is None:
+        if name == "udhaar":
+            client = redis.asyncio.Redis(
+                host=settings.REDIS_UDHAAR_HOST, db=settings.REDIS_UDHAAR_DB,
+                encoding="utf-8", decode_responses=True)
+        else:
+            client = redis.asyncio.Redis(
+                host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+        
+        for key in [key for key in _async_clients if key[1].is_closed()]:
+            del _async_clients[key]
+        
+        _async_clients[(name, loop)] = client
+    
+    return client
+
+
+def render_json(obj):
+    """JSON text exactly as DRF's JSONRenderer writes it with the default settings."""
+    
+    ret = json.dumps(
+        obj, cls=encoders.JSONEncoder, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    )
+    
+    # U+2028 and U+2029 are valid JSON but not valid javascript, escaped as DRF does
+    return ret.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+
+
 def get_redis_list_name(phone_number):
     return settings.ENV+phone_number+'TRANSACTIONS'
 
@@ -28,10 +76,176 @@ def update_redis_head(phone_number,id):
     except Exception as e:
         django_log.exception(e)
         
+class WalletLocalCache:
+    """
+    Per-process copy of wallet sections keyed by (section, version, kind),
+    the version being the section's wallet_timestamps stamp. A new stamp
+    makes the old entry unreachable, entries also expire after
+    WALLET_L1_TTL seconds and at most WALLET_L1_MAX_ENTRIES are kept.
+    Values are shared between requests and must not be mutated.
+    
+    With WALLET_L1_PUBSUB a listener thread drops entries as soon as a
+    stamp is published, and lookups skip the per-request stamp read.
+    """
+    
+    CHANNEL = "wallet_cache_invalidations"
+    
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+        self.listener = None
+        self.pid = None
+    
+    @property
+    def ttl(self):
+        return getattr(settings, "WALLET_L1_TTL", 300)
+    
+    @property
+    def max_entries(self):
+        return getattr(settings, "WALLET_L1_MAX_ENTRIES", 64)
+    
+    @property
+    def enabled(self):
+        return getattr(settings, "WALLET_L1_ENABLED", True)
+    
+    @property
+    def subscribed(self):
+        
+        if not getattr(settings, "WALLET_L1_PUBSUB", False):
+            return False
+        
+        self.ensure_listening()
+        
+        return self.listener is not None and self.listener.is_alive()
+    
+    def get(self, type, version=None, kind="value"):
+        """
+        Cached entry of the section, the latest one when version is None.
+        kind tells apart the forms a section is kept in (decoded, rendered).
+        """
+        
+        now = time.monotonic()
+        
+        with self.lock:
+            
+            for key in reversed(self.entries):
+                
+                if key[0] != type or key[2] != kind or (version is not None and key[1] != version):
+                    continue
+                
+                expires_at, value = self.entries[key]
+                
+                if expires_at < now:
+                    del self.entries[key]
+                    return None
+                
+                self.entries.move_to_end(key)
+                return value
+        
+        return None
+    
+    def generation(self, type):
+        return (self.epoch, self.generations.get(type, 0))
+    
+    def set(self, type, version, value, generation=None, kind="value"):
+        """Stores the value unless the section was invalidated since generation was read."""
+        
+        with self.lock:
+            
+            if generation is not None and generation != self.generation(type):
+                return
+            
+            stale = [
+                key for key in self.entries
+                if key[0] == type and (key[1] != version or key[2] == kind)
+            ]
+            
+            for key in stale:
+                del self.entries[key]
+            
+            self.entries[(type, version, kind)] = (time.monotonic() + self.ttl, value)
+            
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def drop(self, type=None):
+        
+        with self.lock:
+            
+            for key in [key for key in self.entries if type is None or key[0] == type]:
+                del self.entries[key]
+            
+            if type is None:
+                self.epoch += 1
+            else:
+                self.generations[type] = self.generations.get(type, 0) + 1
+    
+    def publish(self, type):
+        try:
+            conn_udhaar.publish(self.CHANNEL, type)
+        except Exception as e:
+            django_log.warning("Wallet cache invalidation not published: %s" % e)
+    
+    def ensure_listening(self):
+        
+        if self.listener is not None and self.pid == os.getpid() and self.listener.is_alive():
+            return
+        
+        with self.lock:
+            
+            if self.listener is not None and self.pid == os.getpid() and self.listener.is_alive():
+                return
+            
+            # entries read before the listener started may have missed a stamp
+            self.entries.clear()
+            self.epoch += 1
+            self.pid = os.getpid()
+            self.listener = threading.Thread(
+                target=self.listen, name="wallet-cache-invalidations", daemon=True
+            )
+            self.listener.start()
+    
+    def listen(self):
+        
+        try:
+            pubsub = conn_udhaar.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.CHANNEL)
+            
+            for message in pubsub.listen():
+                self.drop(message["data"])
+                
+        except Exception as e:
+            django_log.warning("Wallet cache invalidation listener stopped: %s" % e)
+        
+        self.drop()
+
+
 class RedisWalletCache:
     
     TIMESTAMP_HASH_KEY = "wallet_timestamps"
     CACHE_HASH_KEY = "wallet_cache"
+    STALE_HASH_KEY = "wallet_cache_stale"
+    
+    # keeps the cleared value as the stale copy served while it is rebuilt
+    CLEAR_SCRIPT = """
+    local value = redis.call("hget", KEYS[1], ARGV[1])
+    if value and value ~= "" then
+        redis.call("hset", KEYS[2], ARGV[1], value)
+    end
+    redis.call("hset", KEYS[1], ARGV[1], "")
+    """
+    
+    # stores the section only while its stamp is the one read before the build
+    SET_IF_STAMP_SCRIPT = """
+    local stamp = redis.call("hget", KEYS[1], ARGV[1]) or ""
+    if stamp ~= ARGV[2] then
+        return 0
+    end
+    redis.call("hset", KEYS[2], ARGV[1], ARGV[3])
+    return 1
+    """
     
     WALLET_CACHE_IDENTIFIERS = [
         "telcos",
@@ -39,6 +253,11 @@ class RedisWalletCache:
         "vouchers"
     ]
     
+    def __init__(self):
+        self.local = WalletLocalCache()
+        self._clear = conn_udhaar.register_script(self.CLEAR_SCRIPT)
+        self._set_if_stamp = conn_udhaar.register_script(self.SET_IF_STAMP_SCRIPT)
+    
     def reset(self):
         
         timestamp_now = int(round(timezone.now().timestamp() * 1000))
@@ -47,36 +266,126 @@ class RedisWalletCache:
             key : timestamp_now for key in self.WALLET_CACHE_IDENTIFIERS
         }
         
-        WALLET_CACHE = {
-            key : "" for key in self.WALLET_CACHE_IDENTIFIERS if key != "telcos"
-        }
+        for key in self.WALLET_CACHE_IDENTIFIERS:
+            self.clear_value(key)
         
         conn_udhaar.hmset(self.TIMESTAMP_HASH_KEY, TIMESTAMPS)
-        conn_udhaar.hmset(self.CACHE_HASH_KEY, WALLET_CACHE)
+        
+        self.local.drop()
+        
+        for key in self.WALLET_CACHE_IDENTIFIERS:
+            self.local.publish(key)
         
     def set_value(self, type, obj):
         
         if type == "telcos":
             return
         
-        conn_udhaar.hset(self.CACHE_HASH_KEY, type, json.dumps(obj))
+        conn_udhaar.hset(self.CACHE_HASH_KEY, type, render_json(obj))
+    
+    def set_value_if_stamp(self, type, obj, timestamp):
+        """
+        set_value() in one step with checking that the section's stamp is
+        still timestamp (None for no stamp), False when it moved.
+        """
+        
+        if type == "telcos":
+            return False
+        
+        stored = self._set_if_stamp(
+            keys=[self.TIMESTAMP_HASH_KEY, self.CACHE_HASH_KEY],
+            args=[type, "" if timestamp is None else timestamp, render_json(obj)]
+        )
+        
+        return bool(stored)
         
     def clear_value(self, type):
         
         if type == "telcos":
             return
         
-        conn_udhaar.hset(self.CACHE_HASH_KEY, type, "")
+        self._clear(keys=[self.CACHE_HASH_KEY, self.STALE_HASH_KEY], args=[type])
     
     def update_timestamp(self, type):
         timestamp_now = int(round(timezone.now().timestamp() * 1000))
         conn_udhaar.hset(self.TIMESTAMP_HASH_KEY, type, timestamp_now)
         
+        self.local.drop(type)
+        self.local.publish(type)
+        
     def clear_and_update_timestamp(self, type):
         self.clear_value(type)
         self.update_timestamp(type)
         
-    def get_value(self, type):
+    def get_timestamps(self, types=None):
+        """Section -> last change timestamp (ms), None for sections never stamped."""
+        
+        types = list(types or self.WALLET_CACHE_IDENTIFIERS)
+        values = conn_udhaar.hmget(self.TIMESTAMP_HASH_KEY, types)
+        
+        return {
+            key : int(value) if value else None for key, value in zip(types, values)
+        }
+        
+    async def aget_timestamps(self, types=None):
+        """get_timestamps() on the async client."""
+        
+        types = list(types or self.WALLET_CACHE_IDENTIFIERS)
+        values = await async_client("udhaar").hmget(self.TIMESTAMP_HASH_KEY, types)
+        
+        return {
+            key : int(value) if value else None for key, value in zip(types, values)
+        }
+        
+    def get_timestamp(self, type):
+        value = conn_udhaar.hget(self.TIMESTAMP_HASH_KEY, type)
+        return int(value) if value else None
+    
+    def cached(self, type, timestamp, kind, load):
+        """
+        load() through the process cache while the section's stamp is
+        unchanged. Pass the stamp when it was already read for this request.
+        """
+        
+        if not self.local.enabled:
+            return load(type)
+        
+        generation = self.local.generation(type)
+        
+        if timestamp is None and self.local.subscribed:
+            value = self.local.get(type, kind=kind)
+            if value is not None:
+                return value
+        
+        if timestamp is None:
+            timestamp = self.get_timestamp(type)
+        
+        if timestamp is None:
+            return load(type)
+        
+        value = self.local.get(type, timestamp, kind)
+        
+        if value is not None:
+            return value
+        
+        value = load(type)
+        
+        # the section is cleared before its stamp moves, so a value read
+        # after the stamp is never older than the stamp
+        if value is not None:
+            self.local.set(type, timestamp, value, generation, kind)
+        
+        return value
+    
+    def get_value(self, type, timestamp=None):
+        """Decoded section."""
+        return self.cached(type, timestamp, "value", self.load_value)
+    
+    def get_rendered(self, type, timestamp=None):
+        """Section as the JSON bytes set_value stored, for splicing into responses."""
+        return self.cached(type, timestamp, "rendered", self.load_rendered)
+    
+    def load_value(self, type):
         
         value = conn_udhaar.hget(self.CACHE_HASH_KEY, type)
         
@@ -84,5 +393,24 @@ class RedisWalletCache:
             return json.loads(value)
         
         return None
+    
+    def get_stale_value(self, type):
+        """Last value cleared from the section, served while it is rebuilt."""
+        
+        value = conn_udhaar.hget(self.STALE_HASH_KEY, type)
+        
+        if value:
+            return json.loads(value)
+        
+        return None
+    
+    def load_rendered(self, type):
+        
+        value = conn_udhaar.hget(self.CACHE_HASH_KEY, type)
+        
+        if value:
+            return value.encode("utf-8")
+        
+        return None
 
 rds_cache = RedisWalletCache()
\ No newline at end of file
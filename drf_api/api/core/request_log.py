@@ -0,0 +1,218 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from core.models import RequestLog
+from core.ids import id_allocator
+
+log = logging.getLogger("django")
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FLUSH_INTERVAL_MS = 200
+DEFAULT_PUT_TIMEOUT_MS = 20
+
+SPILL_FILE_PATTERN = "request_log_spill.*.ndjson"
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class RequestLogWriter:
+    """
+    Writes RequestLog rows off the request path.
+
+    submit() assigns a pre-reserved id and queues the row, a flusher thread
+    bulk inserts every REQUEST_LOG_BATCH_SIZE rows or REQUEST_LOG_FLUSH_INTERVAL_MS.
+    When the queue is full the caller waits up to REQUEST_LOG_PUT_TIMEOUT_MS
+    and then writes its own row, so a stalled database slows requests down
+    instead of growing memory. Rows that cannot be written are spilled as
+    NDJSON under LOGS_FOLDER_NAME and replayed when a writer starts.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=_setting("REQUEST_LOG_QUEUE_SIZE", DEFAULT_QUEUE_SIZE))
+        self.batch_size = _setting("REQUEST_LOG_BATCH_SIZE", DEFAULT_BATCH_SIZE)
+        self.flush_interval = _setting("REQUEST_LOG_FLUSH_INTERVAL_MS", DEFAULT_FLUSH_INTERVAL_MS) / 1000.0
+        self.put_timeout = _setting("REQUEST_LOG_PUT_TIMEOUT_MS", DEFAULT_PUT_TIMEOUT_MS) / 1000.0
+        self.ids = id_allocator(RequestLog)
+        self.thread = None
+        self.pid = None
+        self.stopping = threading.Event()
+        self.start_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return _setting("REQUEST_LOG_ASYNC", True) and self.ids.supported()
+
+    @property
+    def spill_path(self):
+        return os.path.join(
+            settings.LOGS_FOLDER_NAME, SPILL_FILE_PATTERN.replace("*", str(os.getpid()))
+        )
+
+    def ensure_started(self):
+
+        if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+            return
+
+        with self.start_lock:
+
+            if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+                return
+
+            if self.pid != os.getpid():
+                # the parent's queue and thread do not survive a fork
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+
+            self.pid = os.getpid()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name="request-log-writer", daemon=True)
+            self.thread.start()
+
+    def submit(self, user, request_data, response_data):
+        """Queues a RequestLog row and returns its id."""
+
+        if not self.enabled:
+            return RequestLog.objects.create(
+                user=user, request_data=request_data, response_data=response_data
+            ).id
+
+        entry = RequestLog(
+            id=self.ids.next_id(),
+            user_id=user.id,
+            request_data=request_data,
+            response_data=response_data,
+            created_at=timezone.now()
+        )
+
+        self.ensure_started()
+
+        try:
+            self.queue.put(entry, timeout=self.put_timeout)
+        except queue.Full:
+            log.warning("RequestLog queue full, writing inline")
+            self.write([entry])
+
+        return entry.id
+
+    def _drain(self, batch=None):
+
+        batch = batch if batch is not None else []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+
+        self.replay_spills()
+
+        while not self.stopping.is_set():
+
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            batch = self._drain([first])
+
+            while len(batch) < self.batch_size and time.monotonic() < deadline:
+                time.sleep(min(0.01, max(deadline - time.monotonic(), 0)))
+                self._drain(batch)
+
+            self.write(batch)
+
+        close_old_connections()
+
+    def write(self, batch):
+
+        if not batch:
+            return
+
+        try:
+            RequestLog.objects.bulk_create(batch, batch_size=self.batch_size)
+        except Exception as e:
+            log.exception(e)
+            close_old_connections()
+            self.spill(batch)
+
+    def spill(self, batch):
+        try:
+            with open(self.spill_path, "a") as f:
+                for entry in batch:
+                    f.write(json.dumps({
+                        "id" : entry.id,
+                        "user_id" : entry.user_id,
+                        "request_data" : entry.request_data,
+                        "response_data" : entry.response_data,
+                        "created_at" : entry.created_at.isoformat()
+                    }, default=str) + "\n")
+        except Exception as e:
+            log.exception(e)
+
+    def replay_spills(self):
+        """Inserts rows spilled by any worker, claiming each file by renaming it."""
+
+        for path in glob.glob(os.path.join(settings.LOGS_FOLDER_NAME, SPILL_FILE_PATTERN)):
+
+            claimed = "%s.replaying.%s" % (path, os.getpid())
+
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+
+            try:
+                with open(claimed) as f:
+                    entries = [json.loads(line) for line in f if line.strip()]
+
+                RequestLog.objects.bulk_create([
+                    RequestLog(
+                        id=entry["id"],
+                        user_id=entry["user_id"],
+                        request_data=entry["request_data"],
+                        response_data=entry["response_data"],
+                        created_at=entry["created_at"]
+                    ) for entry in entries
+                ], batch_size=self.batch_size, ignore_conflicts=True)
+
+                os.remove(claimed)
+                log.info("Replayed %s spilled RequestLog rows" % len(entries))
+
+            except Exception as e:
+                log.exception(e)
+                os.rename(claimed, path)
+
+    def close(self):
+        """Flushes what is queued, on interpreter exit."""
+
+        if self.thread is None or self.pid != os.getpid():
+            return
+
+        self.stopping.set()
+        self.thread.join(timeout=5)
+
+        batch = self._drain()
+
+        while batch:
+            self.write(batch)
+            batch = self._drain()
+
+
+request_log_writer = RequestLogWriter()
+
+atexit.register(request_log_writer.close)
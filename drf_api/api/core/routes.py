@@ -0,0 +1,240 @@
+import logging
+from functools import lru_cache
+from django.conf import settings
+from django.conf.urls import url
+from django.urls import get_resolver, Resolver404, URLPattern, URLResolver
+
+log = logging.getLogger("django")
+
+ROUTE_POLICY_KWARG = "route_policy"
+
+
+class RoutePolicy:
+    """
+    Declarative per-route behaviour shared by the core middlewares.
+
+    lock (bool):
+        Serialize requests per merchant (SyncLockMiddleware).
+    lock_key_fields (tuple):
+        Payload fields tried in order to build the lock key.
+    lock_methods (tuple or None):
+        Methods the lock applies to, None for every method.
+    lock_exempt_methods (tuple):
+        Methods that skip the lock even when lock_methods allows them.
+    lock_backend (str or None):
+        Name of the core.locks backend, None for settings.SYNC_LOCK_BACKEND.
+    lock_wait_ms (int or None):
+        How long a request may queue for a held lock before the 429,
+        0 rejects immediately, None for settings.SYNC_LOCK_WAIT_MS.
+    lock_max_waiters (int or None):
+        Most requests allowed to queue on the same key, None for
+        settings.SYNC_LOCK_MAX_WAITERS (no bound when that is None too).
+    ip_security (str or None):
+        IP group checked by IPBlockingMiddleware, "disabled" to skip.
+        None blocks every caller.
+    auth (bool or None):
+        Secret key authentication in UdhaarAuthenticationMiddleware,
+        None leaves the route to the view.
+    """
+
+    def __init__(
+        self,
+        lock=True,
+        lock_key_fields=("phone_number", "username"),
+        lock_methods=None,
+        lock_exempt_methods=(),
+        lock_backend=None,
+        lock_wait_ms=None,
+        lock_max_waiters=None,
+        ip_security=None,
+        auth=None
+    ):
+        self.lock = lock
+        self.lock_key_fields = tuple(lock_key_fields)
+        self.lock_methods = frozenset(lock_methods) if lock_methods else None
+        self.lock_exempt_methods = frozenset(lock_exempt_methods)
+        self.lock_backend = lock_backend
+        self.lock_wait_ms = lock_wait_ms
+        self.lock_max_waiters = lock_max_waiters
+        self.ip_security = ip_security
+        self.auth = auth
+        self.name = None
+
+    def locks(self, method):
+        if not self.lock or method in self.lock_exempt_methods:
+            return False
+        return self.lock_methods is None or method in self.lock_methods
+
+    @property
+    def wait_ms(self):
+        if self.lock_wait_ms is None:
+            return getattr(settings, "SYNC_LOCK_WAIT_MS", 0)
+        return self.lock_wait_ms
+
+    @property
+    def max_waiters(self):
+        if self.lock_max_waiters is None:
+            return getattr(settings, "SYNC_LOCK_MAX_WAITERS", None)
+        return self.lock_max_waiters
+
+    def lock_key(self, data):
+        for field in self.lock_key_fields:
+            value = data.get(field)
+            if value:
+                return value
+        return None
+
+    def replace(self, **changes):
+        kwargs = {
+            "lock" : self.lock,
+            "lock_key_fields" : self.lock_key_fields,
+            "lock_methods" : self.lock_methods,
+            "lock_exempt_methods" : self.lock_exempt_methods,
+            "lock_backend" : self.lock_backend,
+            "lock_wait_ms" : self.lock_wait_ms,
+            "lock_max_waiters" : self.lock_max_waiters,
+            "ip_security" : self.ip_security,
+            "auth" : self.auth,
+        }
+        kwargs.update(changes)
+        return RoutePolicy(**kwargs)
+
+    def __repr__(self):
+        return "RoutePolicy(lock=%s, ip_security=%s, auth=%s)" % (
+            self.lock, self.ip_security, self.auth
+        )
+
+
+DEFAULT_POLICY = RoutePolicy()
+
+UNLOCKED = RoutePolicy(lock=False)
+
+
+# Routes served by other url confs of the deployment, matched by path fragment
+# the first time a path is seen. Order matters, the first match wins.
+LEGACY_PATH_POLICIES = (
+    ('/admin/', RoutePolicy(lock=False, ip_security="disabled")),
+    ('/media/', RoutePolicy(lock=False, ip_security="disabled")),
+    ('bills/billpay/', RoutePolicy(lock_methods=("POST",))),
+    ('api/sendmoney/v3/', RoutePolicy(lock_methods=("POST",))),
+    ('sharereward', UNLOCKED),
+    ('/payments/deposit_funds_to_merchant/', UNLOCKED),
+    ('/payments/send_money_to_supplier/', UNLOCKED),
+    ('agent/creditaccount/', UNLOCKED),
+    ('agent/merchanttransactions/', UNLOCKED),
+    ('loyalty/balance/', UNLOCKED),
+    ('/oscar-wallet/', UNLOCKED),
+    ('merchant/list/telcos/', RoutePolicy(lock_exempt_methods=("POST",))),
+    ('available/telcos/', RoutePolicy(lock_exempt_methods=("GET",))),
+    ('recharge/v2/', RoutePolicy(lock_exempt_methods=("GET",))),
+    ('deposit/v2/', RoutePolicy(lock_exempt_methods=("GET",))),
+    ('/loan/agreement/', RoutePolicy(lock_exempt_methods=("GET",))),
+)
+
+
+def route(regex, view, name, **policy):
+    """
+    url() with a RoutePolicy attached. The policy travels in the pattern's
+    default kwargs so the registry can compile it when the url conf loads.
+    """
+    policy = RoutePolicy(**policy)
+    policy.name = name
+    return url(regex, view, {ROUTE_POLICY_KWARG: policy}, name=name)
+
+
+class RoutePolicyRegistry:
+    """
+    Policies of every named route, compiled once from the url conf into a
+    dict keyed by url name so middlewares do a single lookup per request.
+    """
+
+    def __init__(self):
+        self.policies = None
+
+    def _walk(self, patterns, policies):
+
+        for pattern in patterns:
+
+            if isinstance(pattern, URLResolver):
+                self._walk(pattern.url_patterns, policies)
+
+            elif isinstance(pattern, URLPattern):
+                policy = pattern.default_args.get(ROUTE_POLICY_KWARG)
+
+                if policy is None or not pattern.name:
+                    continue
+
+                if pattern.name in policies:
+                    log.warning("Duplicate route policy for %s" % pattern.name)
+
+                policy.name = policy.name or pattern.name
+                policies[pattern.name] = policy
+
+    def compile(self):
+        policies = {}
+        self._walk(get_resolver().url_patterns, policies)
+        self.policies = policies
+        self.for_path.cache_clear()
+        return policies
+
+    def get(self, url_name):
+        if self.policies is None:
+            self.compile()
+        return self.policies.get(url_name)
+
+    @lru_cache(maxsize=2048)
+    def for_path(self, path):
+        """Policy for a path before the handler resolves it, memoized per path."""
+
+        try:
+            match = get_resolver().resolve(path)
+        except Resolver404:
+            match = None
+
+        kwargs = {}
+
+        if match is not None:
+            policy = match.kwargs.get(ROUTE_POLICY_KWARG) or self.get(match.url_name)
+            if policy is not None:
+                return policy
+            kwargs = match.kwargs
+
+        policy = DEFAULT_POLICY
+
+        for fragment, fragment_policy in LEGACY_PATH_POLICIES:
+            if fragment in path:
+                policy = fragment_policy
+                break
+
+        # url confs still declaring {'auth': ..., 'ip_security': ...} kwargs
+        changes = {key: kwargs[key] for key in ("auth", "ip_security") if key in kwargs}
+
+        if changes:
+            policy = policy.replace(**changes)
+
+        return policy
+
+    def for_request(self, request):
+        """
+        Policy of the request, resolved once and cached on the request.
+        Uses the resolver match when the handler has already resolved the url.
+        """
+
+        policy = getattr(request, "_route_policy", None)
+
+        if policy is not None:
+            return policy
+
+        match = getattr(request, "resolver_match", None)
+
+        if match is not None and match.url_name:
+            policy = self.get(match.url_name)
+
+        if policy is None:
+            policy = self.for_path(request.path_info)
+
+        request._route_policy = policy
+        return policy
+
+
+route_policies = RoutePolicyRegistry()
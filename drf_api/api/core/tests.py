@@ -1,3 +1,2003 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import itertools
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
+import requests
+from asgiref.sync import async_to_sync
+from django.db import connections
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteWrapper
+from django.http import HttpResponse
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from pymongo.errors import OperationFailure
+from rest_framework.exceptions import NotAuthenticated, ParseError
+from rest_framework.request import Request
+from rest_framework.response import Response
+from core import http, outbox
+from core.aio import DualModeMiddleware
+from core.allowlist import AllowlistEngine, IPAllowlist, VERSION_KEY
+from core.businesses import BusinessResolver
+from core.checks import outbox_lease_check
+from core.decorators import log_request_response
+from core.fakes import DownRedis, FakeRedis
+from core.fanout import _run
+from core.idempotency import IdempotencyStore, idempotent
+from core.ids import BlockIdAllocator, id_allocator
+from core.locks import (
+    ADVISORY, Lease, LockAttempt, LockBackend, LockUnavailable, RedisLeaseLockBackend, REDIS,
+    REJECTED_BUSY, REJECTED_QUEUE_FULL, REJECTED_TIMEOUT, REJECTED_UNAVAILABLE, WaiterQueue
+)
+from core.middleware import SyncLockMiddleware
+from core.models import OutboxEvent, RequestLog, UserToken
+from core.principal import PrincipalResolver, secret_digest
+from core.payload import CachedJSONParser, RequestPayloadMiddleware, get_payload
+from core.redis_ops import RedisWalletCache, WalletLocalCache
+from core.request_log import RequestLogWriter
+from core.routes import DEFAULT_POLICY, RoutePolicy, RoutePolicyRegistry, UNLOCKED
+from core import tokens
+from core.tokens import ExpiredToken, InvalidToken, RevocationSet, sign_token, verify_token
+from core.views import AsyncAPIView, TokenGenerationView
+from merchant.models import Merchant
 
-# Create your tests here.
+
+class RecordingMiddleware(DualModeMiddleware):
+
+    def handle(self, request):
+        request.seen_by = "handle"
+        return self.get_response(request)
+
+    async def ahandle(self, request):
+        request.seen_by = "ahandle"
+        return await self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        return None
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        return None
+
+
+class DualModeMiddlewareTest(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_sync_chain_runs_handle(self):
+
+        middleware = RecordingMiddleware(lambda request: HttpResponse("ok"))
+        request = self.factory.get("/")
+
+        response = middleware(request)
+
+        self.assertFalse(asyncio.iscoroutinefunction(middleware))
+        self.assertEqual(response.content, b"ok")
+        self.assertEqual(request.seen_by, "handle")
+
+    def test_async_chain_runs_ahandle(self):
+
+        async def get_response(request):
+            return HttpResponse("ok")
+
+        middleware = RecordingMiddleware(get_response)
+        request = self.factory.get("/")
+
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertEqual(middleware.process_view, middleware.aprocess_view)
+
+        response = async_to_sync(middleware)(request)
+
+        self.assertEqual(response.content, b"ok")
+        self.assertEqual(request.seen_by, "ahandle")
+
+
+class EchoView(AsyncAPIView):
+
+    greeting = "hello"
+
+    async def get(self, request, name):
+        return self.respond({"message" : "%s %s" % (self.greeting, name)})
+
+
+class DeniedView(AsyncAPIView):
+
+    async def initial(self, request):
+        raise NotAuthenticated()
+
+
+class AsyncAPIViewTest(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_as_view_returns_csrf_exempt_coroutine_function(self):
+
+        view = EchoView.as_view(greeting="salaam")
+
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        self.assertTrue(view.csrf_exempt)
+        self.assertIs(view.view_class, EchoView)
+
+        response = async_to_sync(view)(self.factory.get("/"), name="ali")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"message" : "salaam ali"})
+
+    def test_as_view_rejects_unknown_keywords(self):
+        with self.assertRaises(TypeError):
+            EchoView.as_view(colour="red")
+
+    def test_method_not_allowed(self):
+        response = async_to_sync(EchoView.as_view())(self.factory.post("/"), name="ali")
+        self.assertEqual(response.status_code, 405)
+
+    def test_api_exception_becomes_json_response(self):
+
+        response = async_to_sync(DeniedView.as_view())(self.factory.get("/"))
+
+        self.assertEqual(response.status_code, 403)
+        self.assertIn("detail", json.loads(response.content))
+
+
+class SyncLockMiddlewareAsyncTest(SimpleTestCase):
+
+    def setUp(self):
+
+        self.factory = RequestFactory()
+
+        self.policy = mock.Mock(
+            wait_ms=0, max_waiters=None, lock_backend=REDIS
+        )
+        self.policy.name = "credit"
+        self.policy.locks.return_value = True
+        self.policy.lock_key.return_value = "merchant:1"
+
+        self.backend = mock.Mock()
+        self.backend.name = REDIS
+
+        patches = [
+            mock.patch("core.middleware.route_policies.for_request", return_value=self.policy),
+            mock.patch("core.middleware.get_lock_backend", return_value=self.backend),
+        ]
+
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def middleware(self, calls):
+
+        async def get_response(request):
+            calls.append(request.method)
+            return HttpResponse("ok")
+
+        return SyncLockMiddleware(get_response)
+
+    def request(self):
+        return self.factory.post("/", data=json.dumps({"id" : 1}), content_type="application/json")
+
+    def test_acquires_runs_and_releases(self):
+
+        lease = Lease("merchant:1", "7")
+        self.backend.acquire.return_value = LockAttempt(lease=lease)
+        calls = []
+
+        response = async_to_sync(self.middleware(calls))(self.request())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, ["POST"])
+        self.backend.acquire.assert_called_once_with("merchant:1", 0, None)
+        self.backend.release.assert_called_once_with(lease)
+
+    def test_busy_lock_is_rejected_without_release(self):
+
+        self.backend.acquire.return_value = LockAttempt(rejected_reason=REJECTED_BUSY)
+        calls = []
+
+        response = async_to_sync(self.middleware(calls))(self.request())
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(calls, [])
+        self.backend.release.assert_not_called()
+
+    def test_release_runs_when_the_view_fails(self):
+
+        lease = Lease("merchant:1", "8")
+        self.backend.acquire.return_value = LockAttempt(lease=lease)
+
+        async def get_response(request):
+            raise RuntimeError("view failed")
+
+        with self.assertRaises(RuntimeError):
+            async_to_sync(SyncLockMiddleware(get_response))(self.request())
+
+        self.backend.release.assert_called_once_with(lease)
+
+    def test_unlocked_route_passes_through(self):
+
+        self.policy.locks.return_value = False
+
+        async def get_response(request):
+            return HttpResponse("ok")
+
+        response = async_to_sync(SyncLockMiddleware(get_response))(self.request())
+
+        self.assertEqual(response.status_code, 200)
+        self.backend.acquire.assert_not_called()
+
+
+class RedisLeaseLockBackendTest(SimpleTestCase):
+
+    def setUp(self):
+
+        self.client = FakeRedis()
+        self.backend = RedisLeaseLockBackend(self.client, lease_ms=5000)
+
+        def release(keys, args):
+            if self.client.get(keys[0]) != args[0].encode():
+                return 0
+            return self.client.delete(keys[0])
+
+        self.client.scripts[RedisLeaseLockBackend.RELEASE_SCRIPT].side_effect = release
+
+    def test_lease_is_exclusive_until_released(self):
+
+        lease = self.backend.try_acquire("merchant:1")
+
+        self.assertIsNotNone(lease)
+        self.assertEqual(self.client.expiry[self.backend.redis_key("merchant:1")], 5)
+        self.assertIsNone(self.backend.try_acquire("merchant:1"))
+        self.assertIsNotNone(self.backend.try_acquire("merchant:2"))
+
+        self.backend.release(lease)
+        self.assertIsNotNone(self.backend.try_acquire("merchant:1"))
+
+    def test_release_of_an_expired_lease_keeps_the_new_holder(self):
+
+        lease = self.backend.try_acquire("merchant:1")
+
+        # the lease ran out and another worker took the key
+        self.client.delete(self.backend.redis_key("merchant:1"))
+        self.backend.try_acquire("merchant:1")
+
+        with self.assertLogs("django", "WARNING"):
+            self.backend.release(lease)
+
+        self.assertIsNone(self.backend.try_acquire("merchant:1"))
+
+    def test_redis_error_is_lock_unavailable(self):
+
+        self.backend.client = DownRedis()
+
+        with self.assertRaises(LockUnavailable):
+            self.backend.try_acquire("merchant:1")
+
+        with self.assertRaises(LockUnavailable):
+            self.backend.acquire("merchant:1", 100)
+
+
+class SyncLockMiddlewareTest(SimpleTestCase):
+
+    def setUp(self):
+
+        self.factory = RequestFactory()
+
+        self.policy = mock.Mock(wait_ms=0, max_waiters=None, lock_backend=REDIS)
+        self.policy.name = "credit"
+        self.policy.locks.return_value = True
+        self.policy.lock_key.return_value = "merchant:1"
+
+        self.backends = {}
+
+        for name in (REDIS, ADVISORY):
+            self.backends[name] = mock.Mock()
+            self.backends[name].name = name
+
+        patches = [
+            mock.patch("core.middleware.route_policies.for_request", return_value=self.policy),
+            mock.patch("core.middleware.get_lock_backend", side_effect=self.backends.get),
+        ]
+
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.calls = []
+
+    def get_response(self, request):
+        self.calls.append(request.method)
+        return HttpResponse("ok")
+
+    def request(self):
+        return self.factory.post("/", data=json.dumps({"id" : 1}), content_type="application/json")
+
+    def test_acquires_runs_and_releases(self):
+
+        lease = Lease("merchant:1", "a")
+        self.backends[REDIS].acquire.return_value = LockAttempt(lease=lease)
+
+        response = SyncLockMiddleware(self.get_response)(self.request())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.calls, ["POST"])
+        self.backends[REDIS].acquire.assert_called_once_with("merchant:1", 0, None)
+        self.backends[REDIS].release.assert_called_once_with(lease)
+
+    def test_busy_lock_is_rejected(self):
+
+        self.backends[REDIS].acquire.return_value = LockAttempt(rejected_reason=REJECTED_BUSY)
+
+        response = SyncLockMiddleware(self.get_response)(self.request())
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.calls, [])
+        self.backends[REDIS].release.assert_not_called()
+
+    def test_release_runs_when_the_view_fails(self):
+
+        lease = Lease("merchant:1", "a")
+        self.backends[REDIS].acquire.return_value = LockAttempt(lease=lease)
+
+        def failing(request):
+            raise RuntimeError("view failed")
+
+        with self.assertRaises(RuntimeError):
+            SyncLockMiddleware(failing)(self.request())
+
+        self.backends[REDIS].release.assert_called_once_with(lease)
+
+    def test_unavailable_redis_falls_back_to_the_advisory_lock(self):
+
+        lease = Lease("merchant:1")
+        self.backends[REDIS].acquire.side_effect = LockUnavailable("redis down")
+        self.backends[ADVISORY].acquire.return_value = LockAttempt(lease=lease)
+
+        with self.assertLogs("django", "WARNING"):
+            response = SyncLockMiddleware(self.get_response)(self.request())
+
+        self.assertEqual(response.status_code, 200)
+        self.backends[ADVISORY].release.assert_called_once_with(lease)
+        self.backends[REDIS].release.assert_not_called()
+
+    def test_unavailable_redis_without_fallback_is_rejected(self):
+
+        self.backends[REDIS].acquire.side_effect = LockUnavailable("redis down")
+
+        with self.settings(SYNC_LOCK_FALLBACK_BACKEND=None), self.assertLogs("django", "WARNING"):
+            with mock.patch("core.middleware.SYNC_LOCK_REJECTIONS") as rejections:
+                response = SyncLockMiddleware(self.get_response)(self.request())
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.calls, [])
+        rejections.labels.assert_called_once_with("credit", REJECTED_UNAVAILABLE)
+
+    def test_async_chain_falls_back_too(self):
+
+        lease = Lease("merchant:1")
+        self.backends[REDIS].acquire.side_effect = LockUnavailable("redis down")
+        self.backends[ADVISORY].acquire.return_value = LockAttempt(lease=lease)
+
+        async def get_response(request):
+            return HttpResponse("ok")
+
+        with self.assertLogs("django", "WARNING"):
+            response = async_to_sync(SyncLockMiddleware(get_response))(self.request())
+
+        self.assertEqual(response.status_code, 200)
+        self.backends[ADVISORY].release.assert_called_once_with(lease)
+
+
+class CountdownLockBackend(LockBackend):
+    """Busy for the first busy_attempts tries, free afterwards."""
+
+    name = "countdown"
+
+    def __init__(self, busy_attempts, client):
+        self.busy_attempts = busy_attempts
+        self.attempts = 0
+        self.waiters = WaiterQueue(client)
+
+    def try_acquire(self, key):
+        self.attempts += 1
+        if self.attempts > self.busy_attempts:
+            return Lease(key)
+        return None
+
+    def release(self, lease):
+        pass
+
+
+class LockWaitTest(SimpleTestCase):
+
+    def setUp(self):
+        self.client = FakeRedis()
+
+    def waiters(self, backend):
+        return int(self.client.get(backend.waiters.redis_key("merchant:1")) or 0)
+
+    def test_lock_freed_within_the_wait_is_acquired(self):
+
+        backend = CountdownLockBackend(2, self.client)
+
+        attempt = backend.acquire("merchant:1", wait_ms=1000, max_waiters=2)
+
+        self.assertIsNotNone(attempt.lease)
+        self.assertEqual(backend.attempts, 3)
+        self.assertGreater(attempt.waited, 0)
+        self.assertEqual(self.waiters(backend), 0)
+
+    def test_lock_still_held_after_the_wait_times_out(self):
+
+        backend = CountdownLockBackend(1000, self.client)
+
+        started = time.monotonic()
+        attempt = backend.acquire("merchant:1", wait_ms=30)
+
+        self.assertIsNone(attempt.lease)
+        self.assertEqual(attempt.rejected_reason, REJECTED_TIMEOUT)
+        self.assertGreaterEqual(attempt.waited, 0.03)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.waiters(backend), 0)
+
+    def test_full_queue_is_rejected_without_waiting(self):
+
+        backend = CountdownLockBackend(1000, self.client)
+        backend.waiters.enter("merchant:1", 2, 1000)
+        backend.waiters.enter("merchant:1", 2, 1000)
+
+        attempt = backend.acquire("merchant:1", wait_ms=1000, max_waiters=2)
+
+        self.assertEqual(attempt.rejected_reason, REJECTED_QUEUE_FULL)
+        self.assertEqual(backend.attempts, 1)
+        self.assertEqual(self.waiters(backend), 2)
+
+    def test_no_wait_rejects_at_once(self):
+
+        backend = CountdownLockBackend(1, self.client)
+
+        self.assertEqual(backend.acquire("merchant:1").rejected_reason, REJECTED_BUSY)
+        self.assertEqual(self.client.values, {})
+
+    def test_switch_routes_queue_per_account(self):
+
+        registry = RoutePolicyRegistry()
+
+        credit = registry.get("transaction-credit")
+        reversal = registry.get("transaction-reversal")
+
+        self.assertEqual(credit.lock_key({"toAccountNumber" : "PK00"}), "PK00")
+        self.assertEqual(reversal.lock_key({"accountNumber" : "PK00"}), "PK00")
+        self.assertGreater(credit.wait_ms, 0)
+        self.assertGreater(reversal.wait_ms, 0)
+
+    def test_routes_default_to_the_settings(self):
+
+        with self.settings(SYNC_LOCK_WAIT_MS=200, SYNC_LOCK_MAX_WAITERS=3):
+            self.assertEqual((RoutePolicy().wait_ms, RoutePolicy().max_waiters), (200, 3))
+            self.assertEqual(RoutePolicy(lock_wait_ms=0).wait_ms, 0)
+
+
+class SwitchView:
+
+    PROCESSED_OK = "Success"
+    TECHNICAL_PROBLEM = "Technical problem"
+    DUPLICATE_PAYMENT = "Duplicate"
+    RESPONSE_CODES = {PROCESSED_OK : "00", TECHNICAL_PROBLEM : "96", DUPLICATE_PAYMENT : "94"}
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+        self.posted = None
+
+    @idempotent("credit")
+    def post(self, request):
+        self.calls += 1
+        return Response(self.responses.pop(0))
+
+    def recover_response(self, key):
+        return self.posted
+
+
+class LoggedSwitchView(SwitchView):
+    """Decorated as the switch views are, the stored response includes the log's auth id."""
+
+    @idempotent("credit")
+    @log_request_response
+    def post(self, request):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return Response(response)
+
+
+def switch_request(rrn="123456789012"):
+    return mock.Mock(data={"rrn" : rrn, "stan" : "000001", "transmissionDate" : "1018120000"})
+
+
+@mock.patch("core.idempotency.settings.IDEMPOTENCY_WAIT_MS", 0, create=True)
+class IdempotentTest(SimpleTestCase):
+
+    def setUp(self):
+        self.client = FakeRedis()
+        patch = mock.patch("core.idempotency.idempotency", IdempotencyStore(self.client))
+        self.store = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_pending_claim_is_leased_and_done_response_kept(self):
+
+        self.assertTrue(self.store.claim("credit:1:2:3").claimed)
+
+        redis_key = self.store.redis_key("credit:1:2:3")
+        self.assertEqual(self.client.expiry[redis_key], self.store.pending_ttl)
+        self.assertLess(self.store.pending_ttl, self.store.ttl)
+
+        self.store.complete("credit:1:2:3", {"responseCode" : "00"})
+        self.assertEqual(self.client.expiry[redis_key], self.store.ttl)
+
+    def test_retry_replays_the_stored_response(self):
+
+        view = SwitchView([{"responseCode" : "00", "transactionLogId" : "1"}])
+
+        first = view.post(switch_request())
+        second = view.post(switch_request())
+
+        self.assertEqual(view.calls, 1)
+        self.assertEqual(second.data, first.data)
+
+    def test_in_flight_duplicate_gets_duplicate_payment(self):
+
+        view = SwitchView([{"responseCode" : "00"}])
+        self.store.claim(self.store.key("credit", "123456789012", "000001", "1018120000"))
+
+        response = view.post(switch_request())
+
+        self.assertEqual(view.calls, 0)
+        self.assertEqual(response.data["responseCode"], "94")
+
+    def test_technical_problem_releases_the_claim(self):
+
+        view = SwitchView([{"responseCode" : "96"}, {"responseCode" : "00"}])
+
+        self.assertEqual(view.post(switch_request()).data["responseCode"], "96")
+        self.assertEqual(self.client.values, {})
+
+        self.assertEqual(view.post(switch_request()).data["responseCode"], "00")
+        self.assertEqual(view.calls, 2)
+
+    def test_technical_problem_of_a_posted_request_is_recovered(self):
+
+        view = SwitchView([{"responseCode" : "96"}])
+        view.posted = {"responseCode" : "00", "transactionLogId" : "7"}
+
+        response = view.post(switch_request())
+
+        self.assertEqual(response.data, view.posted)
+        self.assertEqual(view.post(switch_request()).data, view.posted)
+        self.assertEqual(view.calls, 1)
+
+    def test_duplicate_is_recovered_while_redis_is_down(self):
+
+        self.store.client = DownRedis()
+
+        # the unique constraint turned the duplicate into a technical problem
+        view = SwitchView([{"responseCode" : "96"}])
+        view.posted = {"responseCode" : "00", "transactionLogId" : "7"}
+
+        response = view.post(switch_request())
+
+        self.assertEqual(response.data, view.posted)
+        self.assertEqual(view.calls, 1)
+
+
+@mock.patch("core.idempotency.settings.IDEMPOTENCY_WAIT_MS", 0, create=True)
+class LoggedIdempotentTest(SimpleTestCase):
+
+    def setUp(self):
+
+        patch = mock.patch("core.idempotency.idempotency", IdempotencyStore(FakeRedis()))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        patch = mock.patch("core.decorators.request_log_writer")
+        self.writer = patch.start()
+        self.addCleanup(patch.stop)
+
+        ids = itertools.count(41)
+        self.writer.submit.side_effect = lambda **kwargs: next(ids)
+
+    def test_replay_keeps_the_original_auth_id(self):
+
+        view = LoggedSwitchView([{"responseCode" : "00", "transactionLogId" : "1"}])
+
+        first = view.post(switch_request())
+        second = view.post(switch_request())
+
+        self.assertEqual(first.data["authIdResponse"], "000041")
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(self.writer.submit.call_count, 1)
+
+    def test_system_exception_releases_the_claim(self):
+
+        view = LoggedSwitchView([RuntimeError("db down"), {"responseCode" : "00"}])
+
+        with self.assertLogs("django", "ERROR"):
+            self.assertEqual(view.post(switch_request()).status_code, 500)
+
+        response = view.post(switch_request())
+
+        self.assertEqual(response.data["responseCode"], "00")
+        self.assertEqual(view.calls, 2)
+
+    def test_recovered_response_keeps_the_auth_id(self):
+
+        view = LoggedSwitchView([{"responseCode" : "96"}])
+        view.posted = {"responseCode" : "00", "transactionLogId" : "7"}
+
+        response = view.post(switch_request())
+
+        self.assertEqual(response.data, dict(view.posted, authIdResponse="000041"))
+        self.assertEqual(view.post(switch_request()).data, response.data)
+
+
+class OutboxTest(TestCase):
+
+    def setUp(self):
+
+        self.delivered = []
+
+        patch = mock.patch.dict(outbox.HANDLERS, {"test" : self.delivered.append}, clear=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_claim_leases_due_events(self):
+
+        due = outbox.enqueue("test", amount=1)
+        later = outbox.enqueue("test", amount=2)
+        later.available_at = timezone.now() + timedelta(minutes=5)
+        later.save(update_fields=["available_at"])
+
+        with self.settings(OUTBOX_LEASE_SECONDS=60):
+            self.assertEqual([event.id for event in outbox.claim(10)], [due.id])
+            self.assertEqual(outbox.claim(10), [])
+
+        due.refresh_from_db()
+        self.assertGreater(due.available_at, timezone.now() + timedelta(seconds=50))
+
+    def test_delivered_event_is_not_claimed_again(self):
+
+        outbox.enqueue("test", amount=1)
+
+        self.assertEqual(outbox.dispatch(), (1, 0))
+        self.assertEqual(self.delivered, [{"amount" : 1}])
+
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.status, event.STATUS_DELIVERED)
+        self.assertEqual(event.attempts, 1)
+        self.assertEqual(outbox.dispatch(), (0, 0))
+
+    def test_failure_backs_off_then_gives_up(self):
+
+        def failing(payload):
+            raise ValueError("partner down")
+
+        outbox.HANDLERS["test"] = failing
+        event = outbox.enqueue("test", amount=1)
+
+        with self.settings(OUTBOX_MAX_ATTEMPTS=2, OUTBOX_BACKOFF_SECONDS=30):
+
+            self.assertFalse(outbox.deliver(event))
+            event.refresh_from_db()
+
+            self.assertEqual(event.status, event.STATUS_PENDING)
+            self.assertEqual(event.attempts, 1)
+            self.assertGreater(event.available_at, timezone.now() + timedelta(seconds=20))
+            self.assertIn("partner down", event.last_error)
+            self.assertEqual(outbox.claim(10), [])
+
+            self.assertFalse(outbox.deliver(event))
+            event.refresh_from_db()
+
+            self.assertEqual(event.status, event.STATUS_FAILED)
+            self.assertEqual(event.attempts, 2)
+
+    def test_each_event_is_leased_again_when_its_delivery_starts(self):
+
+        first = outbox.enqueue("test", amount=1)
+        second = outbox.enqueue("test", amount=2)
+        leases = []
+
+        def deliver(payload):
+            leases.append(OutboxEvent.objects.get(payload=payload).available_at)
+
+        outbox.HANDLERS["test"] = deliver
+
+        with self.settings(OUTBOX_LEASE_SECONDS=60):
+
+            events = outbox.claim(10)
+            claimed = events[0].available_at
+
+            with mock.patch("core.outbox.timezone.now", return_value=timezone.now() + timedelta(seconds=50)):
+                self.assertEqual([outbox.deliver(event) for event in events], [True, True])
+
+        self.assertEqual(len(leases), 2)
+        self.assertTrue(all(leased > claimed for leased in leases))
+        self.assertEqual(OutboxEvent.objects.filter(status=OutboxEvent.STATUS_DELIVERED).count(), 2)
+
+    def test_event_claimed_by_another_worker_is_skipped(self):
+
+        outbox.enqueue("test", amount=1)
+        event, = outbox.claim(10)
+
+        # the lease ran out and another worker claimed the event
+        OutboxEvent.objects.filter(id=event.id).update(available_at=timezone.now() + timedelta(minutes=9))
+
+        with self.assertLogs("django", "WARNING"):
+            self.assertFalse(outbox.deliver(event))
+
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(OutboxEvent.objects.get().attempts, 0)
+
+    def test_outcome_is_not_recorded_once_the_lease_is_lost(self):
+
+        event = outbox.enqueue("test", amount=1)
+
+        def taken_over(payload):
+            OutboxEvent.objects.filter(id=event.id).update(available_at=timezone.now() + timedelta(minutes=9))
+
+        outbox.HANDLERS["test"] = taken_over
+
+        with self.assertLogs("django", "WARNING"):
+            self.assertFalse(outbox.deliver(event))
+
+        stored = OutboxEvent.objects.get()
+        self.assertEqual((stored.status, stored.attempts), (stored.STATUS_PENDING, 0))
+
+    def test_lease_must_outlast_a_delivery(self):
+
+        with self.settings(OUTBOX_LEASE_SECONDS=15, OUTBOX_DELIVERY_SECONDS=15):
+            self.assertEqual([error.id for error in outbox_lease_check(None)], ["core.E001"])
+
+        with self.settings(OUTBOX_LEASE_SECONDS=60, OUTBOX_DELIVERY_SECONDS=15):
+            self.assertEqual(outbox_lease_check(None), [])
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+
+        with self.settings(OUTBOX_BACKOFF_SECONDS=5, OUTBOX_MAX_BACKOFF_SECONDS=30):
+            self.assertEqual(
+                [outbox.backoff(attempts).total_seconds() for attempts in (1, 2, 3, 4)],
+                [5, 10, 20, 30]
+            )
+
+    def test_unknown_topic_fails_the_attempt(self):
+
+        event = outbox.enqueue("unknown", amount=1)
+
+        self.assertFalse(outbox.deliver(event))
+
+        event.refresh_from_db()
+        self.assertIn("No outbox handler", event.last_error)
+
+    def test_partner_calls_share_the_delivery_budget(self):
+
+        def partner_call(payload):
+            requests.post("https://partner.example/deposits", json=payload, timeout=30)
+
+        outbox.HANDLERS["test"] = partner_call
+        event = outbox.enqueue("test", amount=1)
+
+        with mock.patch.object(http.sessions, "get") as session, self.settings(OUTBOX_DELIVERY_SECONDS=2):
+            session.return_value.request.return_value.status_code = 200
+            self.assertTrue(outbox.deliver(event))
+
+        method, url = session.return_value.request.call_args[0]
+        connect, read = session.return_value.request.call_args[1]["timeout"]
+
+        self.assertEqual((method, url), ("POST", "https://partner.example/deposits"))
+        self.assertLessEqual(max(connect, read), 2)
+
+    def test_spent_budget_fails_the_attempt(self):
+
+        def slow_partner_call(payload):
+            time.sleep(0.05)
+            requests.post("https://partner.example/deposits", json=payload)
+
+        outbox.HANDLERS["test"] = slow_partner_call
+        event = outbox.enqueue("test", amount=1)
+
+        with mock.patch.object(http.sessions, "get") as session, self.settings(OUTBOX_DELIVERY_SECONDS=0.01):
+            self.assertFalse(outbox.deliver(event))
+
+        session.return_value.request.assert_not_called()
+
+        event.refresh_from_db()
+        self.assertEqual(event.status, event.STATUS_PENDING)
+        self.assertIn("DeadlineExceeded", event.last_error)
+
+
+class PartnerHttpTest(SimpleTestCase):
+
+    def setUp(self):
+
+        patcher = mock.patch.object(http.sessions, "get")
+        self.session = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch("core.http.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def responses(self, *outcomes):
+
+        def respond(method, url, **kwargs):
+            outcome = outcomes[self.session.request.call_count - 1]
+            if isinstance(outcome, Exception):
+                raise outcome
+            return mock.Mock(status_code=outcome)
+
+        self.session.request.side_effect = respond
+
+    def test_idempotent_call_is_retried_on_a_bad_gateway(self):
+
+        self.responses(503, 502, 200)
+
+        self.assertEqual(http.get("https://partner.example/status").status_code, 200)
+        self.assertEqual(self.session.request.call_count, 3)
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list], [0.2, 0.4])
+
+    def test_post_is_only_retried_when_it_never_connected(self):
+
+        self.responses(requests.ConnectTimeout("connect"), requests.ReadTimeout("read"))
+
+        with self.assertRaises(requests.ReadTimeout):
+            http.post("https://partner.example/deposits", json={})
+
+        self.assertEqual(self.session.request.call_count, 2)
+
+    def test_caller_timeout_and_budget_cut_the_timeouts(self):
+
+        self.responses(200, 200)
+
+        with self.settings(PARTNER_HTTP_CONNECT_TIMEOUT=3, PARTNER_HTTP_READ_TIMEOUT=10):
+            http.post("https://partner.example/deposits", timeout=5)
+            self.assertEqual(self.session.request.call_args[1]["timeout"], (3, 5))
+
+            with http.deadline(1):
+                http.post("https://partner.example/deposits", timeout=(None, 5))
+
+        connect, read = self.session.request.call_args[1]["timeout"]
+        self.assertLessEqual(max(connect, read), 1)
+
+    def test_retries_stop_when_the_budget_is_spent(self):
+
+        self.responses(503, 200)
+
+        with http.deadline(0.1):
+            self.assertEqual(http.get("https://partner.example/status").status_code, 503)
+
+        self.assertEqual(self.session.request.call_count, 1)
+
+    def test_plain_requests_are_routed_inside_a_deadline_only(self):
+
+        self.responses(200, 200)
+
+        with mock.patch("core.http._plain_request") as plain:
+            requests.get("https://partner.example/status")
+
+            with http.deadline(5):
+                requests.get("https://partner.example/status")
+
+        plain.assert_called_once()
+        self.assertEqual(self.session.request.call_count, 1)
+
+
+class PartnerSessionsTest(SimpleTestCase):
+
+    def test_one_session_per_host_and_process(self):
+
+        sessions = http.PartnerSessions()
+        self.addCleanup(sessions.close)
+
+        first = sessions.get("https://partner.example/a")
+
+        self.assertIs(sessions.get("https://partner.example/b"), first)
+        self.assertIsNot(sessions.get("https://other.example/a"), first)
+
+        sessions.pid = -1
+        self.assertIsNot(sessions.get("https://partner.example/a"), first)
+
+
+class BusinessResolverTest(SimpleTestCase):
+
+    def setUp(self):
+        self.client = FakeRedis()
+        self.collection = mock.Mock()
+        self.collection.find_one.return_value = {"id" : "b1", "name" : "Ali Store"}
+        self.resolver = BusinessResolver(self.client, self.collection)
+
+    def test_miss_runs_the_covered_lookup_once(self):
+
+        self.assertEqual(self.resolver.resolve("03001234567"), {"id" : "b1", "name" : "Ali Store"})
+        self.assertEqual(self.resolver.resolve("03001234567"), {"id" : "b1", "name" : "Ali Store"})
+
+        self.collection.find_one.assert_called_once_with(
+            {"user_cloud_id" : "03001234567", "is_active" : True}, {"id" : 1, "_id" : 0, "name" : 1}
+        )
+
+        redis_key = self.resolver.redis_key("03001234567")
+        self.assertEqual(self.client.expiry[redis_key], self.resolver.ttl)
+
+    def test_other_processes_read_redis(self):
+
+        self.resolver.resolve("03001234567")
+        other = BusinessResolver(self.client, self.collection)
+
+        self.assertEqual(other.resolve("03001234567")["id"], "b1")
+        self.assertEqual(self.collection.find_one.call_count, 1)
+
+    def test_missing_business_is_cached_briefly(self):
+
+        self.collection.find_one.return_value = None
+
+        self.assertEqual(self.resolver.resolve("03001234567"), {"id" : None, "name" : None})
+
+        redis_key = self.resolver.redis_key("03001234567")
+        self.assertEqual(self.client.expiry[redis_key], self.resolver.missing_ttl)
+
+    def test_callers_cannot_change_the_cached_entry(self):
+
+        self.resolver.resolve("03001234567")["name"] = "changed"
+
+        self.assertEqual(self.resolver.resolve("03001234567")["name"], "Ali Store")
+
+    def test_redis_down_falls_back_to_mongo(self):
+
+        self.resolver.client = DownRedis()
+
+        self.assertEqual(self.resolver.resolve("03001234567")["id"], "b1")
+
+    def test_watch_invalidates_written_businesses(self):
+
+        self.resolver.resolve("03001234567")
+
+        stream = mock.MagicMock()
+        stream.__enter__.return_value = iter([
+            {"_id" : "t1", "fullDocument" : {"user_cloud_id" : "03001234567"}},
+            {"_id" : "t2", "fullDocument" : None},
+        ])
+        self.collection.watch.return_value = stream
+
+        self.assertEqual(list(self.resolver.watch()), ["t1", "t2"])
+        self.assertIsNone(self.client.get(self.resolver.redis_key("03001234567")))
+
+        self.collection.find_one.return_value = {"id" : "b2", "name" : "Ali Mart"}
+        self.assertEqual(self.resolver.resolve("03001234567")["id"], "b2")
+
+    def stream(self, *changes):
+        stream = mock.MagicMock()
+        stream.__enter__.return_value = iter(changes)
+        return stream
+
+    def test_watch_resumes_after_the_last_change(self):
+
+        self.collection.watch.side_effect = [
+            self.stream({"_id" : {"_data" : "t1"}, "fullDocument" : None}, {"_id" : {"_data" : "t2"}, "fullDocument" : None}),
+            self.stream(),
+        ]
+
+        with mock.patch("core.management.commands.business_cache.businesses", self.resolver):
+            call_command("business_cache", "--watch", stdout=StringIO())
+            self.assertEqual(self.resolver.resume_token(), {"_data" : "t2"})
+            call_command("business_cache", "--watch", stdout=StringIO())
+
+        self.assertEqual(
+            [call[1]["resume_after"] for call in self.collection.watch.call_args_list], [None, {"_data" : "t2"}]
+        )
+
+    def test_watch_starts_over_when_the_token_expired(self):
+
+        self.resolver.save_resume_token({"_data" : "old"})
+        self.collection.watch.side_effect = [
+            OperationFailure("history lost", code=286),
+            self.stream({"_id" : {"_data" : "t3"}, "fullDocument" : None}),
+        ]
+
+        with mock.patch("core.management.commands.business_cache.businesses", self.resolver):
+            call_command("business_cache", "--watch", stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual(
+            [call[1]["resume_after"] for call in self.collection.watch.call_args_list], [{"_data" : "old"}, None]
+        )
+        self.assertEqual(self.resolver.resume_token(), {"_data" : "t3"})
+
+    def test_other_watch_failures_are_raised(self):
+
+        self.resolver.save_resume_token({"_data" : "old"})
+        self.collection.watch.side_effect = OperationFailure("not a replica set", code=40573)
+
+        with mock.patch("core.management.commands.business_cache.businesses", self.resolver), \
+                self.assertRaises(OperationFailure):
+            call_command("business_cache", "--watch", stdout=StringIO())
+
+    def test_explain_reports_a_covered_plan(self):
+
+        def explained(winning_plan, docs_examined=0):
+            cursor = mock.Mock()
+            cursor.limit.return_value.explain.return_value = {
+                "queryPlanner" : {"winningPlan" : winning_plan},
+                "executionStats" : {"totalDocsExamined" : docs_examined}
+            }
+            return cursor
+
+        self.collection.find.return_value = explained(
+            {"stage" : "LIMIT", "inputStage" : {"stage" : "PROJECTION_COVERED", "inputStage" : {"stage" : "IXSCAN"}}}
+        )
+        self.assertTrue(self.resolver.explain("03001234567")["covered"])
+
+        self.collection.find.return_value = explained(
+            {"stage" : "LIMIT", "inputStage" : {"stage" : "FETCH", "inputStage" : {"stage" : "IXSCAN"}}}, 1
+        )
+        self.assertFalse(self.resolver.explain("03001234567")["covered"])
+
+
+class RequestPayloadTest(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = RequestPayloadMiddleware(lambda request: HttpResponse("ok"))
+
+    def post(self, body, content_type="application/json"):
+        return self.factory.post("/", data=body, content_type=content_type)
+
+    def test_body_is_decoded_once_and_only_when_read(self):
+
+        request = self.post(json.dumps({"amount" : 10}))
+
+        with mock.patch("core.payload.json.loads", side_effect=json.loads) as loads:
+
+            payload = get_payload(request)
+            self.assertEqual(loads.call_count, 0)
+
+            self.assertEqual(payload.get("amount"), 10)
+            self.assertEqual(get_payload(Request(request)).data, {"amount" : 10})
+            self.assertIs(get_payload(request), payload)
+
+        self.assertEqual(loads.call_count, 1)
+
+    def test_non_object_body_reads_as_empty(self):
+
+        payload = get_payload(self.post("[1, 2]"))
+
+        self.assertEqual(payload.value, [1, 2])
+        self.assertEqual(payload.data, {})
+
+    def test_oversized_json_body_gets_413(self):
+
+        with self.settings(PAYLOAD_MAX_BODY_SIZE=10):
+            response = self.middleware(self.post(json.dumps({"note" : "x" * 20})))
+
+        self.assertEqual(response.status_code, 413)
+
+    def test_malformed_json_body_gets_400(self):
+
+        response = self.middleware(self.post("{not json"))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content), {"detail" : "Malformed request body"})
+
+    def test_other_bodies_are_left_to_django(self):
+
+        with self.settings(PAYLOAD_MAX_BODY_SIZE=10):
+            response = self.middleware(self.post("x" * 20, content_type="text/plain"))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_malformed_body_of_a_get_passes(self):
+
+        request = self.factory.generic("GET", "/", "{not json", content_type="application/json")
+
+        self.assertEqual(self.middleware(request).status_code, 200)
+
+    def test_parser_reuses_the_decoded_payload(self):
+
+        request = self.post(json.dumps({"amount" : 10}))
+        self.middleware(request)
+
+        with mock.patch("core.payload.json.loads") as loads:
+            data = Request(request, parsers=[CachedJSONParser()]).data
+
+        self.assertEqual(data, {"amount" : 10})
+        loads.assert_not_called()
+
+    def test_parser_raises_parse_error_for_malformed_bodies(self):
+
+        request = self.post("{not json")
+
+        with self.assertRaises(ParseError):
+            Request(request, parsers=[CachedJSONParser()]).data
+
+
+class RoutePolicyRegistryTest(SimpleTestCase):
+
+    def setUp(self):
+        self.registry = RoutePolicyRegistry()
+        self.factory = RequestFactory()
+
+    def test_compile_collects_the_named_route_policies(self):
+
+        policies = self.registry.compile()
+
+        credit = policies["transaction-credit"]
+        self.assertEqual((credit.name, credit.auth, credit.ip_security), ("transaction-credit", False, "all"))
+        self.assertTrue(credit.locks("POST"))
+
+        wallet = policies["merchant-wallet"]
+        self.assertFalse(wallet.locks("POST"))
+        self.assertTrue(wallet.locks("GET"))
+
+    def test_for_path_resolves_routes_once(self):
+
+        self.registry.compile()
+        self.assertIs(self.registry.for_path("/trancaction/credit"), self.registry.get("transaction-credit"))
+
+        with mock.patch("core.routes.get_resolver") as get_resolver:
+            self.registry.for_path("/trancaction/credit")
+
+        get_resolver.assert_not_called()
+
+    def test_legacy_paths_match_by_fragment(self):
+
+        self.assertIs(self.registry.for_path("/api/loyalty/balance/"), UNLOCKED)
+        self.assertIs(self.registry.for_path("/somewhere/else/"), DEFAULT_POLICY)
+
+        billpay = self.registry.for_path("/bills/billpay/")
+        self.assertTrue(billpay.locks("POST"))
+        self.assertFalse(billpay.locks("GET"))
+
+    def test_legacy_url_kwargs_override_the_fallback(self):
+
+        match = mock.Mock(kwargs={"auth" : True, "ip_security" : "disabled"}, url_name=None)
+
+        with mock.patch("core.routes.get_resolver") as get_resolver:
+            get_resolver.return_value.resolve.return_value = match
+            policy = self.registry.for_path("/oscar-wallet/balance/")
+
+        self.assertEqual((policy.lock, policy.auth, policy.ip_security), (False, True, "disabled"))
+        self.assertEqual(UNLOCKED.auth, None)
+
+    def test_for_request_prefers_the_resolver_match_and_caches(self):
+
+        request = self.factory.get("/somewhere/else/")
+        request.resolver_match = mock.Mock(url_name="transaction-reversal")
+
+        policy = self.registry.for_request(request)
+        self.assertIs(policy, self.registry.get("transaction-reversal"))
+
+        request.resolver_match = None
+        self.assertIs(self.registry.for_request(request), policy)
+
+    def test_replace_keeps_the_other_fields(self):
+
+        policy = RoutePolicy(lock_methods=("POST",), lock_wait_ms=50).replace(auth=True)
+
+        self.assertEqual((policy.lock_wait_ms, policy.auth), (50, True))
+        self.assertTrue(policy.locks("POST"))
+        self.assertFalse(policy.locks("GET"))
+
+
+class IPAllowlistTest(SimpleTestCase):
+
+    def test_networks_and_addresses_are_merged_into_intervals(self):
+
+        allowlist = IPAllowlist([
+            "10.0.0.0/24", "10.0.1.0/24", "10.0.0.7", "192.168.1.10", "2001:db8::/32", "not an ip"
+        ])
+
+        # the two /24s and the address inside them are one interval
+        self.assertEqual(len(allowlist), 3)
+
+        for ip in ("10.0.0.0", "10.0.1.255", "192.168.1.10", "2001:db8::1", "::ffff:10.0.0.9"):
+            self.assertIn(ip, allowlist)
+
+        for ip in ("9.255.255.255", "10.0.2.0", "192.168.1.11", "2001:db9::1", "", "garbage"):
+            self.assertNotIn(ip, allowlist)
+
+
+class AllowlistEngineTest(SimpleTestCase):
+
+    def setUp(self):
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        self.write("all_ips.txt", "10.0.0.0/24  # office\n")
+        self.write("white_listed_merchants.txt", "03001234567\n")
+
+        patch = mock.patch("core.allowlist.conn")
+        self.conn = patch.start()
+        self.conn.get.return_value = b"1"
+        self.addCleanup(patch.stop)
+
+    def write(self, filename, text, mtime=None):
+
+        path = os.path.join(self.directory, filename)
+
+        with open(path, "w") as f:
+            f.write(text)
+
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_nothing_is_read_until_the_first_lookup(self):
+
+        engine = AllowlistEngine(self.directory, check_interval=60)
+
+        self.assertIsNone(engine.snapshot)
+        self.assertTrue(engine.refresh_due())
+        self.conn.get.assert_not_called()
+
+        self.assertTrue(engine.ip_allowed("all", "10.0.0.5"))
+        self.assertFalse(engine.ip_allowed("hbl", "10.0.0.5"))
+        self.assertTrue(engine.merchant_allowed("03001234567"))
+        self.conn.get.assert_called_once_with(VERSION_KEY)
+
+    def test_changed_file_is_reloaded_after_the_interval(self):
+
+        engine = AllowlistEngine(self.directory, check_interval=60)
+        self.assertFalse(engine.ip_allowed("all", "172.16.0.1"))
+
+        self.write("all_ips.txt", "172.16.0.0/12\n", mtime=time.time() + 10)
+
+        # within the interval the snapshot is kept without a stat
+        self.assertFalse(engine.ip_allowed("all", "172.16.0.1"))
+
+        engine._checked_at -= 60
+        self.assertTrue(engine.ip_allowed("all", "172.16.0.1"))
+        self.assertFalse(engine.ip_allowed("all", "10.0.0.5"))
+
+    def test_version_bump_reloads_unchanged_files(self):
+
+        engine = AllowlistEngine(self.directory, check_interval=0)
+        snapshot = engine.refresh()
+
+        self.assertIs(engine.refresh(), snapshot)
+
+        self.conn.get.return_value = b"2"
+        self.assertIsNot(engine.refresh(), snapshot)
+
+    def test_redis_down_keeps_serving_the_files(self):
+
+        self.conn.get.side_effect = ConnectionError("redis down")
+        engine = AllowlistEngine(self.directory, check_interval=0)
+
+        self.assertTrue(engine.ip_allowed("all", "10.0.0.5"))
+
+
+@mock.patch("core.tokens.settings.AUTH_TOKEN_SIGNING_KEYS", {"k1" : "first secret", "k2" : "second secret"})
+@mock.patch("core.tokens.settings.AUTH_TOKEN_ACTIVE_KEY_ID", "k2")
+class SignedTokenTest(TestCase):
+
+    def setUp(self):
+
+        self.client = FakeRedis()
+        patch = mock.patch("core.tokens.revoked_tokens", RevocationSet(self.client, refresh_interval=60))
+        self.revoked = patch.start()
+        self.addCleanup(patch.stop)
+
+        self.user = User.objects.create(username="03001234567")
+        self.expires_at = time.time() + 3600
+
+    def forge(self, claims, key="second secret"):
+        payload = tokens._b64encode(json.dumps(claims).encode())
+        message = "v1.%s" % payload
+        return "%s.%s" % (message, tokens._signature(key, message))
+
+    def test_signed_token_verifies_without_a_query(self):
+
+        token = sign_token(self.user, self.expires_at)
+
+        with self.assertNumQueries(0):
+            claims = verify_token(token)
+            user = tokens.token_user(claims)
+
+        self.assertEqual((claims["u"], claims["n"], claims["k"]), (self.user.id, "03001234567", "k2"))
+        self.assertEqual((user.id, user.username), (self.user.id, "03001234567"))
+
+    def test_older_key_still_verifies(self):
+        token = sign_token(self.user, self.expires_at, key_id="k1")
+        self.assertEqual(verify_token(token)["k"], "k1")
+
+    def test_expired_token_is_rejected(self):
+
+        token = sign_token(self.user, self.expires_at)
+
+        with self.assertRaises(ExpiredToken):
+            verify_token(token, now=self.expires_at + 1)
+
+    def test_tampered_token_is_rejected(self):
+
+        version, payload, signature = sign_token(self.user, self.expires_at).split(".")
+        claims = json.loads(tokens._b64decode(payload))
+        claims["u"] = claims["u"] + 1
+        other_payload = tokens._b64encode(json.dumps(claims).encode())
+
+        for token in (
+            "%s.%s.%s" % (version, other_payload, signature),
+            "%s.%s.%s" % (version, payload, signature[:-2] + "xx"),
+            "v2.%s.%s" % (payload, signature),
+            "%s.%s" % (version, payload),
+            "v1.!!!.%s" % signature,
+        ):
+            with self.assertRaises(InvalidToken):
+                verify_token(token)
+
+    def test_key_id_must_be_a_known_string(self):
+
+        claims = {"u" : 1, "n" : "x", "e" : int(self.expires_at), "j" : "j1"}
+
+        for key_id in (None, 1, ["k2"], {"k" : "k2"}, "k3"):
+            with self.assertRaises(InvalidToken):
+                verify_token(self.forge(dict(claims, k=key_id)))
+
+        with self.assertRaises(InvalidToken):
+            verify_token(self.forge([claims]))
+
+    def test_revoked_token_is_rejected(self):
+
+        token = sign_token(self.user, self.expires_at)
+
+        self.assertTrue(tokens.revoke_token(token))
+        self.assertFalse(tokens.revoke_token("not-signed"))
+
+        with self.assertRaises(InvalidToken):
+            verify_token(token)
+
+        # other processes see it once they refresh
+        other = RevocationSet(self.client)
+        claims = json.loads(tokens._b64decode(token.split(".")[1]))
+        self.assertTrue(other.is_revoked(claims["j"]))
+
+    def test_rotation_revokes_the_previous_token_on_commit(self):
+
+        view = TokenGenerationView()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first = view.generate_token(self.user, signed=True)["access_token"]
+
+        verify_token(first)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second = view.generate_token(self.user, signed=False)["access_token"]
+
+        self.assertNotEqual(first, second)
+
+        with self.assertRaises(InvalidToken):
+            verify_token(first)
+
+    def test_replaced_and_deleted_tokens_are_revoked(self):
+
+        first = sign_token(self.user, self.expires_at)
+        second = sign_token(self.user, self.expires_at)
+
+        user_token = UserToken.objects.create(
+            user=self.user, token=first, issued_at_gmt=timezone.now(),
+            expires_at_gmt=timezone.now() + timedelta(hours=6), expiry_time=3600
+        )
+
+        user_token.token = second
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user_token.save()
+            verify_token(first)
+
+        with self.assertRaises(InvalidToken):
+            verify_token(first)
+
+        verify_token(second)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user_token.delete()
+
+        with self.assertRaises(InvalidToken):
+            verify_token(second)
+
+
+class PrincipalResolverTest(TestCase):
+
+    def setUp(self):
+
+        self.client = FakeRedis()
+        self.resolver = PrincipalResolver(self.client)
+
+        patch = mock.patch("core.principal.principals", self.resolver)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.user = User.objects.create(username="03001234567")
+        self.merchant = Merchant.objects.create(user=self.user, current_balance=500)
+
+    def resolve(self):
+        return self.resolver.resolve("03001234567", self.merchant.secret_key)
+
+    def cached(self):
+        return self.client.get(self.resolver.redis_key("03001234567"))
+
+    def test_miss_loads_once_then_serves_the_caches(self):
+
+        with self.assertNumQueries(1):
+            principal = self.resolve()
+
+        self.assertEqual((principal.merchant_id, principal.current_balance), (self.merchant.id, 500))
+        self.assertEqual(principal.digest, secret_digest(self.merchant.secret_key))
+        self.assertNotIn(self.merchant.secret_key.encode(), self.cached())
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve().merchant_id, self.merchant.id)
+
+        # another process reads redis, the balance is never cached
+        other = PrincipalResolver(self.client)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(other.resolve("03001234567", self.merchant.secret_key).current_balance)
+
+    def test_wrong_secret_key_is_checked_against_the_database(self):
+
+        self.resolve()
+
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.resolver.resolve("03001234567", "wrong"))
+
+        self.assertIsNone(self.resolver.resolve("03001234567", None))
+
+    def test_merchant_change_invalidates_on_commit(self):
+
+        self.resolve()
+        self.merchant.status = Merchant.STATUS_ON_HOLD
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.save()
+            self.assertIsNotNone(self.cached())
+
+        self.assertIsNone(self.cached())
+        self.assertEqual(self.resolve().status, Merchant.STATUS_ON_HOLD)
+
+    def test_user_changes_invalidate_the_old_and_new_username(self):
+
+        self.resolve()
+        self.user.is_active = False
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(update_fields=["is_active"])
+
+        self.assertIsNone(self.cached())
+        self.assertFalse(self.resolve().is_active)
+
+        self.user.username = "03007654321"
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+        self.assertIsNone(self.cached())
+        self.assertIsNone(self.resolve())
+
+    def test_last_login_update_keeps_the_entry(self):
+
+        self.resolve()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(update_fields=["last_login"])
+
+        self.assertIsNotNone(self.cached())
+
+    def test_saving_the_built_objects_does_not_write_cached_values_back(self):
+
+        user = self.resolve().build_user()
+        self.assertEqual((user.merchant_profile.current_balance, user.merchant_profile.status), (500, "ACTIVE"))
+
+        Merchant.objects.filter(id=self.merchant.id).update(credit_blocked=True)
+        User.objects.filter(id=self.user.id).update(is_active=False)
+
+        merchant = user.merchant_profile
+        merchant.status = Merchant.STATUS_ON_HOLD
+        merchant.save()
+        user.first_name = "Ali"
+        user.save()
+
+        self.merchant.refresh_from_db()
+        self.user.refresh_from_db()
+
+        self.assertEqual((self.merchant.status, self.merchant.credit_blocked), (Merchant.STATUS_ON_HOLD, True))
+        self.assertEqual((self.user.first_name, self.user.is_active), ("Ali", False))
+
+        # later saves are plain saves
+        merchant.credit_blocked = False
+        merchant.save(update_fields=["credit_blocked"])
+        self.merchant.refresh_from_db()
+        self.assertFalse(self.merchant.credit_blocked)
+
+
+class RequestLogWriterTest(TestCase):
+    """The writer is only enabled on postgres, where ids can be reserved, so the tests stand in for the allocator."""
+
+    def setUp(self):
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        patch = self.settings(
+            LOGS_FOLDER_NAME=directory.name, REQUEST_LOG_QUEUE_SIZE=2,
+            REQUEST_LOG_BATCH_SIZE=10, REQUEST_LOG_FLUSH_INTERVAL_MS=10, REQUEST_LOG_PUT_TIMEOUT_MS=1
+        )
+        patch.enable()
+        self.addCleanup(patch.disable)
+
+        self.user = User.objects.create(username="03001234567")
+        self.writer = RequestLogWriter()
+        self.writer.ids = mock.Mock(supported=mock.Mock(return_value=True), next_id=itertools.count(101).__next__)
+
+        # the flusher thread has its own connection, the tests collect its batches instead
+        self.written = []
+        self.write = self.writer.write
+        self.writer.write = lambda batch: self.written.append([entry.id for entry in batch])
+
+    def stop(self):
+        self.writer.stopping.set()
+        self.writer.thread.join(timeout=5)
+
+    def test_without_reserved_ids_the_row_is_written_inline(self):
+
+        self.writer.ids.supported.return_value = False
+
+        log_id = self.writer.submit(self.user, {"a" : 1}, {"b" : 2})
+
+        self.assertEqual(RequestLog.objects.get(id=log_id).request_data, {"a" : 1})
+        self.assertIsNone(self.writer.thread)
+
+    def test_flusher_writes_queued_rows_in_batches(self):
+
+        ids = [self.writer.submit(self.user, {"n" : n}, {}) for n in range(2)]
+        self.assertEqual(ids, [101, 102])
+
+        deadline = time.monotonic() + 5
+
+        while sum(len(batch) for batch in self.written) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.stop()
+        self.assertEqual([log_id for batch in self.written for log_id in batch], [101, 102])
+
+    def test_full_queue_writes_inline(self):
+
+        with mock.patch.object(self.writer, "ensure_started"):
+            ids = [self.writer.submit(self.user, {"n" : n}, {}) for n in range(3)]
+
+        self.assertEqual(self.writer.queue.qsize(), 2)
+        self.assertEqual(self.written, [[ids[2]]])
+
+    def test_failed_write_is_spilled_and_replayed(self):
+
+        entry = RequestLog(id=7, user_id=self.user.id, request_data={"a" : 1}, response_data={}, created_at=timezone.now())
+
+        with mock.patch("core.request_log.RequestLog.objects.bulk_create", side_effect=RuntimeError("db down")):
+            with self.assertLogs("django", "ERROR"):
+                self.write([entry])
+
+        self.assertTrue(os.path.exists(self.writer.spill_path))
+        self.assertFalse(RequestLog.objects.exists())
+
+        # replayed by the next writer, a row already written is skipped
+        self.writer.replay_spills()
+        self.writer.replay_spills()
+
+        self.assertEqual(RequestLog.objects.get().request_data, {"a" : 1})
+        self.assertEqual(os.listdir(os.path.dirname(self.writer.spill_path)), [])
+
+    def test_close_flushes_the_queue(self):
+
+        with mock.patch.object(self.writer, "ensure_started"):
+            self.writer.submit(self.user, {}, {})
+            self.writer.submit(self.user, {}, {})
+
+        self.writer.pid = os.getpid()
+        self.writer.thread = mock.Mock()
+
+        self.writer.close()
+
+        self.assertTrue(self.writer.stopping.is_set())
+        self.assertEqual(self.written, [[101, 102]])
+        self.assertTrue(self.writer.queue.empty())
+
+
+class BlockIdAllocatorTest(SimpleTestCase):
+
+    def allocator(self, blocks):
+        allocator = BlockIdAllocator(RequestLog, block_size=3)
+        allocator.supported = mock.Mock(return_value=True)
+        allocator.reserve = mock.Mock(side_effect=blocks)
+        return allocator
+
+    def test_ids_come_from_one_block_per_round_trip(self):
+
+        allocator = self.allocator([[1, 2, 3], [10, 11, 12]])
+
+        self.assertEqual([allocator.next_id() for n in range(4)], [1, 2, 3, 10])
+        self.assertEqual(allocator.reserve.call_count, 2)
+
+    def test_forked_process_drops_the_parents_block(self):
+
+        allocator = self.allocator([[1, 2, 3], [10, 11, 12]])
+        self.assertEqual(allocator.next_id(), 1)
+
+        allocator.pid = -1
+
+        self.assertEqual(allocator.next_id(), 10)
+        self.assertEqual(allocator.pid, os.getpid())
+
+    def test_without_a_sequence_there_is_no_id(self):
+
+        allocator = self.allocator([[1, 2, 3]])
+        allocator.supported.return_value = False
+
+        self.assertIsNone(allocator.next_id())
+        allocator.reserve.assert_not_called()
+
+    def test_reserve_asks_the_sequence_for_a_block(self):
+
+        allocator = BlockIdAllocator(RequestLog, block_size=3)
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.fetchall.return_value = [(5,), (6,), (7,)]
+
+        with mock.patch.object(BlockIdAllocator, "connection", mock.Mock(cursor=mock.Mock(return_value=cursor))):
+            self.assertEqual(allocator.reserve(), [5, 6, 7])
+
+        sql, params = cursor.__enter__.return_value.execute.call_args[0]
+        self.assertIn("nextval(pg_get_serial_sequence", sql)
+        self.assertEqual(params, [RequestLog._meta.db_table, "id", 3])
+
+    def test_one_allocator_per_model(self):
+
+        with self.settings(ID_BLOCK_SIZES={"core.RequestLog" : 500}), mock.patch.dict("core.ids._allocators", clear=True):
+            allocator = id_allocator(RequestLog)
+            self.assertIs(id_allocator(RequestLog), allocator)
+
+        self.assertEqual(allocator.block_size, 500)
+
+
+class RequestLogPartitionsTest(TestCase):
+    """Partitioning runs on postgres only, the SQL is checked with --dry-run and rows are pruned on sqlite."""
+
+    command = "core.management.commands.request_log_partitions"
+
+    def setUp(self):
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.archive_dir = directory.name
+
+        now = mock.patch("%s.timezone.now" % self.command, return_value=datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc))
+        now.start()
+        self.addCleanup(now.stop)
+
+    def run_command(self, *args, postgres=True, **patches):
+
+        output = StringIO()
+        patches.setdefault("legacy_bound", mock.Mock(return_value=None))
+
+        with mock.patch("%s.connection.vendor" % self.command, "postgresql" if postgres else "sqlite"), \
+                mock.patch.multiple("%s.Command" % self.command, **patches):
+            call_command("request_log_partitions", *args, stdout=output)
+
+        return output.getvalue().splitlines()
+
+    def test_arguments_are_checked(self):
+
+        with self.assertRaisesMessage(CommandError, "Nothing to do"):
+            call_command("request_log_partitions")
+
+        with self.assertRaisesMessage(CommandError, "--archive-dir"):
+            call_command("request_log_partitions", "--prune", "--archive-dir", "")
+
+        with self.assertRaisesMessage(CommandError, "postgresql"):
+            call_command("request_log_partitions", "--ensure", "1")
+
+    def test_setup_attaches_the_table_as_the_legacy_partition(self):
+
+        statements = self.run_command(
+            "--setup", "--dry-run",
+            is_partitioned=mock.Mock(return_value=False),
+            primary_key_name=mock.Mock(return_value="core_requestlog_pkey")
+        )
+
+        self.assertEqual(statements[0], "ALTER TABLE core_requestlog RENAME TO core_requestlog_legacy")
+        self.assertIn("ALTER TABLE core_requestlog_legacy DROP CONSTRAINT core_requestlog_pkey", statements)
+        self.assertIn(
+            "ALTER TABLE core_requestlog ATTACH PARTITION core_requestlog_legacy "
+            "FOR VALUES FROM (MINVALUE) TO ('2026-11-01')", statements
+        )
+        self.assertEqual(statements[-1], "CREATE TABLE core_requestlog_default PARTITION OF core_requestlog DEFAULT")
+
+    def test_setup_of_a_partitioned_table_does_nothing(self):
+
+        statements = self.run_command("--setup", "--dry-run", is_partitioned=mock.Mock(return_value=True))
+
+        self.assertEqual(statements, ["core_requestlog is already partitioned"])
+
+    def test_ensure_starts_above_the_legacy_partition(self):
+
+        statements = self.run_command("--ensure", "2", "--dry-run", legacy_bound=mock.Mock(return_value=date(2026, 11, 1)))
+
+        self.assertEqual(statements, [
+            "CREATE TABLE IF NOT EXISTS core_requestlog_p202611 PARTITION OF core_requestlog "
+            "FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')",
+            "CREATE TABLE IF NOT EXISTS core_requestlog_p202612 PARTITION OF core_requestlog "
+            "FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')",
+        ])
+
+    def test_ensure_daily_partitions(self):
+
+        statements = self.run_command(
+            "--ensure", "1", "--interval", "day", "--dry-run", legacy_bound=mock.Mock(return_value=None)
+        )
+
+        self.assertEqual(statements, [
+            "CREATE TABLE IF NOT EXISTS core_requestlog_p20261018 PARTITION OF core_requestlog "
+            "FOR VALUES FROM ('2026-10-18') TO ('2026-10-19')",
+            "CREATE TABLE IF NOT EXISTS core_requestlog_p20261019 PARTITION OF core_requestlog "
+            "FOR VALUES FROM ('2026-10-19') TO ('2026-10-20')",
+        ])
+
+    def test_prune_drops_partitions_past_the_retention(self):
+
+        statements = self.run_command(
+            "--prune", "--no-archive", "--dry-run", "--keep-months", "6",
+            is_partitioned=mock.Mock(return_value=True),
+            partitions=mock.Mock(return_value=[
+                "core_requestlog_default", "core_requestlog_legacy",
+                "core_requestlog_p202603", "core_requestlog_p202604", "core_requestlog_p20260331",
+            ])
+        )
+
+        self.assertEqual(statements, [
+            "Pruning RequestLog rows before 2026-04-01",
+            "ALTER TABLE core_requestlog DETACH PARTITION core_requestlog_p202603",
+            "DROP TABLE core_requestlog_p202603",
+            "ALTER TABLE core_requestlog DETACH PARTITION core_requestlog_p20260331",
+            "DROP TABLE core_requestlog_p20260331",
+            "0 rows would be deleted",
+        ])
+
+    def test_prune_archives_and_deletes_old_rows(self):
+
+        user = User.objects.create(username="03001234567")
+        old = [
+            RequestLog.objects.create(user=user, request_data={"n" : n}, created_at=datetime(2026, 3, 1, tzinfo=dt_timezone.utc))
+            for n in range(3)
+        ]
+        kept = RequestLog.objects.create(user=user, created_at=datetime(2026, 4, 1, tzinfo=dt_timezone.utc))
+
+        statements = self.run_command(
+            "--prune", "--archive-dir", self.archive_dir, "--chunk-size", "2", postgres=False
+        )
+
+        self.assertEqual(statements[-1], "Deleted 3 rows")
+        self.assertEqual(list(RequestLog.objects.values_list("id", flat=True)), [kept.id])
+
+        archive, = os.listdir(self.archive_dir)
+
+        with gzip.open(os.path.join(self.archive_dir, archive), "rt") as lines:
+            records = [json.loads(line) for line in lines]
+
+        self.assertEqual([record["id"] for record in records], [entry.id for entry in old])
+        self.assertEqual(records[0]["request_data"], {"n" : 0})
+
+
+class WalletLocalCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = WalletLocalCache()
+
+    def test_a_new_stamp_replaces_the_section(self):
+
+        self.cache.set("vouchers", 1, "old")
+        self.cache.set("vouchers", 1, b"old", kind="rendered")
+        self.cache.set("billers", 1, "billers")
+
+        self.assertEqual(self.cache.get("vouchers", 1), "old")
+        self.assertEqual(self.cache.get("vouchers", 1, "rendered"), b"old")
+
+        self.cache.set("vouchers", 2, "new")
+
+        self.assertIsNone(self.cache.get("vouchers", 1))
+        self.assertIsNone(self.cache.get("vouchers", 1, "rendered"))
+        self.assertEqual(self.cache.get("vouchers"), "new")
+        self.assertEqual(self.cache.get("billers", 1), "billers")
+
+    @override_settings(WALLET_L1_TTL=10)
+    def test_entries_expire(self):
+
+        with mock.patch("core.redis_ops.time.monotonic", return_value=100):
+            self.cache.set("vouchers", 1, "value")
+
+        with mock.patch("core.redis_ops.time.monotonic", return_value=109):
+            self.assertEqual(self.cache.get("vouchers", 1), "value")
+
+        with mock.patch("core.redis_ops.time.monotonic", return_value=111):
+            self.assertIsNone(self.cache.get("vouchers", 1))
+
+        self.assertFalse(self.cache.entries)
+
+    @override_settings(WALLET_L1_MAX_ENTRIES=2)
+    def test_least_recently_used_entry_is_evicted(self):
+
+        self.cache.set("vouchers", 1, "vouchers")
+        self.cache.set("billers", 1, "billers")
+        self.cache.get("vouchers", 1)
+        self.cache.set("telcos", 1, "telcos")
+
+        self.assertIsNone(self.cache.get("billers", 1))
+        self.assertEqual(self.cache.get("vouchers", 1), "vouchers")
+
+    def test_value_read_before_a_drop_is_not_stored(self):
+
+        generation = self.cache.generation("vouchers")
+        billers = self.cache.generation("billers")
+
+        self.cache.drop("vouchers")
+        self.cache.set("vouchers", 1, "stale", generation)
+        self.cache.set("billers", 1, "billers", billers)
+
+        self.assertIsNone(self.cache.get("vouchers", 1))
+        self.assertEqual(self.cache.get("billers", 1), "billers")
+
+        # dropping everything moves every section's generation
+        self.cache.drop()
+        self.cache.set("billers", 2, "stale", billers)
+
+        self.assertIsNone(self.cache.get("billers"))
+
+    def test_listener_drops_published_sections(self):
+
+        self.cache.set("vouchers", 1, "vouchers")
+        self.cache.set("billers", 1, "billers")
+
+        client = mock.Mock()
+
+        def listen():
+            # checked after the first message, before the listener stops
+            self.assertIsNone(self.cache.get("vouchers", 1))
+            self.assertEqual(self.cache.get("billers", 1), "billers")
+            yield from ()
+
+        client.pubsub.return_value.listen.return_value = itertools.chain([{"data" : "vouchers"}], listen())
+
+        with mock.patch("core.redis_ops.conn_udhaar", client):
+            self.cache.listen()
+
+        client.pubsub.return_value.subscribe.assert_called_once_with(WalletLocalCache.CHANNEL)
+
+        # a listener that stops can't be trusted with what it missed
+        self.assertFalse(self.cache.entries)
+
+    @override_settings(WALLET_L1_PUBSUB=True)
+    def test_listener_is_restarted_in_a_forked_process(self):
+
+        with mock.patch("core.redis_ops.threading.Thread") as thread:
+            thread.return_value.is_alive.return_value = True
+
+            self.assertTrue(self.cache.subscribed)
+            self.assertTrue(self.cache.subscribed)
+            self.assertEqual(thread.call_count, 1)
+
+            self.cache.set("vouchers", 1, "inherited")
+            self.cache.pid = -1
+
+            self.assertTrue(self.cache.subscribed)
+
+        self.assertEqual(thread.call_count, 2)
+        self.assertIsNone(self.cache.get("vouchers", 1))
+
+
+class RedisWalletCacheTest(SimpleTestCase):
+
+    def setUp(self):
+
+        self.redis = FakeRedis(decode_responses=True)
+
+        patcher = mock.patch("core.redis_ops.conn_udhaar", self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cache = RedisWalletCache()
+        self.redis.hset(RedisWalletCache.TIMESTAMP_HASH_KEY, "vouchers", 1)
+
+    def test_section_is_read_once_per_stamp(self):
+
+        self.cache.set_value("vouchers", [{"vendor_name" : "Free Fire"}])
+
+        with mock.patch.object(self.redis, "hget", wraps=self.redis.hget) as hget:
+
+            self.assertEqual(self.cache.get_value("vouchers"), [{"vendor_name" : "Free Fire"}])
+            self.assertEqual(self.cache.get_value("vouchers", timestamp=1), [{"vendor_name" : "Free Fire"}])
+            self.assertEqual(self.cache.get_rendered("vouchers", timestamp=1), b'[{"vendor_name":"Free Fire"}]')
+
+        # the stamp and the decoded section, then the section once more as bytes
+        self.assertEqual([call[0][0] for call in hget.call_args_list], [
+            RedisWalletCache.TIMESTAMP_HASH_KEY, RedisWalletCache.CACHE_HASH_KEY, RedisWalletCache.CACHE_HASH_KEY
+        ])
+
+    def test_new_stamp_is_read_through_and_published(self):
+
+        self.cache.set_value("vouchers", ["old"])
+        self.assertEqual(self.cache.get_value("vouchers"), ["old"])
+
+        self.cache.set_value("vouchers", ["new"])
+
+        with mock.patch("core.redis_ops.timezone.now", return_value=timezone.now() + timedelta(seconds=1)):
+            self.cache.update_timestamp("vouchers")
+
+        self.assertEqual(self.cache.get_value("vouchers"), ["new"])
+        self.assertEqual(self.redis.published, [(WalletLocalCache.CHANNEL, "vouchers")])
+
+    def test_subscribed_cache_skips_the_stamp(self):
+
+        self.cache.set_value("vouchers", ["value"])
+        self.cache.get_value("vouchers")
+
+        with mock.patch.object(WalletLocalCache, "subscribed", True), \
+                mock.patch.object(self.redis, "hget") as hget:
+            self.assertEqual(self.cache.get_value("vouchers"), ["value"])
+
+        hget.assert_not_called()
+
+    @override_settings(WALLET_L1_ENABLED=False)
+    def test_disabled_cache_reads_redis(self):
+
+        self.cache.set_value("vouchers", ["old"])
+        self.cache.get_value("vouchers")
+        self.cache.set_value("vouchers", ["new"])
+
+        self.assertEqual(self.cache.get_value("vouchers"), ["new"])
+
+
+class FanoutConnectionsTest(SimpleTestCase):
+    """Pool threads get no request_finished, their connections are handled after each task."""
+
+    def run_task(self, max_age, broken=False):
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        conn = SQLiteWrapper(dict(
+            connections.settings["default"], NAME=os.path.join(directory.name, "db.sqlite3"), CONN_MAX_AGE=max_age
+        ))
+        self.addCleanup(conn.close)
+
+        def task():
+            conn.ensure_connection()
+            conn.errors_occurred = broken
+
+        with mock.patch("core.fanout.connections") as handler:
+            handler.all.return_value = [conn]
+            _run(task, ())
+
+        return conn
+
+    def test_connection_is_closed_after_each_task_by_default(self):
+        self.assertIsNone(self.run_task(max_age=0).connection)
+
+    def test_persistent_connection_is_kept(self):
+        self.assertIsNotNone(self.run_task(max_age=None).connection)
+        self.assertIsNotNone(self.run_task(max_age=60).connection)
+
+    def test_broken_persistent_connection_is_closed(self):
+
+        with mock.patch.object(SQLiteWrapper, "is_usable", return_value=False):
+            self.assertIsNone(self.run_task(max_age=None, broken=True).connection)
@@ -0,0 +1,234 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import pre_save, post_delete
+from django.dispatch import receiver
+from core.models import UserToken
+from core.redis_ops import conn
+
+log = logging.getLogger("django")
+
+TOKEN_VERSION = "v1"
+
+REVOKED_TOKENS_KEY = "revoked_auth_tokens"
+
+DEFAULT_REVOCATION_REFRESH = 5.0
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class ExpiredToken(InvalidToken):
+    pass
+
+
+def _b64encode(value):
+    return base64.urlsafe_b64encode(value).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def signing_keys():
+    """kid -> secret, settings.AUTH_TOKEN_SIGNING_KEYS or the django SECRET_KEY."""
+    return getattr(settings, "AUTH_TOKEN_SIGNING_KEYS", None) or {"default": settings.SECRET_KEY}
+
+
+def active_key_id():
+    keys = signing_keys()
+    return getattr(settings, "AUTH_TOKEN_ACTIVE_KEY_ID", None) or next(iter(keys))
+
+
+def is_signed_token(token):
+    return token.startswith(TOKEN_VERSION + ".")
+
+
+def _signature(key, message):
+    return _b64encode(hmac.new(key.encode(), message.encode(), hashlib.sha256).digest())
+
+
+def sign_token(user, expires_at, key_id=None):
+    """
+    Self describing bearer token: user id, username, expiry (epoch seconds),
+    key id and a random jti, signed with HMAC-SHA256 under key_id.
+    """
+
+    key_id = key_id or active_key_id()
+
+    claims = {
+        "u" : user.id,
+        "n" : user.username,
+        "e" : int(expires_at),
+        "k" : key_id,
+        "j" : secrets.token_urlsafe(12),
+    }
+
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    message = "%s.%s" % (TOKEN_VERSION, payload)
+
+    return "%s.%s" % (message, _signature(signing_keys()[key_id], message))
+
+
+def verify_token(token, now=None):
+    """
+    Claims of a signed token. Raises InvalidToken for malformed, forged or
+    revoked tokens and ExpiredToken once the expiry has passed.
+    """
+
+    try:
+        version, payload, signature = token.split(".")
+    except ValueError:
+        raise InvalidToken("Malformed token")
+
+    if version != TOKEN_VERSION:
+        raise InvalidToken("Unknown token version")
+
+    try:
+        claims = json.loads(_b64decode(payload))
+    except (TypeError, ValueError):
+        raise InvalidToken("Malformed token")
+
+    if not isinstance(claims, dict):
+        raise InvalidToken("Malformed token")
+
+    key_id = claims.get("k")
+
+    if not isinstance(key_id, str):
+        raise InvalidToken("Malformed token")
+
+    key = signing_keys().get(key_id)
+
+    if key is None:
+        raise InvalidToken("Unknown signing key")
+
+    expected = _signature(key, "%s.%s" % (version, payload))
+
+    if not hmac.compare_digest(expected, signature):
+        raise InvalidToken("Bad signature")
+
+    if claims["e"] <= (now or time.time()):
+        raise ExpiredToken("Token expired")
+
+    if revoked_tokens.is_revoked(claims["j"]):
+        raise InvalidToken("Token revoked")
+
+    return claims
+
+
+def token_user(claims):
+    """
+    User built from the token claims without a query. Only id and username
+    are loaded, any other field is fetched on first access and save() only
+    writes the loaded fields.
+    """
+    return User.from_db("default", ["id", "username"], [claims["u"], claims["n"]])
+
+
+class RevocationSet:
+    """
+    jti's of revoked signed tokens. Kept in a redis sorted set scored by the
+    token expiry, so entries drop out once the token would have expired
+    anyway, and mirrored in-process for REVOCATION_REFRESH seconds.
+    """
+
+    def __init__(self, client=None, refresh_interval=None):
+        self.client = client or conn
+        self.refresh_interval = refresh_interval or getattr(
+            settings, "AUTH_TOKEN_REVOCATION_REFRESH", DEFAULT_REVOCATION_REFRESH
+        )
+        self._revoked = frozenset()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def refresh_due(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_interval
+
+    def refresh(self):
+
+        now = time.monotonic()
+
+        if not self.refresh_due():
+            return
+
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            self.client.zremrangebyscore(REVOKED_TOKENS_KEY, "-inf", time.time())
+            self._revoked = frozenset(
+                jti.decode() if isinstance(jti, bytes) else jti
+                for jti in self.client.zrange(REVOKED_TOKENS_KEY, 0, -1)
+            )
+        except Exception as e:
+            log.warning("Token revocation set unavailable: %s" % e)
+        finally:
+            self._loaded_at = now
+            self._lock.release()
+
+    def is_revoked(self, jti):
+        self.refresh()
+        return jti in self._revoked
+
+    def revoke(self, jti, expires_at):
+        self.client.zadd(REVOKED_TOKENS_KEY, {jti: int(expires_at)})
+        self._revoked = self._revoked | {jti}
+
+
+revoked_tokens = RevocationSet()
+
+
+def revoke_token(token):
+    """Revokes a signed token string, e.g. UserToken.token."""
+
+    if not is_signed_token(token):
+        return False
+
+    try:
+        claims = json.loads(_b64decode(token.split(".")[1]))
+    except (IndexError, TypeError, ValueError):
+        return False
+
+    if not isinstance(claims, dict) or not isinstance(claims.get("j"), str):
+        return False
+
+    revoked_tokens.revoke(claims["j"], claims.get("e") or time.time())
+    return True
+
+
+def revoke_on_commit(token):
+    """Revokes token once the surrounding transaction commits."""
+
+    def revoke():
+        try:
+            revoke_token(token)
+        except Exception as e:
+            log.warning("Token revocation set unavailable: %s" % e)
+
+    transaction.on_commit(revoke)
+
+
+@receiver(pre_save, sender=UserToken)
+def revoke_replaced_token(sender, instance, **kwargs):
+
+    if instance.pk is None:
+        return
+
+    previous = sender.objects.filter(pk=instance.pk).values_list("token", flat=True).first()
+
+    if previous and previous != instance.token:
+        revoke_on_commit(previous)
+
+
+@receiver(post_delete, sender=UserToken)
+def revoke_deleted_token(sender, instance, **kwargs):
+    revoke_on_commit(instance.token)
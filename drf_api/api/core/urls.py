@@ -1,6 +1,6 @@
-from django.conf.urls import url
+from core.routes import route
 from .views import *
 
 urlpatterns = [
-    url(r'^generate/token$', TokenGenerationView.as_view(), {'auth': False,'ip_security':'all'})
+    route(r'^generate/token$', TokenGenerationView.as_view(), 'core-generate-token', auth=False, ip_security='all')
 ]
\ No newline at end of file
@@ -1,16 +1,14 @@
 from core.permissions import IsMerchantActive
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
+from rest_framework import exceptions
 from core.permissions import UserAuthentication
+from core.payload import get_payload
+from core.principal import principals
+from core.views import AsyncAPIView
 
 
-class WalletView(APIView):
-    """
-    It is a Base View for user authentication on wallet.
-    Every Wallet API Must be inherited from this View.
-    """
-    authentication_classes = (UserAuthentication, )
-    permission_classes = (IsAuthenticated, IsMerchantActive)
+class WalletResponses:
     
     SUCCESS = "SUCCESS"
     FRAUD_USER = "FRAUDULENT_USER"
@@ -40,4 +38,39 @@ class WalletView(APIView):
         return {
             "response_code" : self.RESPONSE_CODES.get(message),
             "response_description" : message
-        }
\ No newline at end of file
+        }
+
+
+class WalletView(WalletResponses, APIView):
+    """
+    It is a Base View for user authentication on wallet.
+    Every Wallet API Must be inherited from this View.
+    """
+    authentication_classes = (UserAuthentication, )
+    permission_classes = (IsAuthenticated, IsMerchantActive)
+
+
+class AsyncWalletView(WalletResponses, AsyncAPIView):
+    """
+    WalletView for async handlers, with the same secret key authentication
+    and merchant checks answering with the same responses.
+    """
+    
+    www_authenticate = UserAuthentication.keyword
+    
+    async def initial(self, request):
+        
+        data = get_payload(request).data
+        
+        if not data.get('secret_key'):
+            raise exceptions.NotAuthenticated()
+        
+        principal = await principals.afor_request(request, data.get('phone_number'), data.get('secret_key'))
+        
+        if principal is None:
+            raise exceptions.AuthenticationFailed('User Unauthorized')
+        
+        request.user = principal.build_user()
+        request.auth = principal
+        
+        IsMerchantActive().has_permission(request, self)
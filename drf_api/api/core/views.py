@@ -7,8 +7,16 @@ from datetime import timedelta
 from django.contrib.auth.models import User
 from django.utils import timezone
 from core.permissions import IsTokenValid
+from core.tokens import sign_token, is_signed_token, revoke_on_commit
+from django.conf import settings
+import time
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.exceptions import APIException, AuthenticationFailed, NotAuthenticated
+from django.http import HttpResponse
+from django.views import View
+from core.redis_ops import render_json
+import asyncio
 import logging
 import traceback
 
@@ -18,9 +26,7 @@ log = logging.getLogger("django")
 
 log = logging.getLogger("django")
 
-class AuthView(APIView):
-    
-    permission_classes = [IsTokenValid]
+class AuthResponses:
     
     PROCESSED_OK = "Success"
     INVALID_USERNAME = "Invalid Username"
@@ -60,16 +66,109 @@ class AuthView(APIView):
         LIMIT_OUT : "007"
     }
 
+
+class AuthView(AuthResponses, APIView):
+    
+    permission_classes = [IsTokenValid]
+
+
+class AsyncAPIView(View):
+    """
+    Class based view with async handlers, for the ASGI deployment.
+    
+    Django 3.2 only awaits function views, so as_view() returns one. Like
+    APIView it is csrf exempt, turns APIException into its JSON response
+    and renders bodies exactly as DRF's JSONRenderer. Request data comes
+    from core.payload, initial() is where subclasses authenticate.
+    """
+    
+    # WWW-Authenticate sent with a 401, without one DRF answers 403
+    www_authenticate = None
+    
+    @classmethod
+    def as_view(cls, **initkwargs):
+        
+        for key in initkwargs:
+            if not hasattr(cls, key):
+                raise TypeError("%s() received an invalid keyword %r" % (cls.__name__, key))
+        
+        async def view(request, *args, **kwargs):
+            self = cls(**initkwargs)
+            self.setup(request, *args, **kwargs)
+            return await self.dispatch(request, *args, **kwargs)
+        
+        view.view_class = cls
+        view.view_initkwargs = initkwargs
+        view.csrf_exempt = True
+        view.__doc__ = cls.__doc__
+        view.__module__ = cls.__module__
+        view.__name__ = cls.__name__
+        
+        return view
+    
+    async def dispatch(self, request, *args, **kwargs):
+        
+        handler = self.http_method_not_allowed
+        
+        if request.method.lower() in self.http_method_names:
+            handler = getattr(self, request.method.lower(), handler)
+        
+        try:
+            await self.initial(request)
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except APIException as exc:
+            response = self.exception_response(exc)
+        
+        return response
+    
+    async def initial(self, request):
+        pass
+    
+    def respond(self, data, status=200):
+        """JSON response of data, which stays readable as response.data."""
+        
+        response = HttpResponse(render_json(data), content_type="application/json", status=status)
+        response.data = data
+        
+        return response
+    
+    def exception_response(self, exc):
+        
+        detail = exc.detail if isinstance(exc.detail, (dict, list)) else {"detail" : exc.detail}
+        status = exc.status_code
+        
+        if isinstance(exc, (NotAuthenticated, AuthenticationFailed)) and not self.www_authenticate:
+            status = 403
+        
+        response = self.respond(detail, status)
+        
+        if status == 401:
+            response["WWW-Authenticate"] = self.www_authenticate
+        
+        return response
+
+
+class AsyncAuthView(AuthResponses, AsyncAPIView):
+    """AuthView for async handlers, the bearer token is checked in initial()."""
+    
+    async def initial(self, request):
+        request.user = await IsTokenValid().aauthenticate(request.headers.get("Authorization"))
+
 class TokenGenerationView(AuthView):
     
     permission_classes = []
     
-    def generate_token(self, user, expiration_seconds=31536000):
+    def generate_token(self, user, expiration_seconds=31536000, signed=None):
+        
+        if signed is None:
+            signed = getattr(settings, "AUTH_TOKEN_SIGNED", False)
         
         try:
             user_token = UserToken.objects.filter(user=user).order_by('-id').first()
 
-            if user_token and not user_token.is_expired():
+            if user_token and not user_token.is_expired() and is_signed_token(user_token.token) == signed:
                 return {
                     "access_token": user_token.token,
                     "token_type": "Bearer",
@@ -82,7 +181,10 @@ class TokenGenerationView(AuthView):
         except UserToken.DoesNotExist:
             pass
         
-        token = secrets.token_urlsafe(64)
+        if signed:
+            token = sign_token(user, time.time() + expiration_seconds)
+        else:
+            token = secrets.token_urlsafe(64)
 
         issued_at = timezone.now() + timedelta(hours=5)
         expires_at = issued_at + timedelta(seconds=expiration_seconds)
@@ -94,6 +196,10 @@ class TokenGenerationView(AuthView):
             expiry_time=expiration_seconds,
             issued_at_gmt=issued_at
         )
+        
+        # rotated, the previous signed token stops verifying
+        if user_token and not user_token.is_expired():
+            revoke_on_commit(user_token.token)
 
         return {
             "access_token" : token,
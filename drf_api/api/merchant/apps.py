@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class MerchantConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'merchant'
+
+    def ready(self):
+        from merchant.catalog import connect_warm_signals
+        import merchant.checks  # noqa: registers the system checks
+
+        connect_warm_signals()
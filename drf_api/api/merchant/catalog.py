@@ -0,0 +1,427 @@
+import hashlib
+import json
+import logging
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from django.db.models.signals import post_save, post_delete
+from redis.exceptions import RedisError
+from core.locks import RedisLeaseLockBackend
+from core.redis_ops import rds_cache, render_json
+
+log = logging.getLogger("django")
+
+POPULAR_VOUCHER_VENDORS = ['Free Fire', 'PUBG [US]', 'RazerGold [USA]']
+
+BILLER_BUSINESS_TYPES = ['Electricity', 'Gas', 'Internet']
+
+BILLER_LIST_FIELDS = (
+    'name',
+    'icon',
+    'commission',
+    'commission_type',
+    'start',
+    'len_of_consumer_number'
+)
+
+CATALOG_SECTIONS = {
+    'vouchers' : 'available_vouchers',
+    'billers' : 'available_billers'
+}
+
+
+def build_voucher_data():
+    """
+    Voucher catalog of the popular vendors in two queries, the vendors and
+    one prefetch of all their active vouchers.
+    """
+
+    vendor_model = apps.get_model('vouchers', 'vendor')
+    voucher_model = vendor_model._meta.get_field('vouchers').related_model
+
+    all_vendors = vendor_model.objects.filter(
+        active=True, name__in=POPULAR_VOUCHER_VENDORS
+    ).prefetch_related(
+        Prefetch(
+            'vouchers',
+            queryset=voucher_model.objects.filter(active=True),
+            to_attr='active_vouchers'
+        )
+    )
+
+    data = []
+
+    for vendor in all_vendors:
+
+        insertion = {
+            'vendor_name' : vendor.name,
+            'icon' : vendor.icon,
+            'commission' : vendor.commission,
+            'favicon':vendor.favicon,
+            'vouchers' : []
+        }
+
+        for voucher in vendor.active_vouchers:
+
+            dc = {
+                'voucher_id':voucher.id,
+                'voucher_type':voucher.name,
+                'price':voucher.cost_original,
+                'short_description':voucher.short_description,
+                'long_description':voucher.long_description
+            }
+
+            if voucher.cost_discounted < voucher.cost_original:
+                dc['dicounted_price']= voucher.cost_discounted
+
+            else:
+                dc['dicounted_price']= None
+
+            icons = voucher.icon
+            icons = icons.split(',')
+            dc['icon']= icons
+
+            insertion['vouchers'].append(dc)
+
+        if insertion['vouchers']:
+            data.append(insertion)
+
+    return data
+
+
+def build_billers_data():
+    """
+    Biller catalog grouped by business type in a single query. The business
+    icon is taken from the first biller of the type, active or not, as before.
+    This is the shared base layer, the caller's earning rule is overlaid by
+    with_earning_rule().
+    """
+
+    biller_model = apps.get_model('bills', 'billers')
+    ordering = biller_model._meta.ordering or ['pk']
+
+    rows = biller_model.objects.filter(
+        business__in=BILLER_BUSINESS_TYPES
+    ).order_by(*ordering).values('business', 'business_icon', 'active', *BILLER_LIST_FIELDS)
+
+    grouped = {}
+
+    for row in rows:
+
+        business_type = grouped.get(row['business'])
+
+        if business_type is None:
+            business_type = grouped[row['business']] = {
+                'business' : row['business'],
+                'business_icon' : row['business_icon'],
+                'business_list' : []
+            }
+
+        if row['active']:
+            business_type['business_list'].append(
+                {field: row[field] for field in BILLER_LIST_FIELDS}
+            )
+
+    res = []
+
+    for business in BILLER_BUSINESS_TYPES:
+
+        dict_type = grouped.get(business)
+
+        if dict_type is None or not dict_type['business_list']:
+            continue
+
+        res.append(dict_type)
+
+    return res
+
+
+_rebuild_locks = None
+
+
+def rebuild_locks():
+    global _rebuild_locks
+
+    if _rebuild_locks is None:
+        _rebuild_locks = RedisLeaseLockBackend(
+            lease_ms=getattr(settings, "WALLET_REBUILD_LEASE_MS", 10000)
+        )
+
+    return _rebuild_locks
+
+
+def store_section(section, build):
+    """
+    Builds the section and caches it, unless the section was cleared while
+    it was being built (the result may predate the change). The stamp is
+    checked and the value written in one script, so a clear can't land
+    between the two.
+    """
+
+    timestamp = rds_cache.get_timestamp(section)
+    data = build()
+
+    rds_cache.set_value_if_stamp(section, data, timestamp)
+
+    return data
+
+
+def rebuild_section(section, build):
+    """
+    Single-flight rebuild of a missing section. One worker holds the
+    section's rebuild lease and queries the database, the others serve the
+    stale copy kept by clear_value, or wait up to WALLET_REBUILD_WAIT_MS for
+    the rebuild when there is none.
+    """
+
+    key = "wallet_rebuild:%s" % section
+
+    try:
+        with rebuild_locks().lock(key) as attempt:
+            if attempt.lease is not None:
+                return store_section(section, build)
+
+        stale = rds_cache.get_stale_value(section)
+
+        if stale is not None:
+            return stale
+
+        with rebuild_locks().lock(key, getattr(settings, "WALLET_REBUILD_WAIT_MS", 2000)) as attempt:
+
+            value = rds_cache.load_value(section)
+
+            if value is not None:
+                return value
+
+            if attempt.lease is not None:
+                return store_section(section, build)
+
+    except RedisError as e:
+        # rebuild without coordination, as before
+        log.warning("Wallet %s rebuild lock unavailable: %s" % (section, e))
+
+    return build()
+
+
+def get_voucher_data(timestamp=None):
+
+    cache_value = rds_cache.get_value(type="vouchers", timestamp=timestamp)
+
+    if cache_value:
+        return cache_value
+
+    return rebuild_section("vouchers", build_voucher_data)
+
+
+def with_earning_rule(billers, earning_rule):
+    """Copy of the base biller catalog with the caller's earning rule on every business type."""
+    return [dict(business_type, earning_rule=earning_rule) for business_type in billers]
+
+
+def get_base_billers_data(timestamp=None):
+
+    cache_value = rds_cache.get_value(type="billers", timestamp=timestamp)
+
+    if cache_value:
+        return cache_value
+
+    return rebuild_section("billers", build_billers_data)
+
+
+def get_billers_data(earning_rule=None, timestamp=None):
+    return with_earning_rule(get_base_billers_data(timestamp), earning_rule)
+
+
+SECTION_BUILDERS = {
+    'vouchers' : build_voucher_data,
+    'billers' : build_billers_data
+}
+
+
+def warm_section(section):
+    """
+    Rebuilds a section ahead of requests, after its rows changed. The new
+    value is stored before the stamp moves so readers never see a blank
+    section. When a rebuild is already running the section is cleared
+    instead and rebuilt by the next request.
+    """
+
+    with rebuild_locks().lock("wallet_rebuild:%s" % section) as attempt:
+
+        if attempt.lease is None:
+            rds_cache.clear_and_update_timestamp(section)
+            return False
+
+        rds_cache.set_value(type=section, obj=SECTION_BUILDERS[section]())
+        rds_cache.update_timestamp(section)
+
+    return True
+
+
+def section_models():
+    """(section, model) pairs whose rows feed the catalog, for installed apps."""
+
+    pairs = []
+
+    if apps.is_installed('vouchers'):
+        vendor_model = apps.get_model('vouchers', 'vendor')
+        pairs.append(('vouchers', vendor_model))
+        pairs.append(('vouchers', vendor_model._meta.get_field('vouchers').related_model))
+
+    if apps.is_installed('bills'):
+        pairs.append(('billers', apps.get_model('bills', 'billers')))
+
+    return pairs
+
+
+def connect_warm_signals():
+    """With WALLET_CACHE_WARM_ON_SAVE, rebuild a section when its rows change."""
+
+    if not getattr(settings, "WALLET_CACHE_WARM_ON_SAVE", False):
+        return
+
+    for section, model in section_models():
+
+        def rows_changed(sender, section=section, **kwargs):
+            transaction.on_commit(lambda: _warm_quietly(section))
+
+        post_save.connect(rows_changed, sender=model, weak=False)
+        post_delete.connect(rows_changed, sender=model, weak=False)
+
+
+def _warm_quietly(section):
+    try:
+        warm_section(section)
+    except Exception as e:
+        log.exception(e)
+
+
+def get_rendered_section(section, earning_rule=None, timestamp=None):
+    """Section as pre-rendered JSON bytes, rebuilding the cache on a miss."""
+
+    if section == 'billers':
+        return get_rendered_billers(earning_rule, timestamp)
+
+    rendered = rds_cache.get_rendered(section, timestamp)
+
+    if rendered is not None:
+        return rendered
+
+    return render_json(get_voucher_data(timestamp)).encode('utf-8')
+
+
+def rendered_section_kind(section, earning_rule=None):
+    """Kind under which the process cache keeps a rendered section."""
+
+    if section == 'billers':
+        return 'rendered:%s' % _digest(earning_rule)
+
+    return 'rendered'
+
+
+def local_rendered_section(section, earning_rule=None, timestamp=None):
+    """
+    Rendered section from the process cache only, None unless it is held
+    for this exact stamp. Lets async views skip the thread hop on a hit.
+    """
+
+    if timestamp is None or not rds_cache.local.enabled:
+        return None
+
+    return rds_cache.local.get(
+        section, timestamp, rendered_section_kind(section, earning_rule)
+    )
+
+
+def get_rendered_billers(earning_rule=None, timestamp=None):
+    """
+    Rendered biller catalog for one earning rule. Variants are kept per
+    rule digest in the process cache next to the decoded base layer, so
+    each distinct rule is rendered once per catalog stamp.
+    """
+
+    def render(type):
+        return render_json(get_billers_data(earning_rule, timestamp)).encode('utf-8')
+
+    return rds_cache.cached(
+        'billers',
+        timestamp,
+        rendered_section_kind('billers', earning_rule),
+        render
+    )
+
+
+def splice_json(fields, fragments):
+    """
+    JSON object of fields rendered now followed by pre-rendered fragments,
+    joined as bytes.
+    """
+
+    pieces = []
+    literal = render_json(fields)[:-1]
+
+    for name, fragment in fragments.items():
+        literal += ("," if literal != "{" else "") + render_json(name) + ":"
+        pieces.append(literal.encode('utf-8'))
+        pieces.append(fragment)
+        literal = ""
+
+    pieces.append((literal + "}").encode('utf-8'))
+
+    return b"".join(pieces)
+
+
+def _digest(value):
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True, default=str).encode()
+    ).hexdigest()[:12]
+
+
+def catalog_timestamps():
+    return rds_cache.get_timestamps(CATALOG_SECTIONS.keys())
+
+
+def catalog_versions(earning_rule=None, timestamps=None):
+    """
+    Version of each catalog section as sent to clients, the wallet_timestamps
+    stamp of the section. Billers embed the client's earning rule, so its
+    digest is part of the billers version. None when a section has no stamp
+    yet, such a section is always sent.
+    """
+
+    timestamps = timestamps if timestamps is not None else catalog_timestamps()
+    versions = {}
+
+    for section, timestamp in timestamps.items():
+
+        if timestamp is None:
+            versions[section] = None
+
+        elif section == 'billers':
+            versions[section] = "%s.%s" % (timestamp, _digest(earning_rule))
+
+        else:
+            versions[section] = str(timestamp)
+
+    return versions
+
+
+def catalog_etag(versions, **state):
+    """Weak ETag of a wallet response, None when any section is unversioned."""
+
+    if any(version is None for version in versions.values()):
+        return None
+
+    return 'W/"%s"' % _digest({'versions' : versions, 'state' : state})
+
+
+def changed_sections(versions, known_versions):
+    """Sections whose current version differs from the one the client holds."""
+
+    known_versions = known_versions if isinstance(known_versions, dict) else {}
+
+    return [
+        section for section, version in versions.items()
+        if version is None or str(known_versions.get(section)) != version
+    ]
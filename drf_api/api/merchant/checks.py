@@ -0,0 +1,25 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+@register()
+def credit_limits_check(app_configs, **kwargs):
+    """Every account level needs daily and monthly credit limits, CreditView refuses credits otherwise."""
+
+    account = apps.get_model("transaction", "account")
+    limits = getattr(settings, "MERCHANT_CREDIT_LIMITS", None) or {}
+    errors = []
+
+    for level, _ in account.LEVEL_CHOICES:
+
+        windows = limits.get(level) or {}
+
+        if not all(isinstance(windows.get(window), int) for window in ("daily", "monthly")):
+            errors.append(Error(
+                "MERCHANT_CREDIT_LIMITS has no daily and monthly limits for level %s" % level,
+                hint='Set MERCHANT_CREDIT_LIMITS["%s"] = {"daily": ..., "monthly": ...} in api/environment.py.' % level,
+                id="merchant.E001",
+            ))
+
+    return errors
@@ -0,0 +1,244 @@
+import logging
+from datetime import timedelta
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from core.redis_ops import conn
+
+log = logging.getLogger("django")
+
+# limit windows are Pakistan calendar days and months
+PKT_OFFSET = timedelta(hours=5)
+
+MONTH_FIELD = "month"
+VERSION_FIELD = "version"
+
+
+def local_now(now=None):
+    return (now or timezone.now()) + PKT_OFFSET
+
+
+def day_field(local):
+    return "d%02d" % local.day
+
+
+def month_bounds(local):
+    """UTC (start, end) of the PKT month holding local."""
+
+    start = local.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+
+    return start - PKT_OFFSET, end - PKT_OFFSET
+
+
+def month_days(local):
+    """(first day, first day of the next month) of the PKT month holding local."""
+
+    start, end = month_bounds(local)
+
+    return (start + PKT_OFFSET).date(), (end + PKT_OFFSET).date()
+
+
+class CreditCounters:
+    """
+    Credited amount per merchant for the current day and month, kept in one
+    redis hash per merchant and month ("month" plus a "dDD" field per day),
+    so reading both costs a single HMGET whatever the merchant's history.
+
+    A credit is a DEPOSITED action that has not failed, counted with its
+    delta. Actions.save() bumps the counters after a new one commits. A
+    month hash that is missing (new month, lost redis) is rebuilt from the
+    merchant's ActionsDailyRollup rows on first read. Deposits that fail
+    later are corrected by the reconcile_credit_counters command, which
+    runs periodically.
+
+    Every bump also moves the hash's "version", a rebuild only replaces the
+    hash if the version is still the one read before loading the totals, so
+    it can't erase a credit the database didn't have yet.
+    """
+
+    KEY_PREFIX = "merchant_credits:"
+
+    # attempts of a rebuild racing with new credits before leaving it to the next read
+    REBUILD_ATTEMPTS = 3
+
+    # a hash without "month" only holds the version, it's rebuilt from the
+    # database (which already has this credit) on the next read
+    RECORD_SCRIPT = """
+    redis.call("hincrby", KEYS[1], ARGV[4], 1)
+    redis.call("expireat", KEYS[1], ARGV[5])
+    if redis.call("hexists", KEYS[1], ARGV[1]) == 0 then
+        return 0
+    end
+    redis.call("hincrby", KEYS[1], ARGV[1], ARGV[3])
+    redis.call("hincrby", KEYS[1], ARGV[2], ARGV[3])
+    return 1
+    """
+
+    # ARGV: version field, expected version, expiry, then field, value pairs
+    STORE_SCRIPT = """
+    local version = redis.call("hget", KEYS[1], ARGV[1]) or ""
+    if version ~= ARGV[2] then
+        return 0
+    end
+    if version == "" then
+        version = "0"
+    end
+    redis.call("del", KEYS[1])
+    redis.call("hset", KEYS[1], ARGV[1], version, unpack(ARGV, 4))
+    redis.call("expireat", KEYS[1], ARGV[3])
+    return 1
+    """
+
+    def __init__(self, client=None):
+        self.client = client or conn
+        self._record = self.client.register_script(self.RECORD_SCRIPT)
+        self._store = self.client.register_script(self.STORE_SCRIPT)
+
+    def redis_key(self, merchant_id, local):
+        return "%s%s%s:%s" % (settings.ENV, self.KEY_PREFIX, merchant_id, local.strftime("%Y%m"))
+
+    def expiry(self, local):
+        # kept a few days past the month for late reads and reconciliation
+        _, end = month_bounds(local)
+        return int((end + timedelta(days=3)).timestamp())
+
+    def record(self, merchant_id, amount, now=None):
+
+        local = local_now(now)
+
+        self._record(
+            keys=[self.redis_key(merchant_id, local)],
+            args=[MONTH_FIELD, day_field(local), int(amount), VERSION_FIELD, self.expiry(local)]
+        )
+
+    def credits(self):
+        """ActionsDailyRollup rows counting credits."""
+
+        actions = apps.get_model("merchant", "actions")
+        rollup = apps.get_model("merchant", "actionsdailyrollup")
+
+        return rollup.objects.filter(type=actions.ACTION_TYPE_DEPOSITED).exclude(
+            status=actions.STATUS_TYPE_FAILED
+        )
+
+    def load(self, merchant_id, local):
+        """{field: amount} of the merchant's credits in the month of local, from the database."""
+
+        first, last = month_days(local)
+
+        rows = self.credits().filter(
+            merchant_id=merchant_id,
+            day__gte=first,
+            day__lt=last
+        ).values_list("day", "total_delta")
+
+        totals = {MONTH_FIELD : 0}
+
+        for day, delta in rows:
+            amount = int(round(delta or 0))
+            field = day_field(day)
+            totals[field] = totals.get(field, 0) + amount
+            totals[MONTH_FIELD] += amount
+
+        return totals
+
+    def store(self, merchant_id, local, totals, version):
+        """Replaces the month hash with totals unless its version moved past version."""
+
+        fields = []
+
+        for field, amount in totals.items():
+            fields += [field, amount]
+
+        return bool(self._store(
+            keys=[self.redis_key(merchant_id, local)],
+            args=[VERSION_FIELD, version or "", self.expiry(local)] + fields
+        ))
+
+    def reconcile(self, merchant_id, now=None):
+        """Rewrites the merchant's counters for the current month from the database."""
+
+        local = local_now(now)
+        key = self.redis_key(merchant_id, local)
+
+        for attempt in range(self.REBUILD_ATTEMPTS):
+
+            # read before the totals, a credit counted after it moves it
+            version = self.client.hget(key, VERSION_FIELD)
+            totals = self.load(merchant_id, local)
+
+            if self.store(merchant_id, local, totals, version):
+                return totals
+
+        log.warning("Credit counters of merchant %s kept moving while rebuilt" % merchant_id)
+
+        return totals
+
+    def usage(self, merchant_id, now=None):
+        """(credited today, credited this month) of the merchant."""
+
+        local = local_now(now)
+
+        try:
+            month, day = self.client.hmget(
+                self.redis_key(merchant_id, local), MONTH_FIELD, day_field(local)
+            )
+
+            if month is None:
+                totals = self.reconcile(merchant_id, now)
+                return totals.get(day_field(local), 0), totals[MONTH_FIELD]
+
+        except Exception as e:
+            log.warning("Credit counters unavailable: %s" % e)
+            totals = self.load(merchant_id, local)
+            return totals.get(day_field(local), 0), totals[MONTH_FIELD]
+
+        return int(day or 0), int(month)
+
+
+credit_counters = CreditCounters()
+
+
+def record_credit(merchant_id, amount, created):
+    try:
+        credit_counters.record(merchant_id, amount, created)
+    except Exception as e:
+        # the counters are rebuilt from the actions by reconciliation
+        log.warning("Credit counters unavailable: %s" % e)
+
+
+def credit_limits(level):
+    """
+    {"daily", "monthly"} credit limits of an account level, from the
+    deployment's MERCHANT_CREDIT_LIMITS, in the unit of Actions.delta.
+    """
+
+    limits = getattr(settings, "MERCHANT_CREDIT_LIMITS", None)
+
+    if not limits or level not in limits:
+        raise ImproperlyConfigured("MERCHANT_CREDIT_LIMITS has no limits for level %s" % level)
+
+    return limits[level]
+
+
+class MerchantLimits:
+    """Credit limits of a merchant's account level against its credit counters."""
+
+    def __init__(self, merchant_id, level):
+        self.merchant_id = merchant_id
+        self.limits = credit_limits(level)
+        self.daily_credit, self.monthly_credit = credit_counters.usage(merchant_id)
+
+    @property
+    def available_daily_credit_limit(self):
+        return max(self.limits["daily"] - self.daily_credit, 0)
+
+    @property
+    def available_monthly_credit_limit(self):
+        return max(self.limits["monthly"] - self.monthly_credit, 0)
+
+    @property
+    def available_credit_limit(self):
+        return min(self.available_daily_credit_limit, self.available_monthly_credit_limit)
@@ -0,0 +1,212 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections, transaction
+from django.utils import timezone
+from merchant.models import Merchant, Actions, ActionsDailyRollup
+from merchant.limits import PKT_OFFSET
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError("Dates are YYYY-MM-DD, got %s" % value)
+
+
+def day_start(day):
+    """UTC start of a Pakistan calendar day."""
+    return datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc) - PKT_OFFSET
+
+
+def aggregate(merchant_ids, start, end):
+    """{(merchant_id, day, type, status): [count, delta]} of the merchants' actions from start to end."""
+
+    totals = {}
+
+    rows = Actions.objects.filter(
+        merchant_id__in=merchant_ids,
+        created__gte=day_start(start),
+        created__lt=day_start(end + timedelta(days=1))
+    ).values_list("merchant_id", "created", "type", "status", "delta").iterator(chunk_size=5000)
+
+    for merchant_id, created, type, status, delta in rows:
+        key = (merchant_id, ActionsDailyRollup.day_of(created), type, status or "")
+        total = totals.setdefault(key, [0, 0])
+        total[0] += 1
+        total[1] += delta or 0
+
+    return totals
+
+
+def stored(merchant_ids, start, end):
+
+    rows = ActionsDailyRollup.objects.filter(
+        merchant_id__in=merchant_ids, day__gte=start, day__lte=end
+    ).values_list("merchant_id", "day", "type", "status", "count", "total_delta")
+
+    return {
+        (merchant_id, day, type, status) : [count, total_delta]
+        for merchant_id, day, type, status, count, total_delta in rows
+        if count or total_delta
+    }
+
+
+def lock(merchant_ids, start, end):
+    """{(merchant_id, day, type, status): row} of the chunk's rollup rows, locked."""
+
+    return {
+        (row.merchant_id, row.day, row.type, row.status) : row
+        for row in ActionsDailyRollup.objects.select_for_update().filter(
+            merchant_id__in=merchant_ids, day__gte=start, day__lte=end
+        )
+    }
+
+
+def rebuild_chunk(merchant_ids, start, end):
+    """Rewrites the chunk's rollup rows between start and end, returns the rows that changed."""
+
+    close_old_connections()
+
+    with transaction.atomic():
+
+        # Actions.save() updates these rows in its own transaction, locking
+        # them first makes it wait, so every action is either committed
+        # before the aggregate below or added on top of the rebuilt counts
+        rows = lock(merchant_ids, start, end)
+        totals = aggregate(merchant_ids, start, end)
+        missing = set(totals) - set(rows)
+
+        while missing:
+
+            # keys without a row get an empty one, locked with the others
+            # before aggregating again: an action saved meanwhile under one
+            # of them is then either counted here or added on top, never
+            # both. A row a concurrent save just created is kept and locked.
+            ActionsDailyRollup.objects.bulk_create([
+                ActionsDailyRollup(merchant_id=merchant_id, day=day, type=type, status=status)
+                for merchant_id, day, type, status in missing
+            ], batch_size=1000, ignore_conflicts=True)
+
+            rows = lock(merchant_ids, start, end)
+            totals = aggregate(merchant_ids, start, end)
+            missing = set(totals) - set(rows)
+
+        changed = [
+            row
+            for key, row in rows.items()
+            if [row.count, row.total_delta] != totals.get(key, [0, 0])
+        ]
+
+        for row in changed:
+            row.count, row.total_delta = totals.get((row.merchant_id, row.day, row.type, row.status), [0, 0])
+
+        ActionsDailyRollup.objects.bulk_update(changed, ["count", "total_delta"], batch_size=1000)
+
+    return len(changed)
+
+
+def check_chunk(merchant_ids, start, end):
+    """Ids of the chunk's merchants whose rollup differs from their actions."""
+
+    close_old_connections()
+
+    expected = aggregate(merchant_ids, start, end)
+    actual = stored(merchant_ids, start, end)
+    mismatched = set()
+
+    for key in set(expected) | set(actual):
+
+        expected_count, expected_delta = expected.get(key, (0, 0))
+        actual_count, actual_delta = actual.get(key, (0, 0))
+
+        if expected_count != actual_count or abs(expected_delta - actual_delta) > 1e-6:
+            mismatched.add(key[0])
+
+    return sorted(mismatched)
+
+
+def close_connections():
+    # forked workers must not share the parent's database connections
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    """
+    Maintenance of ActionsDailyRollup.
+
+        --rebuild      recompute the rollup of the days from the actions,
+                       in chunks of merchants spread over --workers processes
+        --check        compare the rollup with the actions, --fix rebuilds
+                       the merchants that differ
+
+    Days are Pakistan calendar days, --start defaults to a week ago and --end
+    to today.
+    """
+
+    help = "Rebuilds and checks the per-merchant daily Actions rollup"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true")
+        parser.add_argument("--check", action="store_true")
+        parser.add_argument("--fix", action="store_true")
+        parser.add_argument("--start", type=parse_day, default=None)
+        parser.add_argument("--end", type=parse_day, default=None)
+        parser.add_argument("--merchant", type=int, action="append", metavar="ID")
+        parser.add_argument("--chunk-size", type=int, default=200, help="Merchants per chunk")
+        parser.add_argument("--workers", type=int, default=4)
+
+    def handle(self, *args, **options):
+
+        if not (options["rebuild"] or options["check"]):
+            raise CommandError("Nothing to do, pass --rebuild or --check")
+
+        today = (timezone.now() + PKT_OFFSET).date()
+        end = options["end"] or today
+        start = options["start"] or end - timedelta(days=7)
+
+        if start > end:
+            raise CommandError("--start is after --end")
+
+        self.options = options
+        merchant_ids = options["merchant"] or list(
+            Merchant.objects.order_by("id").values_list("id", flat=True)
+        )
+
+        if options["rebuild"]:
+            written = sum(self.run(rebuild_chunk, merchant_ids, start, end))
+            self.stdout.write("Rebuilt %s to %s, %s rollup rows changed" % (start, end, written))
+
+        if options["check"]:
+
+            mismatched = [
+                merchant_id
+                for chunk_result in self.run(check_chunk, merchant_ids, start, end)
+                for merchant_id in chunk_result
+            ]
+
+            self.stdout.write("%s merchants differ from their actions" % len(mismatched))
+
+            for merchant_id in mismatched:
+                self.stdout.write("  merchant %s" % merchant_id)
+
+            if mismatched and options["fix"]:
+                sum(self.run(rebuild_chunk, mismatched, start, end))
+                self.stdout.write("Rebuilt %s merchants" % len(mismatched))
+
+    def run(self, func, merchant_ids, start, end):
+        """Runs func over chunks of merchant_ids, yields the chunk results."""
+
+        size = self.options["chunk_size"]
+        chunks = [merchant_ids[i:i + size] for i in range(0, len(merchant_ids), size)]
+
+        if self.options["workers"] <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                yield func(chunk, start, end)
+            return
+
+        close_connections()
+
+        with ProcessPoolExecutor(max_workers=self.options["workers"], initializer=close_connections) as pool:
+            for result in pool.map(func, chunks, [start] * len(chunks), [end] * len(chunks)):
+                yield result
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from merchant.limits import credit_counters, local_now, month_days
+
+
+class Command(BaseCommand):
+    """
+    Rewrites the merchants' daily and monthly credit counters (merchant.limits)
+    from their ActionsDailyRollup credit rows of the current month. Run it
+    periodically, e.g. every few minutes from cron, and after a redis restore.
+    """
+
+    help = "Rebuilds the merchant credit limit counters from the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--merchant", type=int, action="append", metavar="ID",
+            help="Merchant to reconcile, all merchants credited this month by default"
+        )
+
+    def handle(self, *args, **options):
+
+        merchant_ids = options["merchant"] or self.credited_merchants()
+
+        for merchant_id in merchant_ids:
+            totals = credit_counters.reconcile(merchant_id)
+            self.stdout.write("%s: %s this month" % (merchant_id, totals["month"]))
+
+    def credited_merchants(self):
+
+        first, last = month_days(local_now())
+
+        return credit_counters.credits().filter(
+            day__gte=first,
+            day__lt=last
+        ).order_by().values_list("merchant_id", flat=True).distinct()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from merchant.catalog import SECTION_BUILDERS, warm_section
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the wallet catalog sections into the cache, e.g. after a deploy
+    or a bulk import, so no request pays for the rebuild.
+    """
+
+    help = "Rebuilds the cached wallet catalog sections"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--section", action="append", choices=sorted(SECTION_BUILDERS),
+            help="Section to rebuild, all of them by default"
+        )
+
+    def handle(self, *args, **options):
+
+        for section in options["section"] or sorted(SECTION_BUILDERS):
+
+            if warm_section(section):
+                self.stdout.write("Rebuilt %s" % section)
+            else:
+                self.stdout.write("%s is being rebuilt elsewhere, cleared it instead" % section)
@@ -1,14 +1,18 @@
 from django.db import models
-from django.db import transaction
+from django.db import transaction, IntegrityError
 import uuid
 from django.contrib.auth.models import User
 from django.db.models import F, Sum
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 from django.core.exceptions import ValidationError
 from django.core.exceptions import ObjectDoesNotExist
 import re
 import base64
+from contextlib import contextmanager
+from contextvars import ContextVar
+from core.ids import id_allocator
+from merchant.limits import record_credit
 
 def random_secret_key():
     return uuid.uuid4().hex
@@ -21,6 +25,8 @@ def generate_unique_id():
 
 # Create your models here.
 
+_action_reference_template = ContextVar("action_reference_template", default=None)
+
 
 class Merchant(models.Model):
     USER_TYPE = (
@@ -310,6 +316,48 @@ class Actions(models.Model):
     base_currency=models.CharField(max_length=10, default='PKR')
     base_currency_delta=models.FloatField(null=True)
 
+    def save(self, *args, **kwargs):
+        """
+        Saves the action and moves it between ActionsDailyRollup rows in the
+        same transaction.
+
+        Saving an existing action first reads its stored rollup fields with
+        SELECT ... FOR UPDATE by primary key: one more indexed round trip,
+        and the row lock the UPDATE would take is held from that read on.
+        Saves whose update_fields leave the tracked fields out skip both.
+        """
+
+        update_fields = kwargs.get("update_fields")
+
+        if update_fields is not None and not ActionsDailyRollup.TRACKED_FIELDS.intersection(update_fields):
+            return super().save(*args, **kwargs)
+
+        adding = self._state.adding
+
+        with transaction.atomic():
+            previous = None if adding else ActionsDailyRollup.stored_values(self)
+            super().save(*args, **kwargs)
+            ActionsDailyRollup.track(self, previous, update_fields)
+
+            if adding and self.type == self.ACTION_TYPE_DEPOSITED and self.status != self.STATUS_TYPE_FAILED:
+                merchant_id, amount, created = self.merchant_id, self.delta, self.created
+                transaction.on_commit(lambda: record_credit(merchant_id, amount, created))
+
+    @classmethod
+    @contextmanager
+    def references_from_id(cls, template):
+        """
+        Actions created inside the block without a reference get
+        template.format(action_id) as reference, written in the INSERT.
+
+            with Actions.references_from_id("{:012}"):
+                merchant.deposit(...)
+        """
+        token = _action_reference_template.set(template)
+        try:
+            yield
+        finally:
+            _action_reference_template.reset(token)
         
     @classmethod
     def create(
@@ -363,8 +411,13 @@ class Actions(models.Model):
                 'reference_type': 'required for deposit.',
             })
 
+        action_id = id_allocator(cls).next_id()
+        reference_template = _action_reference_template.get()
+
         if reference_type is None:
             reference_type = cls.REFERENCE_TYPE_NONE
+        if not reference and reference_template and action_id is not None:
+            reference = reference_template.format(action_id)
         if reference is None:
             reference = ''
         if comment is None:
@@ -383,6 +436,7 @@ class Actions(models.Model):
 
 
         action=cls.objects.create(
+            id=action_id,
             user_friendly_id=user_friendly_id,
             created=asof,
             user=user,
@@ -413,3 +467,121 @@ class Actions(models.Model):
         #conn.set(head_name,action.id)
         
         return action
+
+
+class ActionsDailyRollup(models.Model):
+    """
+    Count and delta of a merchant's actions per Pakistan calendar day, type
+    and status, kept in step with Actions by Actions.save() inside the
+    saving transaction. Actions changed with queryset update() bypass it,
+    the actions_rollup command checks and rebuilds the rollup.
+    """
+
+    TRACKED_FIELDS = {"merchant", "merchant_id", "created", "type", "status", "delta"}
+    ROLLUP_FIELDS = ("merchant_id", "created", "type", "status", "delta")
+
+    merchant = models.ForeignKey(
+        Merchant,
+        on_delete=models.CASCADE,
+        related_name='daily_rollups',
+    )
+    day = models.DateField()
+    type = models.CharField(max_length=30)
+    # "" for actions without a status
+    status = models.CharField(max_length=30, blank=True, default="")
+    count = models.IntegerField(default=0)
+    total_delta = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["merchant", "day", "type", "status"],
+                name="merchant_actions_rollup_uniq"
+            )
+        ]
+        indexes = [
+            models.Index(fields=["day", "type"], name="merchant_rollup_day_type_idx"),
+        ]
+
+    @staticmethod
+    def day_of(created):
+        # days roll over at Pakistan midnight, as the credit limits do
+        return (created + timedelta(hours=5)).date()
+
+    @classmethod
+    def entry(cls, values):
+        """(merchant_id, day, type, status, delta) an action with values counts under."""
+
+        if values.get("created") is None:
+            return None
+
+        return (
+            values["merchant_id"],
+            cls.day_of(values["created"]),
+            values["type"],
+            values["status"] or "",
+            values["delta"] or 0
+        )
+
+    @classmethod
+    def stored_values(cls, action):
+        """{field: value} of the saved action's row, locked until the transaction ends."""
+
+        rows = type(action)._base_manager.select_for_update().filter(pk=action.pk).values(*cls.ROLLUP_FIELDS)
+
+        for row in rows:
+            return row
+
+        return None
+
+    @classmethod
+    def apply(cls, entry, sign):
+
+        merchant_id, day, type, status, delta = entry
+        lookup = {"merchant_id" : merchant_id, "day" : day, "type" : type, "status" : status}
+
+        updated = cls.objects.filter(**lookup).update(
+            count=F("count") + sign, total_delta=F("total_delta") + sign * delta
+        )
+
+        if updated:
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(count=sign, total_delta=sign * delta, **lookup)
+        except IntegrityError:
+            # created by a concurrent transaction in the meantime
+            cls.objects.filter(**lookup).update(
+                count=F("count") + sign, total_delta=F("total_delta") + sign * delta
+            )
+
+    @classmethod
+    def track(cls, action, previous, update_fields=None):
+        """
+        Moves a saved action from the rollup row its previous values counted
+        under to the one of the values the save wrote.
+        """
+
+        if update_fields is not None:
+            written = {"merchant_id" if field == "merchant" else field for field in update_fields}
+        else:
+            written = set(cls.ROLLUP_FIELDS) - action.get_deferred_fields()
+
+        current = dict(previous or {})
+
+        for field in cls.ROLLUP_FIELDS:
+            if previous is None or field in written:
+                current[field] = getattr(action, field)
+
+        before = cls.entry(previous) if previous is not None else None
+        after = cls.entry(current)
+
+        if before == after:
+            return
+
+        if before is not None:
+            cls.apply(before, -1)
+
+        if after is not None:
+            cls.apply(after, 1)
@@ -1,3 +1,905 @@
-from django.test import TestCase
+import json
+from io import StringIO
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, models
+from django.db.models import F
+from django.db.models.signals import ModelSignal
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.core.exceptions import ImproperlyConfigured
+from unittest import mock
+from asgiref.sync import async_to_sync
+from core.fakes import DownRedis, FakeRedis
+from core.redis_ops import RedisWalletCache, WalletLocalCache, render_json
+from rest_framework.renderers import JSONRenderer
+from merchant import catalog
+from merchant.catalog import (
+    BILLER_LIST_FIELDS, POPULAR_VOUCHER_VENDORS, catalog_etag, catalog_versions, changed_sections,
+    get_billers_data, get_voucher_data, splice_json, store_section, warm_section
+)
+from merchant.checks import credit_limits_check
+from merchant.limits import CreditCounters, MerchantLimits
+from merchant.management.commands.actions_rollup import rebuild_chunk
+from merchant.models import Actions, Merchant, ActionsDailyRollup
+from merchant.views import AsyncWallet, Wallet, WalletCatalog
 
 # Create your tests here.
+
+
+class Vendor(models.Model):
+    """
+    Shaped like the vouchers and bills models, which are not installed
+    everywhere. Unmanaged, CatalogTest creates the tables.
+    """
+
+    name = models.CharField(max_length=50)
+    icon = models.CharField(max_length=50, default="icon")
+    favicon = models.CharField(max_length=50, default="favicon")
+    commission = models.FloatField(default=1)
+    active = models.BooleanField(default=True)
+
+    class Meta:
+        app_label = "merchant"
+        managed = False
+
+
+class Voucher(models.Model):
+
+    vendor = models.ForeignKey(Vendor, on_delete=models.CASCADE, related_name="vouchers")
+    name = models.CharField(max_length=50)
+    cost_original = models.IntegerField(default=100)
+    cost_discounted = models.IntegerField(default=90)
+    short_description = models.CharField(max_length=50, default="short")
+    long_description = models.CharField(max_length=50, default="long")
+    icon = models.CharField(max_length=50, default="a,b")
+    active = models.BooleanField(default=True)
+
+    class Meta:
+        app_label = "merchant"
+        managed = False
+
+
+class Billers(models.Model):
+
+    business = models.CharField(max_length=50)
+    business_icon = models.CharField(max_length=50)
+    active = models.BooleanField(default=True)
+    name = models.CharField(max_length=50)
+    icon = models.CharField(max_length=50, default="icon")
+    commission = models.FloatField(default=1)
+    commission_type = models.CharField(max_length=10, default="fixed")
+    start = models.CharField(max_length=10, default="0")
+    len_of_consumer_number = models.IntegerField(default=10)
+
+    class Meta:
+        app_label = "merchant"
+        managed = False
+        ordering = ["id"]
+
+
+CATALOG_MODELS = {"vendor" : Vendor, "billers" : Billers}
+
+
+class CatalogTest(TestCase):
+    """
+    A catalog cache miss must cost a fixed number of queries however many
+    vendors, vouchers or business types there are.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+
+        # sqlite can't change the schema inside the class transaction
+        with connection.schema_editor() as editor:
+            for model in (Vendor, Voucher, Billers):
+                editor.create_model(model)
+
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+
+        super().tearDownClass()
+
+        with connection.schema_editor() as editor:
+            for model in (Voucher, Vendor, Billers):
+                editor.delete_model(model)
+
+    def setUp(self):
+
+        patcher = mock.patch("merchant.catalog.rds_cache")
+        self.rds_cache = patcher.start()
+        self.rds_cache.get_value.return_value = None
+        self.rds_cache.get_timestamp.return_value = 1
+        self.addCleanup(patcher.stop)
+
+        # the rebuild lease is always granted
+        patcher = mock.patch("merchant.catalog.rebuild_locks")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch(
+            "merchant.catalog.apps.get_model",
+            side_effect=lambda app_label, model_name: CATALOG_MODELS[model_name]
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_vendor(self, name, *vouchers, active=True):
+
+        vendor = Vendor.objects.create(name=name, active=active)
+
+        for name, cost_discounted, active in vouchers:
+            Voucher.objects.create(vendor=vendor, name=name, cost_discounted=cost_discounted, active=active)
+
+        return vendor
+
+    def add_biller(self, business, name, active=True):
+        return Billers.objects.create(business=business, business_icon="%s icon" % name, name=name, active=active)
+
+    def test_voucher_data_prefetches_the_active_vouchers(self):
+
+        self.add_vendor("Free Fire", ("voucher 1", 90, True), ("voucher 2", 100, True), ("inactive", 90, False))
+        self.add_vendor("PUBG [US]", ("inactive", 90, False))
+        self.add_vendor("RazerGold [USA]", ("voucher 3", 90, True))
+        self.add_vendor("Unlisted", ("voucher 4", 90, True))
+        self.add_vendor(POPULAR_VOUCHER_VENDORS[0], ("voucher 5", 90, True), active=False)
+
+        # the vendors and one prefetch of their vouchers
+        with self.assertNumQueries(2):
+            data = get_voucher_data()
+
+        # vendors without active vouchers are left out
+        self.assertEqual([item["vendor_name"] for item in data], ["Free Fire", "RazerGold [USA]"])
+        self.assertEqual([item["voucher_type"] for item in data[0]["vouchers"]], ["voucher 1", "voucher 2"])
+        self.assertEqual([item["dicounted_price"] for item in data[0]["vouchers"]], [90, None])
+        self.assertEqual(data[0]["vouchers"][0]["icon"], ["a", "b"])
+
+        self.rds_cache.set_value_if_stamp.assert_called_once_with("vouchers", data, 1)
+
+    def test_voucher_queries_do_not_grow_with_the_vendors(self):
+
+        for name in POPULAR_VOUCHER_VENDORS:
+            self.add_vendor(name, *[("voucher %s" % n, 90, True) for n in range(5)])
+
+        with self.assertNumQueries(2):
+            data = get_voucher_data()
+
+        self.assertEqual([len(item["vouchers"]) for item in data], [5, 5, 5])
+
+    def test_cached_voucher_data_skips_the_database(self):
+
+        self.rds_cache.get_value.return_value = [{"vendor_name" : "Free Fire"}]
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_voucher_data(), [{"vendor_name" : "Free Fire"}])
+
+    def test_billers_data_is_grouped_in_one_query(self):
+
+        self.add_biller("Gas", "Gas inactive", active=False)
+        self.add_biller("Electricity", "Electricity 1")
+        self.add_biller("Gas", "Gas 1")
+        self.add_biller("Internet", "Internet inactive", active=False)
+        self.add_biller("Electricity", "Electricity 2")
+        self.add_biller("Water", "Water 1")
+
+        with self.assertNumQueries(1):
+            data = get_billers_data({"percent" : 1})
+
+        # business types in catalog order, those without active billers left out
+        self.assertEqual([item["business"] for item in data], ["Electricity", "Gas"])
+        self.assertEqual([item["name"] for item in data[0]["business_list"]], ["Electricity 1", "Electricity 2"])
+        self.assertEqual(set(data[0]["business_list"][0]), set(BILLER_LIST_FIELDS))
+
+        # the icon of the first biller of the type, active or not
+        self.assertEqual(data[1]["business_icon"], "Gas inactive icon")
+        self.assertEqual(data[0]["earning_rule"], {"percent" : 1})
+
+        # the cached base layer is shared by every earning rule
+        cached = self.rds_cache.set_value_if_stamp.call_args[0][1]
+        self.assertNotIn("earning_rule", cached[0])
+
+    def test_earning_rule_does_not_change_the_cached_billers(self):
+
+        base = [{"business" : "Gas", "business_icon" : "icon", "business_list" : []}]
+        self.rds_cache.get_value.return_value = base
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_billers_data({"percent" : 2})[0]["earning_rule"], {"percent" : 2})
+
+        self.assertNotIn("earning_rule", base[0])
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class CreditCountersTest(TestCase):
+
+    NOW = utc(2026, 10, 18, 12, 0)
+
+    def setUp(self):
+
+        self.client = FakeRedis()
+        self.counters = CreditCounters(self.client)
+
+        self.client.scripts[CreditCounters.RECORD_SCRIPT].side_effect = self.run_record
+        self.client.scripts[CreditCounters.STORE_SCRIPT].side_effect = self.run_store
+
+        merchant = Merchant.objects.create(user=User.objects.create(username="03001234567"))
+        self.merchant_id = merchant.id
+        self.key = self.counters.redis_key(merchant.id, self.NOW)
+
+        for day, type, status, total_delta in [
+            (date(2026, 9, 30), "DEPOSITED", "", 900),      # last month
+            (date(2026, 10, 1), "DEPOSITED", "", 500),
+            (date(2026, 10, 17), "DEPOSITED", "", 100),
+            (date(2026, 10, 18), "DEPOSITED", "", 200),
+            (date(2026, 10, 18), "DEPOSITED", "SUCCESS", 300),
+            (date(2026, 10, 18), "DEPOSITED", "FAILED", 4000),
+            (date(2026, 10, 18), "WITHDRAW", "", -50),
+        ]:
+            ActionsDailyRollup.objects.create(
+                merchant=merchant, day=day, type=type, status=status, count=1, total_delta=total_delta
+            )
+
+    def run_record(self, keys, args):
+        """RECORD_SCRIPT against the fake."""
+
+        values = self.client.values.setdefault(keys[0], {})
+        values[args[3]] = str(int(values.get(args[3], 0)) + 1).encode()
+
+        if args[0] not in values:
+            return 0
+
+        for field in args[:2]:
+            values[field] = str(int(values.get(field, 0)) + args[2]).encode()
+
+        return 1
+
+    def run_store(self, keys, args):
+        """STORE_SCRIPT against the fake."""
+
+        version = self.client.hget(keys[0], args[0]) or b""
+
+        if version != self.client.encode(args[1]):
+            return 0
+
+        fields = args[3:]
+        self.client.delete(keys[0])
+        self.client.hset(keys[0], args[0], version or 0, mapping=dict(zip(fields[::2], fields[1::2])))
+
+        return 1
+
+    def stored(self):
+        return self.client.hgetall(self.key)
+
+    def test_missing_month_is_rebuilt_from_the_rollup(self):
+
+        self.assertEqual(self.counters.usage(self.merchant_id, self.NOW), (500, 1100))
+
+        self.assertEqual(self.stored(), {
+            b"version" : b"0", b"month" : b"1100", b"d01" : b"500", b"d17" : b"100", b"d18" : b"500"
+        })
+
+    def test_usage_reads_the_stored_month(self):
+
+        self.counters.usage(self.merchant_id, self.NOW)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.counters.usage(self.merchant_id, self.NOW), (500, 1100))
+
+    def test_record_bumps_the_pakistan_day(self):
+
+        self.counters.usage(self.merchant_id, self.NOW)
+        self.counters.record(self.merchant_id, 250, utc(2026, 10, 17, 19, 30))
+
+        self.assertEqual(self.counters.usage(self.merchant_id, self.NOW), (750, 1350))
+        self.assertEqual(self.stored()[b"version"], b"1")
+
+    def test_record_on_a_missing_month_only_moves_the_version(self):
+
+        self.counters.record(self.merchant_id, 250, self.NOW)
+
+        self.assertEqual(self.stored(), {b"version" : b"1"})
+        self.assertEqual(self.counters.usage(self.merchant_id, self.NOW), (500, 1100))
+
+    def test_rebuild_does_not_erase_a_credit_counted_meanwhile(self):
+
+        self.counters.reconcile(self.merchant_id, self.NOW)
+        load = self.counters.load
+
+        def credit_meanwhile(merchant_id, local):
+            totals = load(merchant_id, local)
+
+            if load_calls.call_count == 1:
+                # committed after the totals were read, counted before they are stored
+                ActionsDailyRollup.objects.filter(
+                    merchant_id=merchant_id, day=date(2026, 10, 18), status=""
+                ).update(total_delta=F("total_delta") + 250)
+                self.counters.record(merchant_id, 250, self.NOW)
+
+            return totals
+
+        with mock.patch.object(self.counters, "load", side_effect=credit_meanwhile) as load_calls:
+            totals = self.counters.reconcile(self.merchant_id, self.NOW)
+
+        self.assertEqual(load_calls.call_count, 2)
+        self.assertEqual(totals["month"], 1350)
+        self.assertEqual(self.counters.usage(self.merchant_id, self.NOW), (750, 1350))
+
+    def test_rebuild_gives_up_while_credits_keep_coming(self):
+
+        self.client.scripts[CreditCounters.STORE_SCRIPT].side_effect = None
+        self.client.scripts[CreditCounters.STORE_SCRIPT].return_value = 0
+
+        totals = self.counters.reconcile(self.merchant_id, self.NOW)
+
+        self.assertEqual(totals["month"], 1100)
+        self.assertEqual(self.client.scripts[CreditCounters.STORE_SCRIPT].call_count, CreditCounters.REBUILD_ATTEMPTS)
+
+    def test_redis_down_reads_the_rollup(self):
+
+        self.counters.client = DownRedis()
+
+        self.assertEqual(self.counters.usage(self.merchant_id, self.NOW), (500, 1100))
+
+    def test_reconcile_command_rewrites_credited_merchants(self):
+
+        self.client.hset(self.key, mapping={"version" : 0, "month" : 1, "d18" : 1})
+        out = StringIO()
+
+        with mock.patch("merchant.management.commands.reconcile_credit_counters.credit_counters", self.counters):
+            with mock.patch("merchant.limits.timezone.now", return_value=self.NOW):
+                call_command("reconcile_credit_counters", stdout=out)
+
+        self.assertEqual(out.getvalue(), "%s: 1100 this month\n" % self.merchant_id)
+        self.assertEqual(self.stored()[b"d18"], b"500")
+
+
+class CreditLimitsCheckTest(SimpleTestCase):
+
+    def test_every_account_level_needs_limits(self):
+
+        limits = {
+            "L0" : {"daily" : 1000, "monthly" : 5000},
+            "L1" : {"daily" : 1000},
+        }
+
+        with self.settings(MERCHANT_CREDIT_LIMITS=limits):
+            errors = credit_limits_check(None)
+
+        self.assertEqual([error.id for error in errors], ["merchant.E001", "merchant.E001"])
+        self.assertIn("level L1", errors[0].msg)
+        self.assertIn("level L2", errors[1].msg)
+
+    def test_configured_limits_pass(self):
+        self.assertEqual(credit_limits_check(None), [])
+
+
+class MerchantLimitsTest(SimpleTestCase):
+
+    LIMITS = {"L1" : {"daily" : 1000, "monthly" : 5000}}
+
+    def test_available_limit_is_the_tighter_window(self):
+
+        with self.settings(MERCHANT_CREDIT_LIMITS=self.LIMITS):
+            with mock.patch("merchant.limits.credit_counters.usage", return_value=(400, 4800)):
+                limits = MerchantLimits(7, "L1")
+
+        self.assertEqual(limits.available_daily_credit_limit, 600)
+        self.assertEqual(limits.available_monthly_credit_limit, 200)
+        self.assertEqual(limits.available_credit_limit, 200)
+
+    def test_limits_must_be_configured(self):
+
+        with self.settings(MERCHANT_CREDIT_LIMITS=self.LIMITS):
+            with self.assertRaises(ImproperlyConfigured):
+                MerchantLimits(7, "L2")
+
+
+class SavedAction(SimpleNamespace):
+    """The attributes ActionsDailyRollup.track reads off a saved action."""
+
+    def __init__(self, deferred=(), **values):
+        super().__init__(**values)
+        self.deferred = set(deferred)
+
+    def get_deferred_fields(self):
+        return self.deferred
+
+
+class ActionsDailyRollupTest(TestCase):
+
+    def setUp(self):
+
+        self.merchant = Merchant.objects.create(user=User.objects.create(username="03001234567"))
+        self.other = Merchant.objects.create(user=User.objects.create(username="03007654321"))
+
+        self.values = {
+            "merchant_id" : self.merchant.id,
+            "created" : utc(2026, 10, 17, 19, 30),      # Oct 18th in Pakistan
+            "type" : "DEPOSITED",
+            "status" : None,
+            "delta" : 100.0,
+        }
+
+    def rollup(self):
+        return {
+            (row.merchant_id, row.day, row.type, row.status) : (row.count, row.total_delta)
+            for row in ActionsDailyRollup.objects.all()
+            if row.count or row.total_delta
+        }
+
+    def save(self, previous, update_fields=None, deferred=(), **changes):
+        action = SavedAction(deferred=deferred, **dict(previous or {}, **changes))
+        ActionsDailyRollup.track(action, previous, update_fields)
+
+    def test_new_action_is_counted_on_its_pakistan_day(self):
+
+        self.save(None, **self.values)
+
+        self.assertEqual(self.rollup(), {
+            (self.merchant.id, date(2026, 10, 18), "DEPOSITED", "") : (1, 100.0)
+        })
+
+    def test_status_change_moves_the_action(self):
+
+        self.save(None, **self.values)
+        self.save(self.values, status="FAILED")
+
+        self.assertEqual(self.rollup(), {
+            (self.merchant.id, date(2026, 10, 18), "DEPOSITED", "FAILED") : (1, 100.0)
+        })
+
+    def test_merchant_and_day_change_move_the_action(self):
+
+        self.save(None, **self.values)
+        self.save(self.values, update_fields=["merchant", "created"],
+                  merchant_id=self.other.id, created=utc(2026, 10, 17, 18, 0))
+
+        self.assertEqual(self.rollup(), {
+            (self.other.id, date(2026, 10, 17), "DEPOSITED", "") : (1, 100.0)
+        })
+
+    def test_fields_not_written_keep_the_stored_values(self):
+
+        self.save(None, **self.values)
+
+        # changed in memory but left out of update_fields, or deferred
+        self.save(self.values, update_fields=["delta"], delta=150.0, status="FAILED")
+        self.save(dict(self.values, delta=150.0), deferred=["status"], status="FAILED")
+
+        self.assertEqual(self.rollup(), {
+            (self.merchant.id, date(2026, 10, 18), "DEPOSITED", "") : (1, 150.0)
+        })
+
+    def test_unchanged_save_does_not_write(self):
+
+        self.save(None, **self.values)
+
+        with self.assertNumQueries(0):
+            self.save(self.values)
+
+
+class RebuildChunkTest(TestCase):
+
+    def setUp(self):
+        self.merchant = Merchant.objects.create(user=User.objects.create(username="03001234567"))
+
+    def create_row(self, day, type, count, total_delta):
+        return ActionsDailyRollup.objects.create(
+            merchant=self.merchant, day=day, type=type, count=count, total_delta=total_delta
+        )
+
+    def test_rows_are_rewritten_in_place(self):
+
+        stale = self.create_row(date(2026, 10, 17), "DEPOSITED", 3, 300)
+        gone = self.create_row(date(2026, 10, 17), "WITHDRAW", 1, -50)
+        kept = self.create_row(date(2026, 10, 18), "DEPOSITED", 1, 100)
+
+        totals = {
+            (self.merchant.id, date(2026, 10, 17), "DEPOSITED", "") : [2, 250],
+            (self.merchant.id, date(2026, 10, 18), "DEPOSITED", "") : [1, 100],
+            (self.merchant.id, date(2026, 10, 18), "PROFIT", "") : [1, 5],
+        }
+
+        with mock.patch("merchant.management.commands.actions_rollup.aggregate", return_value=totals):
+            written = rebuild_chunk([self.merchant.id], date(2026, 10, 17), date(2026, 10, 18))
+
+        self.assertEqual(written, 3)
+
+        # the locked rows keep their ids, so waiting saves add on top of them
+        stale.refresh_from_db()
+        gone.refresh_from_db()
+        kept.refresh_from_db()
+
+        self.assertEqual((stale.count, stale.total_delta), (2, 250))
+        self.assertEqual((gone.count, gone.total_delta), (0, 0))
+        self.assertEqual((kept.count, kept.total_delta), (1, 100))
+
+        profit = ActionsDailyRollup.objects.get(type="PROFIT")
+        self.assertEqual((profit.count, profit.total_delta), (1, 5))
+
+    def test_row_created_by_a_concurrent_save_gets_the_rebuilt_totals(self):
+
+        key = (self.merchant.id, date(2026, 10, 18), "DEPOSITED", "")
+        totals = {key : [3, 300]}
+
+        def save_meanwhile(merchant_ids, start, end):
+            if not ActionsDailyRollup.objects.exists():
+                # a save committing its action, already in totals, after the lock
+                self.create_row(date(2026, 10, 18), "DEPOSITED", 1, 100)
+            return totals
+
+        with mock.patch(
+            "merchant.management.commands.actions_rollup.aggregate", side_effect=save_meanwhile
+        ) as aggregate:
+            written = rebuild_chunk([self.merchant.id], date(2026, 10, 17), date(2026, 10, 18))
+
+        self.assertEqual(written, 1)
+        self.assertEqual(aggregate.call_count, 2)
+
+        row = ActionsDailyRollup.objects.get()
+        self.assertEqual((row.count, row.total_delta), (3, 300))
+
+
+class ActionReferenceTest(SimpleTestCase):
+
+    def create(self, **kwargs):
+
+        merchant = SimpleNamespace(current_balance=100)
+        allocator = mock.Mock(next_id=mock.Mock(return_value=42))
+
+        with mock.patch("merchant.models.id_allocator", return_value=allocator), \
+                mock.patch.object(Actions.objects, "create") as create:
+            Actions.create(
+                None, merchant, "telco", Actions.ACTION_TYPE_DEPOSITED, 100, datetime.now(timezone.utc), **kwargs
+            )
+
+        return create.call_args[1]
+
+    def test_reference_is_built_from_the_reserved_id(self):
+
+        with Actions.references_from_id("{:012}"):
+            values = self.create()
+
+        self.assertEqual(values["id"], 42)
+        self.assertEqual(values["reference"], "000000000042")
+
+    def test_given_reference_is_kept(self):
+
+        with Actions.references_from_id("{:012}"):
+            values = self.create(reference="R-1")
+
+        self.assertEqual(values["reference"], "R-1")
+
+    def test_outside_the_block_there_is_no_reference(self):
+
+        with Actions.references_from_id("{}"):
+            pass
+
+        self.assertEqual(self.create()["reference"], "")
+
+
+CATALOG = {
+    "vouchers" : [{"vendor_name" : "Free Fire", "vouchers" : []}],
+    "billers" : [{"business" : "Gas", "business_list" : []}],
+}
+
+
+@override_settings(WALLET_FANOUT_WORKERS=0)
+class WalletVersionsTest(SimpleTestCase):
+
+    def setUp(self):
+
+        self.timestamps = {"vouchers" : 1, "billers" : 2}
+        self.merchant = SimpleNamespace(current_balance=12345)
+
+        patches = [
+            mock.patch("merchant.views.catalog_timestamps", side_effect=lambda: dict(self.timestamps)),
+            mock.patch(
+                "merchant.views.get_rendered_section",
+                side_effect=lambda section, earning_rule, timestamp: render_json(CATALOG[section]).encode()
+            ),
+            mock.patch.object(WalletCatalog, "is_active_wallet_user", return_value=True),
+        ]
+
+        started = [patcher.start() for patcher in patches]
+        self.rendered = started[1]
+
+        for patcher in patches:
+            self.addCleanup(patcher.stop)
+
+    def post(self, etag=None, **data):
+
+        data.setdefault("earning_rules", {"pay-bill" : {"percent" : 1}})
+        request = SimpleNamespace(
+            data=data, user=SimpleNamespace(merchant_profile=self.merchant),
+            META={"HTTP_IF_NONE_MATCH" : etag} if etag else {}
+        )
+
+        return Wallet().post(request)
+
+    def test_response_carries_the_versions_and_an_etag(self):
+
+        response = self.post()
+        body = json.loads(response.content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["ETag"].startswith('W/"'))
+        self.assertEqual(body["current_balance"], 123.45)
+        self.assertEqual(body["available_vouchers"], CATALOG["vouchers"])
+        self.assertEqual(body["available_billers"], CATALOG["billers"])
+        self.assertEqual(body["section_versions"]["vouchers"], "1")
+        self.assertTrue(body["section_versions"]["billers"].startswith("2."))
+
+    def test_unchanged_wallet_is_not_modified(self):
+
+        etag = self.post()["ETag"]
+        self.rendered.reset_mock()
+
+        response = self.post(etag='"other", %s' % etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response["ETag"], etag)
+        self.rendered.assert_not_called()
+
+    def test_etag_moves_with_the_balance_stamps_and_earning_rule(self):
+
+        etag = self.post()["ETag"]
+
+        self.merchant.current_balance = 100
+        self.assertEqual(self.post(etag=etag).status_code, 200)
+        etag = self.post()["ETag"]
+
+        self.timestamps["vouchers"] = 3
+        self.assertEqual(self.post(etag=etag).status_code, 200)
+        etag = self.post()["ETag"]
+
+        response = self.post(etag=etag, earning_rules={"pay-bill" : {"percent" : 2}})
+        self.assertEqual(response.status_code, 200)
+
+    def test_only_changed_sections_are_sent(self):
+
+        versions = json.loads(self.post().content)["section_versions"]
+        self.timestamps["billers"] = 5
+
+        body = json.loads(self.post(section_versions=versions).content)
+
+        self.assertNotIn("available_vouchers", body)
+        self.assertEqual(body["available_billers"], CATALOG["billers"])
+        self.assertEqual(body["section_versions"]["vouchers"], versions["vouchers"])
+
+    def test_unstamped_section_is_always_sent_without_an_etag(self):
+
+        self.timestamps["vouchers"] = None
+
+        response = self.post(section_versions={"vouchers" : None, "billers" : "x"})
+        body = json.loads(response.content)
+
+        self.assertFalse(response.has_header("ETag"))
+        self.assertEqual(body["available_vouchers"], CATALOG["vouchers"])
+
+    def test_async_wallet_answers_not_modified(self):
+
+        etag = self.post()["ETag"]
+        self.rendered.reset_mock()
+
+        request = RequestFactory().post(
+            "/wallet/", data=json.dumps({"earning_rules" : {"pay-bill" : {"percent" : 1}}}),
+            content_type="application/json", HTTP_IF_NONE_MATCH=etag
+        )
+        request.user = SimpleNamespace(merchant_profile=self.merchant)
+
+        with mock.patch("merchant.views.rds_cache.aget_timestamps", mock.AsyncMock(return_value=self.timestamps)):
+            response = async_to_sync(AsyncWallet().post)(request)
+
+        self.assertEqual(response.status_code, 304)
+        self.rendered.assert_not_called()
+
+
+class CatalogVersionsTest(SimpleTestCase):
+
+    def test_billers_version_includes_the_earning_rule(self):
+
+        first = catalog_versions({"percent" : 1}, {"vouchers" : 1, "billers" : 2})
+        second = catalog_versions({"percent" : 2}, {"vouchers" : 1, "billers" : 2})
+
+        self.assertEqual(first["vouchers"], second["vouchers"])
+        self.assertNotEqual(first["billers"], second["billers"])
+        self.assertEqual(first, catalog_versions({"percent" : 1}, {"vouchers" : 1, "billers" : 2}))
+
+    def test_etag_needs_every_section_versioned(self):
+
+        self.assertIsNone(catalog_etag({"vouchers" : None, "billers" : "2.x"}, current_balance=1))
+        self.assertNotEqual(
+            catalog_etag({"vouchers" : "1"}, current_balance=1), catalog_etag({"vouchers" : "1"}, current_balance=2)
+        )
+
+    def test_changed_sections(self):
+
+        versions = {"vouchers" : "1", "billers" : "2.x"}
+
+        self.assertEqual(changed_sections(versions, None), ["vouchers", "billers"])
+        self.assertEqual(changed_sections(versions, "garbage"), ["vouchers", "billers"])
+        self.assertEqual(changed_sections(versions, {"vouchers" : 1, "billers" : "2.y"}), ["billers"])
+
+
+class SpliceJsonTest(SimpleTestCase):
+    """Spliced responses must be the bytes JSONRenderer writes for the same data."""
+
+    def assertSplicedAsRendered(self, fields, sections):
+
+        fragments = {name : render_json(value).encode("utf-8") for name, value in sections.items()}
+
+        self.assertEqual(splice_json(fields, fragments), JSONRenderer().render(dict(fields, **sections)))
+
+    def test_fields_and_fragments(self):
+
+        self.assertSplicedAsRendered(
+            {"current_balance" : 123.45, "is_active_wallet_user" : True, "section_versions" : {"vouchers" : "1"}},
+            {"available_vouchers" : CATALOG["vouchers"], "available_billers" : CATALOG["billers"]}
+        )
+
+    def test_text_that_needs_escaping(self):
+
+        self.assertSplicedAsRendered(
+            {"message" : "quote \" slash \\ tab \t ڈالر \u2028 \u2029"},
+            {"available_vouchers" : [{"vendor_name" : "ڈالر \u2028\u2029 \"x\"", "icon" : None}]}
+        )
+
+    def test_only_fields_or_only_fragments(self):
+
+        self.assertSplicedAsRendered({"success" : True}, {})
+        self.assertSplicedAsRendered({}, {"available_billers" : []})
+        self.assertSplicedAsRendered({}, {})
+
+    def test_wallet_response_is_rendered_as_by_drf(self):
+
+        with override_settings(WALLET_FANOUT_WORKERS=0), \
+                mock.patch("merchant.views.catalog_timestamps", return_value={"vouchers" : 1, "billers" : 2}), \
+                mock.patch(
+                    "merchant.views.get_rendered_section",
+                    side_effect=lambda section, *args: render_json(CATALOG[section]).encode()
+                ), \
+                mock.patch.object(WalletCatalog, "is_active_wallet_user", return_value=False):
+
+            request = SimpleNamespace(
+                data={}, user=SimpleNamespace(merchant_profile=SimpleNamespace(current_balance=5)), META={}
+            )
+            response = Wallet().post(request)
+
+        body = json.loads(response.content)
+        self.assertEqual(response.content, JSONRenderer().render(body))
+        self.assertEqual(list(body), [
+            "current_balance", "is_active_wallet_user", "section_versions", "success",
+            "available_vouchers", "available_billers"
+        ])
+
+
+class WarmSectionTest(TestCase):
+
+    def setUp(self):
+
+        self.redis = FakeRedis(decode_responses=True)
+        self.redis.register_script(RedisWalletCache.SET_IF_STAMP_SCRIPT).side_effect = self.set_if_stamp
+
+        patcher = mock.patch("core.redis_ops.conn_udhaar", self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch("merchant.catalog.rds_cache", RedisWalletCache())
+        self.rds_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.lock = mock.MagicMock()
+        self.lock.__enter__.return_value.lease = "lease"
+
+        patcher = mock.patch("merchant.catalog.rebuild_locks")
+        patcher.start().return_value.lock.return_value = self.lock
+        self.addCleanup(patcher.stop)
+
+        self.redis.hset(RedisWalletCache.TIMESTAMP_HASH_KEY, "billers", 1)
+
+    def set_if_stamp(self, keys, args):
+        """SET_IF_STAMP_SCRIPT on the fake."""
+
+        stamps, cache = keys
+        section, timestamp, value = args
+
+        if (self.redis.hget(stamps, section) or "") != str(timestamp):
+            return 0
+
+        return self.redis.hset(cache, section, value)
+
+    def cached(self, section):
+        return self.redis.hget(RedisWalletCache.CACHE_HASH_KEY, section)
+
+    def test_section_is_stored_while_the_stamp_holds(self):
+
+        self.assertEqual(store_section("billers", lambda: ["billers"]), ["billers"])
+        self.assertEqual(self.cached("billers"), '["billers"]')
+
+    def test_section_cleared_during_the_build_is_not_stored(self):
+
+        def build():
+            self.rds_cache.clear_and_update_timestamp("billers")
+            return ["stale"]
+
+        with mock.patch("core.redis_ops.timezone.now", return_value=datetime(2030, 1, 1, tzinfo=timezone.utc)):
+            self.assertEqual(store_section("billers", build), ["stale"])
+
+        self.assertIsNone(self.cached("billers"))
+
+    def test_section_without_a_stamp_is_stored_until_one_is_set(self):
+
+        self.assertEqual(store_section("vouchers", lambda: ["vouchers"]), ["vouchers"])
+        self.assertEqual(self.cached("vouchers"), '["vouchers"]')
+
+    def test_warm_stores_before_the_stamp_moves(self):
+
+        with mock.patch.dict(catalog.SECTION_BUILDERS, {"billers" : lambda: ["warm"]}):
+            self.assertTrue(warm_section("billers"))
+
+        self.assertEqual(self.cached("billers"), '["warm"]')
+        self.assertNotEqual(self.rds_cache.get_timestamp("billers"), 1)
+        self.assertEqual(self.redis.published, [(WalletLocalCache.CHANNEL, "billers")])
+
+    def test_warm_during_a_rebuild_clears_the_section(self):
+
+        self.lock.__enter__.return_value.lease = None
+        build = mock.Mock()
+
+        with mock.patch.dict(catalog.SECTION_BUILDERS, {"billers" : build}):
+            self.assertFalse(warm_section("billers"))
+
+        build.assert_not_called()
+        self.redis.scripts[RedisWalletCache.CLEAR_SCRIPT].assert_called_once_with(
+            keys=[RedisWalletCache.CACHE_HASH_KEY, RedisWalletCache.STALE_HASH_KEY], args=["billers"]
+        )
+        self.assertNotEqual(self.rds_cache.get_timestamp("billers"), 1)
+
+    def connect(self, enabled=True):
+
+        signals = {"post_save" : ModelSignal(use_caching=True), "post_delete" : ModelSignal(use_caching=True)}
+
+        with override_settings(WALLET_CACHE_WARM_ON_SAVE=enabled), \
+                mock.patch.multiple("merchant.catalog", **signals), \
+                mock.patch("merchant.catalog.section_models", return_value=[("billers", Billers)]):
+            catalog.connect_warm_signals()
+
+        return signals
+
+    def test_saved_rows_warm_their_section_after_commit(self):
+
+        signals = self.connect()
+
+        with mock.patch("merchant.catalog.warm_section") as warm:
+
+            with self.captureOnCommitCallbacks(execute=True):
+                signals["post_save"].send(sender=Billers, instance=Billers(), created=True)
+                warm.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                signals["post_delete"].send(sender=Billers, instance=Billers())
+
+        self.assertEqual(warm.call_args_list, [mock.call("billers"), mock.call("billers")])
+
+    def test_failed_warm_is_logged(self):
+
+        signals = self.connect()
+
+        with mock.patch("merchant.catalog.warm_section", side_effect=RuntimeError("redis down")), \
+                self.assertLogs("django", "ERROR"), self.captureOnCommitCallbacks(execute=True):
+            signals["post_save"].send(sender=Billers, instance=Billers(), created=False)
+
+    def test_warming_is_off_by_default(self):
+
+        signals = self.connect(enabled=False)
+
+        self.assertFalse(signals["post_save"].has_listeners(Billers))
+        self.assertFalse(signals["post_delete"].has_listeners(Billers))
@@ -1,6 +1,9 @@
 from .views import *
-from django.conf.urls import url
+from django.conf import settings
+from core.routes import route
+
+wallet_view = AsyncWallet if getattr(settings, "ASYNC_VIEWS", False) else Wallet
 
 urlpatterns = [
-    url(r'^wallet/$', Wallet.as_view(), {'auth': True,'ip_security':'all'}),
+    route(r'^wallet/$', wallet_view.as_view(), 'merchant-wallet', auth=True, ip_security='all', lock_exempt_methods=('POST',)),
 ] 
\ No newline at end of file
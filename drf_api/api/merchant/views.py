@@ -1,117 +1,25 @@
 from rest_framework.response import Response
+import asyncio
 import logging
-from core.utils import WalletView
+from core.utils import WalletView, AsyncWalletView
 import traceback
+from django.http import HttpResponse
+from django.utils.http import parse_etags
+from core.fanout import gather, submit, run_async
+from core.payload import get_payload
 from core.redis_ops import rds_cache
-from django.apps import apps
+from merchant.catalog import (
+    CATALOG_SECTIONS, get_voucher_data, get_billers_data, get_rendered_section, splice_json,
+    local_rendered_section, catalog_timestamps, catalog_versions, catalog_etag, changed_sections
+)
 
 log = logging.getLogger("django")
 
 
-def get_voucher_data():
-
-    cache_value = rds_cache.get_value(type="vouchers")
-    
-    if cache_value:
-        return cache_value
-
-    data=[]
-    
-    popular = ['Free Fire', 'PUBG [US]', 'RazerGold [USA]']
-    
-    all_vendors=apps.get_model('vouchers', 'vendor').objects.filter(
-        active=True, name__in=popular
-    )
-
-    for vendor in all_vendors:
-        
-        insertion = {
-            'vendor_name' : vendor.name,
-            'icon' : vendor.icon, 
-            'commission' : vendor.commission,
-            'favicon':vendor.favicon,
-            'vouchers' : []
-        }
-        
-        for voucher in vendor.vouchers.filter(active=True):
-            
-            dc = { 
-                'voucher_id':voucher.id,
-                'voucher_type':voucher.name, 
-                'price':voucher.cost_original,
-                'short_description':voucher.short_description,
-                'long_description':voucher.long_description
-            }
-
-            if voucher.cost_discounted < voucher.cost_original:
-                dc['dicounted_price']= voucher.cost_discounted
-                
-            else:
-                dc['dicounted_price']= None
-
-            icons = voucher.icon
-            icons = icons.split(',') 
-            dc['icon']= icons             
-            
-            insertion['vouchers'].append(dc)
-
-        if insertion['vouchers']:
-            data.append(insertion)
-
-    rds_cache.set_value(type="vouchers", obj=data)
-    
-    return data
-
-def get_billers_data(earning_rule=None):
-    
-    cache_value = rds_cache.get_value(type="billers")
-
-    if cache_value:
-        return cache_value
-
-    biller_model=apps.get_model('bills', 'billers')
-    
-    available_business_type = list(biller_model.objects.filter(
-        active=True,
-        business__in=['Electricity', 'Gas', 'Internet']
-    ).values_list('business', flat=True))
-    
-    available_business_types= list(set(available_business_type))
-
-    res = []
-    
-    for business_type in available_business_types:
-        
-        dict_type = {}
-        dict_type['business'] = business_type
-        
-        logo = biller_model.objects.filter(business=business_type)[0].business_icon
-        
-        dict_type['business_icon'] = logo
-        
-        dict_type['business_list'] = list(biller_model.objects.filter(
-            business=business_type,
-            active=True
-        ).values(
-            'name',
-            'icon',
-            'commission',
-            'commission_type',
-            'start',
-            'len_of_consumer_number'
-        ))
-        
-        dict_type["earning_rule"] = earning_rule
-        
-        res.append(dict_type)
-        
-    rds_cache.set_value(type="billers", obj=res)
-
-    return res
-
 # Create your views here.
 
-class Wallet(WalletView):
+class WalletCatalog:
+    """Wallet response building shared by the sync and async views."""
     
     def is_active_wallet_user(self, merchant):
         return merchant.merchant_accout_action.exists()
@@ -122,12 +30,57 @@ class Wallet(WalletView):
         
         if data_type == "billers":
             data['available_billers'] = get_billers_data(earning_rules.get("pay-bill"))
-            
+        
         elif data_type == "vouchers":
             data['available_vouchers'] = get_voucher_data()
-            
+        
         return data
+    
+    def rendered_sections(self, sections, earning_rules, timestamps):
+        """Pre-rendered bytes of the requested sections, keyed by response field."""
+        
+        fields = [field for section, field in CATALOG_SECTIONS.items() if section in sections]
         
+        # sections missing from the cache are rebuilt concurrently
+        rendered = gather(*[
+            (
+                get_rendered_section,
+                section,
+                earning_rules.get("pay-bill"),
+                timestamps.get(section)
+            )
+            for section in CATALOG_SECTIONS if section in sections
+        ])
+        
+        return dict(zip(fields, rendered))
+    
+    def not_modified(self, request, etag):
+        
+        if etag is None:
+            return False
+        
+        return etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+    
+    def not_modified_response(self, etag):
+        response = HttpResponse(status=304)
+        response["ETag"] = etag
+        return response
+    
+    def catalog_response(self, data, fragments, etag):
+        
+        response = HttpResponse(
+            splice_json(data, fragments),
+            content_type="application/json",
+            status=200
+        )
+        
+        if etag:
+            response["ETag"] = etag
+        
+        return response
+
+
+class Wallet(WalletCatalog, WalletView):
     
     def post(self, request, format=None, **kwargs):
         
@@ -135,7 +88,7 @@ class Wallet(WalletView):
             
             log.info("Data Reveived for Wallet V5")
             log.info(request.data)
-        
+            
             merchant = request.user.merchant_profile
             earning_rules = request.data.get("earning_rules", {})
             
@@ -150,17 +103,123 @@ class Wallet(WalletView):
                 optimized_data["success"] = True
                 return Response(optimized_data, status=200)
             
-            data['available_vouchers'] = get_voucher_data()
-            data['available_billers'] = get_billers_data(earning_rules.get("pay-bill"))
-            data["is_active_wallet_user"] = self.is_active_wallet_user(merchant)
+            is_active_wallet_user = submit(self.is_active_wallet_user, merchant)
+            
+            # clients send back the section_versions (or the ETag) of their last
+            # response and only receive the sections that changed since
+            timestamps = catalog_timestamps()
+            versions = catalog_versions(earning_rules.get("pay-bill"), timestamps)
+            data["is_active_wallet_user"] = is_active_wallet_user()
+            
+            etag = catalog_etag(
+                versions,
+                current_balance=data["current_balance"],
+                is_active_wallet_user=data["is_active_wallet_user"]
+            )
             
+            if self.not_modified(request, etag):
+                return self.not_modified_response(etag)
+            
+            sections = changed_sections(versions, request.data.get("section_versions"))
+            
+            data["section_versions"] = versions
             data["success"] = True
             
-            return Response(data, status=200)
-
+            # the catalog sections are cached as rendered JSON and spliced in
+            # as bytes instead of being decoded and rendered again
+            fragments = self.rendered_sections(sections, earning_rules, timestamps)
+            
+            return self.catalog_response(data, fragments, etag)
+        
         except Exception as e:
             log.exception(traceback.format_exc())
             return Response({
                 "success" : False,
                 "message" : "Internal Server Error"
-            }, status=500)
\ No newline at end of file
+            }, status=500)
+
+
+class AsyncWallet(WalletCatalog, AsyncWalletView):
+    """
+    Wallet for the ASGI deployment (settings.ASYNC_VIEWS). Stamps are read
+    on the async redis client and sections held by the process cache are
+    spliced in without leaving the event loop, the balance and active-user
+    queries and cache misses run on the fan-out pool.
+    """
+    
+    def current_balance(self, merchant):
+        return merchant.current_balance / 100
+    
+    async def arendered_section(self, section, earning_rule, timestamp):
+        
+        rendered = local_rendered_section(section, earning_rule, timestamp)
+        
+        if rendered is not None:
+            return rendered
+        
+        return await run_async(get_rendered_section, section, earning_rule, timestamp)
+    
+    async def post(self, request, format=None, **kwargs):
+        
+        try:
+            
+            log.info("Data Reveived for Wallet V5")
+            
+            payload = get_payload(request).data
+            log.info(payload)
+            
+            merchant = request.user.merchant_profile
+            earning_rules = payload.get("earning_rules", {})
+            data_type = payload.get("data_type", None)
+            
+            if data_type:
+                optimized_data = await run_async(
+                    self.fetch_data_type_obj, merchant, data_type, earning_rules
+                )
+                optimized_data["success"] = True
+                return self.respond(optimized_data, status=200)
+            
+            current_balance, is_active_wallet_user, timestamps = await asyncio.gather(
+                run_async(self.current_balance, merchant),
+                run_async(self.is_active_wallet_user, merchant),
+                rds_cache.aget_timestamps(CATALOG_SECTIONS.keys())
+            )
+            
+            data = {
+                "current_balance" : current_balance,
+                "is_active_wallet_user" : is_active_wallet_user
+            }
+            
+            versions = catalog_versions(earning_rules.get("pay-bill"), timestamps)
+            
+            etag = catalog_etag(
+                versions,
+                current_balance=data["current_balance"],
+                is_active_wallet_user=data["is_active_wallet_user"]
+            )
+            
+            if self.not_modified(request, etag):
+                return self.not_modified_response(etag)
+            
+            sections = changed_sections(versions, payload.get("section_versions"))
+            
+            data["section_versions"] = versions
+            data["success"] = True
+            
+            fields = [field for section, field in CATALOG_SECTIONS.items() if section in sections]
+            
+            rendered = await asyncio.gather(*[
+                self.arendered_section(
+                    section, earning_rules.get("pay-bill"), timestamps.get(section)
+                )
+                for section in CATALOG_SECTIONS if section in sections
+            ])
+            
+            return self.catalog_response(data, dict(zip(fields, rendered)), etag)
+        
+        except Exception as e:
+            log.exception(traceback.format_exc())
+            return self.respond({
+                "success" : False,
+                "message" : "Internal Server Error"
+            }, status=500)
@@ -0,0 +1,396 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from merchant.models import Merchant
+from core.redis_ops import conn, async_client
+from core.fanout import run_async
+from transaction.models import Account, Customer
+
+log = logging.getLogger("django")
+
+DEFAULT_CACHE_TTL = 300
+DEFAULT_LOCAL_TTL = 5
+DEFAULT_LOCAL_MAX_ENTRIES = 10000
+DEFAULT_TOMBSTONE_TTL = 10
+
+# left in redis by invalidate(), a miss that loaded the row before the
+# change cannot cache it over the tombstone
+TOMBSTONE = b"invalidated"
+
+# set by the Account pre_save receiver when the iban is about to change
+PREVIOUS_IBAN_ATTRIBUTE = "_snapshot_previous_iban"
+
+# merchant fields the snapshot holds, other merchant saves (the balance)
+# leave it alone
+MERCHANT_SNAPSHOT_FIELDS = {"status", "credit_blocked", "user", "user_id"}
+MERCHANT_SNAPSHOT_COLUMNS = ("status", "credit_blocked", "user_id")
+
+# set by the Merchant pre_save receiver when a full save keeps the snapshot fields
+UNCHANGED_MERCHANT_ATTRIBUTE = "_snapshot_fields_unchanged"
+
+
+class AccountSnapshot:
+    """
+    What the switch endpoints need to know about an account, its customer,
+    merchant and user, loaded in one query and cheap to cache.
+    """
+
+    FIELDS = (
+        "account_id", "iban", "title", "level", "account_status", "customer_id",
+        "merchant_id", "merchant_status", "credit_blocked", "user_id", "username"
+    )
+
+    def __init__(
+        self,
+        account_id,
+        iban,
+        title,
+        level,
+        account_status,
+        customer_id,
+        merchant_id,
+        merchant_status,
+        credit_blocked,
+        user_id,
+        username
+    ):
+        self.account_id = account_id
+        self.iban = iban
+        self.title = title
+        self.level = level
+        self.account_status = account_status
+        self.customer_id = customer_id
+        self.merchant_id = merchant_id
+        self.merchant_status = merchant_status
+        self.credit_blocked = credit_blocked
+        self.user_id = user_id
+        self.username = username
+
+    @classmethod
+    def from_account(cls, account):
+        merchant = account.customer.merchant
+        return cls(
+            account_id=account.id,
+            iban=account.iban,
+            title=account.title,
+            level=account.level,
+            account_status=account.status,
+            customer_id=account.customer_id,
+            merchant_id=merchant.id,
+            merchant_status=merchant.status,
+            credit_blocked=merchant.credit_blocked,
+            user_id=merchant.user_id,
+            username=merchant.user.username
+        )
+
+    def to_json(self):
+        return json.dumps({field: getattr(self, field) for field in self.FIELDS})
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(**json.loads(value))
+
+    def build_account(self):
+        """
+        Deferred Account with account.customer.merchant.user already
+        attached. Fields that were not loaded are fetched on first access,
+        and save() on any of them only writes the loaded fields.
+        """
+
+        user = User.from_db("default", ["id", "username"], [self.user_id, self.username])
+
+        merchant = Merchant.from_db(
+            "default",
+            ["id", "user_id", "status", "credit_blocked"],
+            [self.merchant_id, self.user_id, self.merchant_status, self.credit_blocked]
+        )
+
+        customer = Customer.from_db("default", ["id", "merchant_id"], [self.customer_id, self.merchant_id])
+
+        account = Account.from_db(
+            "default",
+            ["id", "customer_id", "iban", "title", "level", "status"],
+            [self.account_id, self.customer_id, self.iban, self.title, self.level, self.account_status]
+        )
+
+        Merchant.user.field.set_cached_value(merchant, user)
+        Customer.merchant.field.set_cached_value(customer, merchant)
+        Account.customer.field.set_cached_value(account, customer)
+
+        return account
+
+
+class AccountResolver:
+    """
+    Resolves an IBAN to an AccountSnapshot.
+
+    Looks in a per-process LRU (ACCOUNT_LOCAL_TTL seconds, at most
+    ACCOUNT_LOCAL_MAX_ENTRIES), then redis (ACCOUNT_CACHE_TTL seconds), then
+    runs a single select_related query on the indexed iban. Entries are
+    replaced by a short lived tombstone when the account, its customer or
+    its merchant is saved or deleted, and a miss only caches its row where
+    no entry or tombstone exists. Other processes see the change once
+    their local copy expires.
+    """
+
+    KEY_PREFIX = "account_snapshot:"
+
+    def __init__(self, client=None):
+        self.client = client or conn
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, "ACCOUNT_CACHE_TTL", DEFAULT_CACHE_TTL)
+
+    @property
+    def local_ttl(self):
+        return getattr(settings, "ACCOUNT_LOCAL_TTL", DEFAULT_LOCAL_TTL)
+
+    @property
+    def local_max_entries(self):
+        return getattr(settings, "ACCOUNT_LOCAL_MAX_ENTRIES", DEFAULT_LOCAL_MAX_ENTRIES)
+
+    @property
+    def tombstone_ttl(self):
+        return getattr(settings, "ACCOUNT_TOMBSTONE_TTL", DEFAULT_TOMBSTONE_TTL)
+
+    def redis_key(self, iban):
+        return "%s%s%s" % (settings.ENV, self.KEY_PREFIX, iban)
+
+    def load(self, iban):
+
+        account = Account.objects.select_related("customer__merchant__user").only(
+            "id", "customer_id", "iban", "title", "level", "status",
+            "customer__id", "customer__merchant_id",
+            "customer__merchant__id", "customer__merchant__user_id",
+            "customer__merchant__status", "customer__merchant__credit_blocked",
+            "customer__merchant__user__id", "customer__merchant__user__username"
+        ).filter(iban=iban).order_by("id").first()
+
+        if account is None:
+            return None
+
+        return AccountSnapshot.from_account(account)
+
+    def _local_get(self, iban, now):
+
+        with self.lock:
+
+            cached = self.local.get(iban)
+
+            if cached is None:
+                return None
+
+            if cached[0] <= now:
+                self.local.pop(iban, None)
+                return None
+
+            self.local.move_to_end(iban)
+            return cached[1]
+
+    def _remember(self, iban, snapshot, now):
+
+        with self.lock:
+
+            self.local[iban] = (now + self.local_ttl, snapshot)
+            self.local.move_to_end(iban)
+
+            while len(self.local) > self.local_max_entries:
+                self.local.popitem(last=False)
+
+    def resolve(self, iban):
+
+        if not iban:
+            return None
+
+        now = time.monotonic()
+        snapshot = self._local_get(iban, now)
+
+        if snapshot is not None:
+            return snapshot
+
+        try:
+            value = self.client.get(self.redis_key(iban))
+            if value and value != TOMBSTONE:
+                snapshot = AccountSnapshot.from_json(value)
+        except Exception as e:
+            log.warning("Account cache unavailable: %s" % e)
+
+        if snapshot is None:
+
+            snapshot = self.load(iban)
+
+            if snapshot is None:
+                return None
+
+            try:
+                # NX: an invalidation since the read left a tombstone
+                self.client.set(self.redis_key(iban), snapshot.to_json(), ex=self.ttl, nx=True)
+            except Exception as e:
+                log.warning("Account cache unavailable: %s" % e)
+
+        self._remember(iban, snapshot, now)
+
+        return snapshot
+
+    async def aresolve(self, iban):
+        """
+        resolve() for async views, the redis read goes through the async
+        client and only a cache miss runs the query on the fan-out pool.
+        """
+
+        if not iban:
+            return None
+
+        now = time.monotonic()
+        snapshot = self._local_get(iban, now)
+
+        if snapshot is not None:
+            return snapshot
+
+        try:
+            value = await async_client("conn").get(self.redis_key(iban))
+            if value and value != TOMBSTONE:
+                snapshot = AccountSnapshot.from_json(value)
+                self._remember(iban, snapshot, now)
+                return snapshot
+        except Exception as e:
+            log.warning("Account cache unavailable: %s" % e)
+
+        return await run_async(self.resolve, iban)
+
+    def invalidate(self, *ibans):
+
+        ibans = [iban for iban in ibans if iban]
+
+        if not ibans:
+            return
+
+        with self.lock:
+            for iban in ibans:
+                self.local.pop(iban, None)
+
+        try:
+            pipe = self.client.pipeline()
+            for iban in ibans:
+                pipe.set(self.redis_key(iban), TOMBSTONE, ex=self.tombstone_ttl)
+            pipe.execute()
+        except Exception as e:
+            log.warning("Account cache unavailable: %s" % e)
+
+
+accounts = AccountResolver()
+
+
+class AccountLookup:
+    """IBAN lookups of the switch views, through the account snapshot cache."""
+
+    def fetch_account(self, iban):
+
+        snapshot = accounts.resolve(iban)
+
+        if snapshot is None:
+            return None
+
+        return snapshot.build_account()
+
+    async def afetch_account(self, iban):
+
+        snapshot = await accounts.aresolve(iban)
+
+        if snapshot is None:
+            return None
+
+        return snapshot.build_account()
+
+
+def invalidate_on_commit(*ibans):
+    # after the commit, so a concurrent miss cannot cache the old row again
+    transaction.on_commit(lambda: accounts.invalidate(*ibans))
+
+
+@receiver(pre_save, sender=Account)
+def remember_previous_iban(sender, instance, update_fields=None, **kwargs):
+
+    if instance.pk is None or (update_fields is not None and "iban" not in update_fields):
+        return
+
+    try:
+        previous = sender.objects.filter(pk=instance.pk).values_list("iban", flat=True).first()
+    except Exception as e:
+        log.exception(e)
+        return
+
+    if previous and previous != instance.iban:
+        setattr(instance, PREVIOUS_IBAN_ATTRIBUTE, previous)
+
+
+@receiver(post_save, sender=Account)
+@receiver(post_delete, sender=Account)
+def invalidate_account_snapshot(sender, instance, **kwargs):
+    try:
+        invalidate_on_commit(instance.iban, instance.__dict__.pop(PREVIOUS_IBAN_ATTRIBUTE, None))
+    except Exception as e:
+        log.exception(e)
+
+
+@receiver(post_save, sender=Customer)
+def invalidate_customer_account_snapshots(sender, instance, created=False, update_fields=None, **kwargs):
+
+    # the snapshot holds the customer's merchant
+    if created or update_fields and not {"merchant", "merchant_id"}.intersection(update_fields):
+        return
+
+    try:
+        invalidate_on_commit(*Account.objects.filter(
+            customer_id=instance.id
+        ).values_list("iban", flat=True))
+    except Exception as e:
+        log.exception(e)
+
+
+@receiver(pre_save, sender=Merchant)
+def remember_unchanged_merchant(sender, instance, update_fields=None, **kwargs):
+    """
+    A full save writes every field, the stored snapshot fields are read by
+    primary key so a save that only moves the balance keeps the snapshots.
+    """
+
+    if instance.pk is None or update_fields is not None:
+        return
+
+    try:
+        stored = sender.objects.filter(pk=instance.pk).values_list(*MERCHANT_SNAPSHOT_COLUMNS).first()
+    except Exception as e:
+        log.exception(e)
+        return
+
+    if stored == tuple(getattr(instance, field) for field in MERCHANT_SNAPSHOT_COLUMNS):
+        setattr(instance, UNCHANGED_MERCHANT_ATTRIBUTE, True)
+
+
+@receiver(post_save, sender=Merchant)
+@receiver(post_delete, sender=Merchant)
+def invalidate_merchant_account_snapshots(sender, instance, update_fields=None, **kwargs):
+
+    if instance.__dict__.pop(UNCHANGED_MERCHANT_ATTRIBUTE, False):
+        return
+
+    if update_fields and not MERCHANT_SNAPSHOT_FIELDS.intersection(update_fields):
+        return
+
+    try:
+        invalidate_on_commit(*Account.objects.filter(
+            customer__merchant_id=instance.id
+        ).values_list("iban", flat=True))
+    except Exception as e:
+        log.exception(e)
@@ -1,6 +1,5 @@
 from django.db import models
 from merchant.models import Merchant, Actions
-import requests
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth.models import User
@@ -8,16 +7,20 @@ from django.db import transaction
 import logging
 import traceback
 import json
-from core.mongodb import db as udhaar_db
+from core.businesses import businesses
 from core.async_recharge_utilities import record_deposit_to_rnp
 from django.core.exceptions import ObjectDoesNotExist
 from transaction.constants import RAAST_TILL_CODE_PREFIX, TILL_CODE_BASE_NUM
+from core.ids import id_allocator
+from core import outbox
 
 
 sucess_dictionary = {'COMPLETED': True, 'FAILED': False, 'PENDING': None}
 
 log = logging.getLogger("django")
 
+RNP_DEPOSIT_TOPIC = "rnp_deposit"
+
     
 class Customer(models.Model):
 
@@ -59,7 +62,7 @@ class Account(models.Model):
 
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='accounts')
     record_id = models.CharField(max_length=255, unique=True)
-    iban = models.CharField(max_length=34)
+    iban = models.CharField(max_length=34, db_index=True)
     title = models.CharField(max_length=255)
     level = models.CharField(max_length=30, choices=LEVEL_CHOICES, default='L0')
     opening_date = models.DateField()
@@ -85,7 +88,8 @@ class Account(models.Model):
         stan,
         transmission_date_time,
         sender_name,
-        comment=None
+        comment=None,
+        idempotency_key=None
     ):
         
         try:
@@ -110,15 +114,19 @@ class Account(models.Model):
                     "partner" : "raast"
                 }
                 
-                deposit_response = merchant.deposit(
-                    **maa_deposit_kwargs
-                )
+                # the reference is derived from the pre-allocated action id
+                # and written by the INSERT, no follow-up UPDATE on postgres
+                with Actions.references_from_id("{:012}"):
+                    deposit_response = merchant.deposit(
+                        **maa_deposit_kwargs
+                    )
                 action = deposit_response["deposit"]
                 
                 reference = f"{action.id:012}"
                 
-                action.reference = reference
-                action.save()
+                if action.reference != reference:
+                    action.reference = reference
+                    action.save(update_fields=["reference"])
                 
                 raast_transaction_kwargs = {
                     "amount" : amount,
@@ -133,45 +141,28 @@ class Account(models.Model):
                     "sender_name" : sender_name,
                     "created_at" : action.created,
                     "action" : action,
-                    "type" : Transaction.TYPE_CREDIT
+                    "type" : Transaction.TYPE_CREDIT,
+                    "idempotency_key" : idempotency_key
                 }
                 
                 raast_transaction = Transaction.create(
                     **raast_transaction_kwargs
                 )
                 
-                try:
-                    
-                    business = udhaar_db.businesses.find_one({
-                        "user_cloud_id": merchant.user.username,
-                        "is_active": True},{ "id":1, "_id":0, "name": 1 })
-
-                    if not business:
-                        business = { "id": None, "name": None}
-                    
-                    notify_rnp_json = {
-                        "phone_number" : merchant.user.username,
-                        "amount" : amount,
-                        "account_number" : from_iban[-4:],
-                        "account_title" : sender_name,
-                        "account_bank" : bank_name,
-                        "secret_key": merchant.secret_key,
-                        "business_id" : business.get("id", ""),
-                        "deposit_key": action.id,
-                        "reference_id": reference,
-                        "status": "COMPLETED",
-                        "message": "COMPLETED",
-                        "remote_reference_id" : rrn,
-                        "service": "raast",
-                        "recon" : True
-                    }
-                    
-                    record_deposit_to_rnp(**notify_rnp_json)
-                    
-                except Exception as e:
-                    log.exception(traceback.format_exc()) 
-                    
-                    
+                # the business lookup and the notification run after the
+                # commit, in the outbox worker, not under the balance lock
+                outbox.enqueue(
+                    RNP_DEPOSIT_TOPIC,
+                    merchant_id=merchant.id,
+                    amount=amount,
+                    account_number=from_iban[-4:],
+                    account_title=sender_name,
+                    account_bank=bank_name,
+                    deposit_key=action.id,
+                    reference_id=reference,
+                    remote_reference_id=rrn
+                )
+                
                 return {
                     "transaction" : raast_transaction,
                     "action" : action,
@@ -192,7 +183,8 @@ class Account(models.Model):
         transmission_date_time,
         bank_name,
         withdraw_transaction_id,
-        to_iban
+        to_iban,
+        idempotency_key=None
     ):
         
         try:
@@ -214,16 +206,19 @@ class Account(models.Model):
                     
                 comment["failed_transaction"] = withdraw_action.id
                 
-                refund_action = merchant.refund(
-                    uid=merchant.uid, 
-                    user=merchant.user, 
-                    amount=amount, 
-                    comment = json.dumps(comment)
-                )
+                with Actions.references_from_id("{}"):
+                    refund_action = merchant.refund(
+                        uid=merchant.uid, 
+                        user=merchant.user, 
+                        amount=amount, 
+                        comment = json.dumps(comment)
+                    )
+                
+                refund_reference = str(refund_action.id)
                 
-                refund_reference = refund_action.id
-                refund_action.reference = refund_reference
-                refund_action.save()
+                if refund_action.reference != refund_reference:
+                    refund_action.reference = refund_reference
+                    refund_action.save(update_fields=["reference"])
                 
                 withdraw_action.reference = refund_reference
                 withdraw_action.save()
@@ -243,7 +238,8 @@ class Account(models.Model):
                     "transmission_date_time" : transmission_date_time,
                     "created_at" : refund_action.created,
                     "action" : refund_action,
-                    "type" : Transaction.TYPE_REVERSAL
+                    "type" : Transaction.TYPE_REVERSAL,
+                    "idempotency_key" : idempotency_key
                 }
                 
                 raast_transaction = Transaction.create(
@@ -403,6 +399,16 @@ class Transaction(models.Model):
     amount = models.IntegerField()
     created_at = models.DateTimeField()
     type = models.CharField(max_length=50, choices=TYPES_CHOICES)
+    # "rrn:stan:transmission date" of the switch request that posted it
+    idempotency_key = models.CharField(max_length=128, blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["type", "idempotency_key"],
+                name="transaction_type_idempotency_key_uniq"
+            ),
+        ]
 
     def merchant(self):
         return self.action.merchant
@@ -424,10 +430,12 @@ class Transaction(models.Model):
         stan=None,
         transmission_date_time=None,
         transaction_identifier=None,
-        payment_identifier=None
+        payment_identifier=None,
+        idempotency_key=None
     ):
         
         transaction = cls.objects.create(
+            id=id_allocator(cls).next_id(),
             account=account,
             action=action,
             from_iban=from_iban,
@@ -442,7 +450,8 @@ class Transaction(models.Model):
             sender_name=sender_name,
             amount=amount,
             created_at=created_at,
-            type=type
+            type=type,
+            idempotency_key=idempotency_key
         )
         
         return transaction
@@ -512,4 +521,29 @@ class AccountOpening(models.Model):
             ("can_verify_aml", "Can mark AML as verified"),
             ("can_open_raast_account", "Can open Raast account"),
         ]
-    
\ No newline at end of file
+
+
+@outbox.handler(RNP_DEPOSIT_TOPIC)
+def notify_rnp_deposit(payload):
+    """Reports a raast deposit to RNP, delivered from the outbox."""
+    
+    merchant = Merchant.objects.select_related("user").get(id=payload["merchant_id"])
+    
+    business = businesses.resolve(merchant.user.username)
+    
+    record_deposit_to_rnp(
+        phone_number=merchant.user.username,
+        amount=payload["amount"],
+        account_number=payload["account_number"],
+        account_title=payload["account_title"],
+        account_bank=payload["account_bank"],
+        secret_key=merchant.secret_key,
+        business_id=business["id"],
+        deposit_key=payload["deposit_key"],
+        reference_id=payload["reference_id"],
+        status="COMPLETED",
+        message="COMPLETED",
+        remote_reference_id=payload["remote_reference_id"],
+        service="raast",
+        recon=True
+    )
@@ -1,3 +1,163 @@
+from datetime import date
+from unittest import mock
+from django.contrib.auth.models import User
 from django.test import TestCase
+import requests
+from core import http, outbox
+from core.fakes import FakeRedis
+from merchant.models import Merchant
+from transaction.accounts import AccountResolver, TOMBSTONE
+from transaction.models import Account, Customer, RNP_DEPOSIT_TOPIC
 
-# Create your tests here.
+
+class AccountSnapshotTest(TestCase):
+
+    def setUp(self):
+
+        self.client = FakeRedis()
+        self.resolver = AccountResolver(self.client)
+
+        patch = mock.patch("transaction.accounts.accounts", self.resolver)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.merchant = self.create_merchant("03001234567")
+
+        self.customer = Customer.objects.create(
+            merchant=self.merchant, record_id="c1", cnic="4210100000001", name="Ali"
+        )
+
+        self.account = Account.objects.create(
+            customer=self.customer, record_id="a1", iban="PK00RAAST0000000000000001",
+            title="Ali", opening_date=date(2026, 1, 1)
+        )
+
+    def create_merchant(self, username):
+        return Merchant.objects.create(user=User.objects.create(username=username))
+
+    def cached(self, iban):
+        return self.client.get(self.resolver.redis_key(iban))
+
+    def test_resolve_caches_the_snapshot(self):
+
+        snapshot = self.resolver.resolve(self.account.iban)
+
+        self.assertEqual(snapshot.merchant_id, self.merchant.id)
+        self.assertNotIn(self.cached(self.account.iban), (None, TOMBSTONE))
+
+        account = snapshot.build_account()
+        self.assertEqual(account.customer.merchant.user.username, "03001234567")
+
+    def test_miss_does_not_cache_a_row_invalidated_while_loading(self):
+
+        load = self.resolver.load
+
+        def load_then_change(iban):
+            snapshot = load(iban)
+            # the change commits and invalidates between the read and the SET
+            self.resolver.invalidate(iban)
+            return snapshot
+
+        with mock.patch.object(self.resolver, "load", side_effect=load_then_change):
+            self.resolver.resolve(self.account.iban)
+
+        self.assertEqual(self.cached(self.account.iban), TOMBSTONE)
+
+        self.resolver.local.clear()
+
+        with self.assertNumQueries(1):
+            self.resolver.resolve(self.account.iban)
+
+    def test_merchant_change_invalidates_on_commit(self):
+
+        self.resolver.resolve(self.account.iban)
+        self.merchant.credit_blocked = True
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.save(update_fields=["credit_blocked"])
+            self.assertNotEqual(self.cached(self.account.iban), TOMBSTONE)
+
+        self.assertEqual(self.cached(self.account.iban), TOMBSTONE)
+        self.assertTrue(self.resolver.resolve(self.account.iban).credit_blocked)
+
+    def test_full_save_keeps_the_snapshot_unless_its_fields_change(self):
+
+        self.resolver.resolve(self.account.iban)
+        self.merchant.current_balance = 500
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.save()
+
+        self.assertNotEqual(self.cached(self.account.iban), TOMBSTONE)
+
+        self.merchant.status = Merchant.STATUS_INACTIVE
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.save()
+
+        self.assertEqual(self.cached(self.account.iban), TOMBSTONE)
+
+    def test_balance_update_keeps_the_snapshot(self):
+
+        self.resolver.resolve(self.account.iban)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.merchant.save(update_fields=["current_balance"])
+
+        self.assertNotEqual(self.cached(self.account.iban), TOMBSTONE)
+
+    def test_iban_change_invalidates_the_old_iban(self):
+
+        old_iban = self.account.iban
+        self.resolver.resolve(old_iban)
+
+        self.account.iban = "PK00RAAST0000000000000002"
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account.save()
+
+        self.assertEqual(self.cached(old_iban), TOMBSTONE)
+        self.assertIsNone(self.resolver.resolve(old_iban))
+        self.assertEqual(self.resolver.resolve(self.account.iban).account_id, self.account.id)
+
+    def test_customer_reassignment_invalidates_its_accounts(self):
+
+        self.resolver.resolve(self.account.iban)
+
+        other = self.create_merchant("03007654321")
+        self.customer.merchant = other
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.save(update_fields=["merchant"])
+
+        self.assertEqual(self.cached(self.account.iban), TOMBSTONE)
+        self.assertEqual(self.resolver.resolve(self.account.iban).merchant_id, other.id)
+
+
+class RnpDepositNotificationTest(TestCase):
+
+    def setUp(self):
+        self.merchant = Merchant.objects.create(user=User.objects.create(username="03001234567"))
+
+    def test_rnp_call_goes_through_the_pooled_client_within_the_budget(self):
+
+        def record_deposit_to_rnp(**kwargs):
+            # as the recharge utilities do, a plain requests call
+            return requests.post("https://rnp.example/deposits", json=kwargs, timeout=60)
+
+        event = outbox.enqueue(
+            RNP_DEPOSIT_TOPIC, merchant_id=self.merchant.id, amount=100, account_number="0001",
+            account_title="Ali", account_bank="Bank", deposit_key=1, reference_id="R1", remote_reference_id="RRN1"
+        )
+
+        with mock.patch("transaction.models.record_deposit_to_rnp", side_effect=record_deposit_to_rnp), \
+                mock.patch("transaction.models.businesses.resolve", return_value={"id" : "b1", "name" : "Ali Store"}), \
+                mock.patch.object(http.sessions, "get") as session, \
+                self.settings(OUTBOX_DELIVERY_SECONDS=5):
+            session.return_value.request.return_value.status_code = 200
+            self.assertTrue(outbox.deliver(event))
+
+        kwargs = session.return_value.request.call_args[1]
+
+        self.assertEqual(kwargs["json"]["business_id"], "b1")
+        self.assertLessEqual(max(kwargs["timeout"]), 5)
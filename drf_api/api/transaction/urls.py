@@ -1,9 +1,18 @@
 from .views import *
-from django.conf.urls import url
+from django.conf import settings
+from core.routes import route
+
+title_fetch_view = AsyncTitleFetch if getattr(settings, "ASYNC_VIEWS", False) else TitleFetch
 
 
 urlpatterns = [
-    url(r'^credit$', CreditView.as_view(), {'auth': False,'ip_security':'all'}),
-    url(r'^title/fetch$', TitleFetch.as_view(), {'auth': False,'ip_security':'all'}),
-    url(r'^reversal$', ReversalView.as_view(), {'auth': False,'ip_security':'all'}),
+    route(
+        r'^credit$', CreditView.as_view(), 'transaction-credit', auth=False, ip_security='all',
+        lock_key_fields=('toAccountNumber',), lock_wait_ms=300, lock_max_waiters=4
+    ),
+    route(r'^title/fetch$', title_fetch_view.as_view(), 'transaction-title-fetch', auth=False, ip_security='all'),
+    route(
+        r'^reversal$', ReversalView.as_view(), 'transaction-reversal', auth=False, ip_security='all',
+        lock_key_fields=('accountNumber',), lock_wait_ms=300, lock_max_waiters=4
+    ),
 ]
\ No newline at end of file
@@ -1,17 +1,21 @@
-from core.views import AuthView
+from core.views import AuthView, AsyncAuthView
 from core.permissions import IsTokenValid
 from rest_framework.views import APIView
 from transaction.models import Account, Transaction
+from transaction.accounts import AccountLookup
 from rest_framework.response import Response
-from merchant.models import Merchant, MerchantLimits
+from merchant.models import Merchant
+from merchant.limits import MerchantLimits
 import logging
 import traceback
 import json
-from core.decorators import log_request_response
+from core.payload import get_payload
+from core.decorators import log_request_response, log_request_response_async
+from core.idempotency import idempotent
 
 log = logging.getLogger("django")
 
-class TitleFetch(AuthView):            
+class TitleFetch(AccountLookup, AuthView):            
     
     @log_request_response
     def post(self, request, *args, **kwargs):
@@ -42,11 +46,68 @@ class TitleFetch(AuthView):
             }, status=200)
 
 
-class CreditView(AuthView):
+class AsyncTitleFetch(AccountLookup, AsyncAuthView):
+    """TitleFetch for the ASGI deployment (settings.ASYNC_VIEWS)."""
     
-    def is_limit_available(self, merchant, amount):
+    @log_request_response_async
+    async def post(self, request, *args, **kwargs):
         
-        merchant_limit = MerchantLimits(merchant.user.username)
+        account_number = get_payload(request).data.get("toAccountNumber")
+        
+        try:
+            
+            account = await self.afetch_account(account_number)
+            
+            if not account:
+                return self.respond({
+                    "responseDescription" : self.INCORECT_ACCOUNT_NUMBER,
+                    "responseCode" : self.RESPONSE_CODES.get(self.INCORECT_ACCOUNT_NUMBER)
+                }, status=200)
+            
+            return self.respond({
+                "responseCode" : self.RESPONSE_CODES.get(self.PROCESSED_OK),
+                "accountTitle" : account.title,
+                "beneficiaryIBAN" : account.iban
+            }, status=200)
+            
+        except Exception as e:
+            log.exception(traceback.format_exc())
+            return self.respond({
+                "responseDescription" : self.TECHNICAL_PROBLEM,
+                "responseCode" : self.RESPONSE_CODES.get(self.TECHNICAL_PROBLEM)
+            }, status=200)
+
+
+class PostedTransactionResponse:
+    """
+    Rebuilds the response of a switch request whose transaction was posted,
+    from the transaction holding its idempotency key.
+    """
+    
+    transaction_type = None
+    
+    def recover_response(self, key):
+        
+        transaction = Transaction.objects.filter(
+            type=self.transaction_type, idempotency_key=key
+        ).only("id").first()
+        
+        if transaction is None:
+            return None
+        
+        return {
+            "responseCode" : self.RESPONSE_CODES.get(self.PROCESSED_OK),
+            "transactionLogId" : str(transaction.id)
+        }
+
+
+class CreditView(AccountLookup, PostedTransactionResponse, AuthView):
+    
+    transaction_type = Transaction.TYPE_CREDIT
+    
+    def is_limit_available(self, merchant, amount, level):
+        
+        merchant_limit = MerchantLimits(merchant.id, level)
 
         available_limit = merchant_limit.available_credit_limit
         
@@ -55,6 +116,7 @@ class CreditView(AuthView):
         
         return False
     
+    @idempotent("credit")
     @log_request_response
     def post(self, request, *args, **kwargs):
         
@@ -77,12 +139,6 @@ class CreditView(AuthView):
             transmissionDate = request.data.get("transmissionDate")
             transmissionTime = request.data.get("transmissionTime")
             
-            if self.is_duplicate_transaction(rrn):
-                return Response({
-                    "responseDescription" : self.DUPLICATE_PAYMENT,
-                    "responseCode" : self.RESPONSE_CODES.get(self.DUPLICATE_PAYMENT)
-                })
-                
             if not self.amount_valid(amount):
                 return Response({
                     "responseDescription" : self.INVALID_AMOUNT,
@@ -99,7 +155,7 @@ class CreditView(AuthView):
             
             merchant = account.customer.merchant
             
-            if not self.is_limit_available(merchant, amount):
+            if not self.is_limit_available(merchant, amount, account.level):
                 return Response({
                     "responseDescription" : self.LIMIT_OUT,
                     "responseCode" : self.RESPONSE_CODES.get(self.LIMIT_OUT)
@@ -135,7 +191,8 @@ class CreditView(AuthView):
                 stan=stan,
                 sender_name=request.data.get("senderName"),
                 comment=json.dumps(request.data),
-                transmission_date_time=f"{transmissionDate}{transmissionTime}"
+                transmission_date_time=f"{transmissionDate}{transmissionTime}",
+                idempotency_key=request.idempotency_key
             )
             
             if not transaction_response.get("success"):
@@ -158,7 +215,9 @@ class CreditView(AuthView):
                 "responseCode" : self.RESPONSE_CODES.get(self.TECHNICAL_PROBLEM)
             }, status=200)
             
-class ReversalView(AuthView):
+class ReversalView(AccountLookup, PostedTransactionResponse, AuthView):
+    
+    transaction_type = Transaction.TYPE_REVERSAL
     
     def get_withdraw_transaction(self, account, failed_withdraw_id):
         
@@ -179,6 +238,7 @@ class ReversalView(AuthView):
         ).exists()
         
     
+    @idempotent("reversal")
     @log_request_response
     def post(self, request, *args, **kwargs):
         
@@ -192,12 +252,6 @@ class ReversalView(AuthView):
             transmissionTime = request.data.get("transmissionTime")
             failed_withdraw_id = request.data.get("msgid")
             
-            if self.is_duplicate_transaction(rrn):
-                return Response({
-                    "responseDescription" : self.DUPLICATE_PAYMENT,
-                    "responseCode" : self.RESPONSE_CODES.get(self.DUPLICATE_PAYMENT)
-                })
-                
             if not self.amount_valid(amount):
                 return Response({
                     "responseDescription" : self.INVALID_AMOUNT,
@@ -248,7 +302,8 @@ class ReversalView(AuthView):
                 stan=stan,
                 transmission_date_time=f"{transmissionDate}{transmissionTime}",
                 withdraw_transaction_id=withdraw_transaction.id,
-                to_iban=to_iban
+                to_iban=to_iban,
+                idempotency_key=request.idempotency_key
             )
             
             if not refund_response.get("success"):